@@ -0,0 +1,160 @@
+import asyncio
+import random
+import httpx
+from spotipy import SpotifyException
+from features import AUDIO_FEATURES
+from records import PLAYLIST_ITEM_FIELDS, track_records
+
+API_URL = "https://api.spotify.com/v1/"
+
+
+def create_connection_pool(base_url=API_URL, max_connections=20, http2=False, timeout=10.0):
+    # Return an httpx.AsyncClient, a pool of keep-alive connections that can be shared by the AsyncSpotifyClient of
+    # every user on the same event loop. HTTP/2 needs the h2 package (pip install httpx[http2]).
+    return httpx.AsyncClient(base_url=base_url, http2=http2, timeout=timeout,
+                             limits=httpx.Limits(max_connections=max_connections,
+                                                 max_keepalive_connections=max_connections))
+
+
+class AsyncSpotifyClient:
+    # Asyncio version of the Spotify requests made by SpotifyAPI, for one user's access token. The low level methods
+    # have the same names and return the same JSON as the spotipy.Spotify methods, errors raise SpotifyException.
+    # Batch requests are sent concurrently, at most max_in_flight at a time for the user.
+    def __init__(self, access_token, connection_pool=None, max_in_flight=4, max_retries=5, base_delay=0.5,
+                 max_delay=30.0, features_cache=None):
+        self.access_token = access_token
+        self.owns_pool = connection_pool is None
+        self.connection_pool = connection_pool or create_connection_pool()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.features_cache = features_cache
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        # Close the connection pool, unless it was given by the caller and may be used by other clients.
+        if self.owns_pool:
+            await self.connection_pool.aclose()
+
+    async def request(self, method, path, params=None, payload=None, content=None, content_type="application/json"):
+        # Send a request and return its decoded JSON (None for an empty response). A 429 response is retried after its
+        # Retry-After seconds, server errors and connection problems with jittered exponential backoff. A POST, which is
+        # not idempotent (creating a playlist, adding tracks), is only retried after a 429, like in RequestScheduler.
+        idempotent = method != "POST"
+        headers = {"Authorization": f"Bearer {self.access_token}", "Content-Type": content_type}
+        if params is not None:
+            params = {key: value for key, value in params.items() if value is not None}
+
+        attempt = 0
+        while True:
+            try:
+                async with self.in_flight:
+                    response = await self.connection_pool.request(method, path, params=params, json=payload,
+                                                                  content=content, headers=headers)
+            except httpx.TransportError:
+                if attempt >= self.max_retries or not idempotent:
+                    raise
+                delay = None
+            else:
+                if response.status_code < 400:
+                    return response.json() if response.content else None
+                retryable = response.status_code == 429 or (idempotent and response.status_code >= 500)
+                if attempt >= self.max_retries or not retryable:
+                    raise SpotifyException(response.status_code, -1, f"{response.url}:\n {response.text}",
+                                           headers=response.headers)
+                try:
+                    delay = float(response.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    delay = None
+
+            if delay is None:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def current_user(self):
+        return await self.request("GET", "me")
+
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self.request("GET", "me/playlists", params={"limit": limit, "offset": offset})
+
+    async def current_user_recently_played(self, limit=50, after=None, before=None):
+        return await self.request("GET", "me/player/recently-played",
+                                  params={"limit": limit, "after": after, "before": before})
+
+    async def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        return await self.request("GET", f"playlists/{playlist_id}/tracks",
+                                  params={"fields": fields, "limit": limit, "offset": offset, "market": market})
+
+    async def audio_features(self, tracks):
+        return (await self.request("GET", "audio-features", params={"ids": ",".join(tracks)}))["audio_features"]
+
+    async def artists(self, artists):
+        return await self.request("GET", "artists", params={"ids": ",".join(artists)})
+
+    async def recommendations(self, seed_artists, limit=20, **kwargs):
+        # Kwargs are the min_, max_ and target_ audio feature parameters, like in spotipy.
+        params = {"seed_artists": ",".join(seed_artists), "limit": limit}
+        params.update(kwargs)
+        return await self.request("GET", "recommendations", params=params)
+
+    async def user_playlist_create(self, user, name, public=True, collaborative=False, description=""):
+        return await self.request("POST", f"users/{user}/playlists",
+                                  payload={"name": name, "public": public, "collaborative": collaborative,
+                                           "description": description})
+
+    async def playlist_add_items(self, playlist_id, items, position=None):
+        uris = [item if item.startswith("spotify:") else f"spotify:track:{item}" for item in items]
+        return await self.request("POST", f"playlists/{playlist_id}/tracks", params={"position": position},
+                                  payload={"uris": uris})
+
+    async def playlist_upload_cover_image(self, playlist_id, image_b64):
+        return await self.request("PUT", f"playlists/{playlist_id}/images", content=image_b64,
+                                  content_type="image/jpeg")
+
+    async def get_recently_or_playlist(self, limit, recently_played, playlist_id=None):
+        # Same as SpotifyAPI.get_recently_or_playlist, TrackRecord objects are returned. The playlist pages after the
+        # first one are requested concurrently by their offset.
+        if recently_played:
+            return track_records((await self.current_user_recently_played(limit=min(limit, 50)))["items"])
+
+        first_page = await self.playlist_items(playlist_id, PLAYLIST_ITEM_FIELDS, limit=min(limit, 50))
+        end = min(limit, first_page["total"])
+        pages = await asyncio.gather(*(self.playlist_items(playlist_id, PLAYLIST_ITEM_FIELDS, min(end - offset, 50),
+                                                           offset) for offset in range(50, end, 50)))
+        return track_records(first_page["items"] + [item for page in pages for item in page["items"]])
+
+    async def get_audio_features(self, track_ids):
+        # Same as SpotifyAPI.get_audio_features: the audio features in the order of track_ids, the batches of 100 of
+        # the track IDs missing from the features cache are requested concurrently. The cache is a SQLite database,
+        # it is read and written in a thread so the event loop is not blocked.
+        audio_features = {}
+        if self.features_cache is not None:
+            audio_features = await asyncio.to_thread(self.features_cache.get_many, track_ids)
+        missing_track_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id not in audio_features))
+        responses = await asyncio.gather(*(self.audio_features(missing_track_ids[start:start + 100])
+                                           for start in range(0, len(missing_track_ids), 100)))
+        retrieved = [track for response in responses for track in response if track is not None]
+        if self.features_cache is not None and retrieved:
+            await asyncio.to_thread(self.features_cache.put_many, retrieved)
+        audio_features.update((track["id"], track) for track in retrieved)
+        return [audio_features[track_id] for track_id in track_ids if track_id in audio_features]
+
+    async def get_recommended_tracks(self, seed_artists, target_features, limit=100):
+        # Same as SpotifyPlaylist.recommended_tracks: the seed artists are split into batches of 5, which are
+        # requested concurrently, each with the target audio features.
+        targets = {f"target_{key}": target_features.get(key) for key in AUDIO_FEATURES}
+        responses = await asyncio.gather(*(self.recommendations(seed_artists[start:start + 5], limit=limit, **targets)
+                                           for start in range(0, len(seed_artists), 5)))
+        return [track for response in responses for track in response["tracks"]]
+
+    async def add_tracks_to_playlist(self, playlist_id, track_ids):
+        # Add the tracks to the playlist in batches of 100, one after the other to keep their order.
+        for start in range(0, len(track_ids), 100):
+            await self.playlist_add_items(playlist_id, track_ids[start:start + 100])
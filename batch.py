@@ -0,0 +1,131 @@
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import AudioFeaturesCache
+from covers import COVER_UPLOADER
+from history import HistoryStore
+from http_cache import ResponseCache
+from profiles import ProfileStore
+from project import Auth, SpotifyAPI, SpotifyPlaylist
+from scheduler import RequestScheduler
+
+
+def read_job_specs(stream, file_format=None):
+    # Return the job specs from a JSON array, JSON lines (one job object per line) or CSV with a header row.
+    # The keys are the same as the query parameters of the server mode, see SpotifyPlaylist.parse_options.
+    text = stream.read()
+    stripped = text.strip()
+    if file_format == "csv" or (file_format is None and not stripped.startswith(("[", "{"))):
+        return list(csv.DictReader(io.StringIO(text)))
+    if stripped.startswith("["):
+        return json.loads(stripped)
+    return [json.loads(line) for line in stripped.splitlines() if line.strip()]
+
+
+def normalize_spec(spec):
+    # Return the job spec as a dictionary of strings, like the query parameters. Empty values are left out, so they
+    # get their default value, and true/false is accepted for include_artists.
+    result = {}
+    for key, value in spec.items():
+        if value is None or value == "":
+            continue
+        if isinstance(value, bool):
+            value = "Y" if value else "N"
+        result[key] = str(value)
+    return result
+
+
+class BatchRunner:
+    # Generate playlists from job specs without any prompts, max_workers jobs at the same time. The jobs share the
+    # audio features cache, the optional taste profile and listening history stores and one RequestScheduler, since
+    # they all use the same app's rate limit. Session_factory() returns the session of a job, for example
+    # Auth.create_user_session, whose token is refreshed in the background during long batches.
+    def __init__(self, session_factory, max_workers=4, features_cache=None, scheduler=None, profile_store=None,
+                 history_store=None):
+        self.session_factory = session_factory
+        self.max_workers = max_workers
+        self.features_cache = features_cache
+        self.scheduler = scheduler or RequestScheduler(max_in_flight=max_workers)
+        self.profile_store = profile_store
+        self.history_store = history_store
+
+    def run_job(self, index, spec):
+        # Generate one playlist and return the result of the job with its duration in seconds.
+        start_time = time.perf_counter()
+        result = {"job": index, "name": spec.get("name")}
+        try:
+            options = SpotifyPlaylist.parse_options(normalize_spec(spec))
+            spotify_api = SpotifyAPI(self.features_cache, scheduler=self.scheduler, history_store=self.history_store,
+                                     profile_store=self.profile_store)
+            spotify_api.user_session = self.session_factory()
+            result.update(SpotifyPlaylist(spotify_api).generate_playlist(**options), status="done")
+        except Exception as error:
+            result.update(status="failed", error=str(error))
+        result["seconds"] = round(time.perf_counter() - start_time, 3)
+        return result
+
+    def run(self, specs, out=sys.stdout):
+        # Run every job, print a line about each of them as they finish, and return the results in the order of specs.
+        results = [None] * len(specs)
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            futures = {executor.submit(self.run_job, index, spec): index for index, spec in enumerate(specs)}
+            for future in as_completed(futures):
+                result = future.result()
+                results[futures[future]] = result
+                detail = result.get("playlist_id") if result["status"] == "done" else result.get("error")
+                print(f"Job {result['job']} ({result['name']}) {result['status']} in {result['seconds']:.2f}s: "
+                      f"{detail}", file=out)
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate MelodyMystique playlists from a JSON or CSV job file.")
+    parser.add_argument("jobs", nargs="?", default="-", help="job spec file, '-' (default) reads stdin")
+    parser.add_argument("--format", choices=["json", "csv"], help="format of the job specs (detected by default)")
+    parser.add_argument("--workers", type=int, default=4, help="number of playlists generated at the same time")
+    parser.add_argument("--report", help="write the per-job results and timings to this JSON file")
+    parser.add_argument("--cache-path", default=Auth.CACHE_PATH, help="token cache file of an earlier login")
+    parser.add_argument("--every", type=float, help="run the jobs again every N minutes, refreshing their playlists")
+    arguments = parser.parse_args(argv)
+
+    auth = Auth(cache_path=arguments.cache_path, response_cache=ResponseCache())
+    if auth.get_cached_access_token() is None:
+        print("No saved Spotify login found. Run 'python project.py' and log in once, then try again.")
+        return 1
+
+    if arguments.jobs == "-":
+        specs = read_job_specs(sys.stdin, arguments.format)
+    else:
+        with open(arguments.jobs, newline="") as job_file:
+            specs = read_job_specs(job_file, arguments.format)
+
+    runner = BatchRunner(auth.create_user_session, arguments.workers, AudioFeaturesCache(),
+                         profile_store=ProfileStore(), history_store=HistoryStore())
+    while True:
+        start_time = time.perf_counter()
+        results = runner.run(specs)
+        failed = sum(result["status"] == "failed" for result in results)
+        print(f"{len(results) - failed} of {len(results)} playlists generated in "
+              f"{time.perf_counter() - start_time:.2f}s.")
+
+        if arguments.report:
+            with open(arguments.report, "w") as report_file:
+                json.dump(results, report_file, indent=2)
+        if not arguments.every:
+            # The covers are uploaded in the background, the process waits for them before it exits.
+            COVER_UPLOADER.wait()
+            return 1 if failed else 0
+
+        # The next runs refresh the playlists generated by this one, instead of creating new playlists.
+        for spec, result in zip(specs, results):
+            if result["status"] == "done" and not spec.get("refresh"):
+                spec["refresh"] = result["playlist_id"]
+        time.sleep(arguments.every * 60)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
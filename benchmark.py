@@ -0,0 +1,187 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from spotipy import SpotifyException
+from cache import AudioFeaturesCache
+from features import AUDIO_FEATURES
+from project import SpotifyAPI, SpotifyPlaylist
+from scheduler import RequestScheduler
+
+
+class FakeSpotify:
+    # Stand-in for spotipy.Spotify with the methods used by SpotifyAPI. Every call sleeps for latency seconds, pages
+    # hold at most page_size items, and every throttle_every-th call fails with a 429 (0 turns it off).
+    def __init__(self, playlist_size, latency=0.0, page_size=50, throttle_every=0, retry_after=0):
+        self.playlist_size = playlist_size
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, method):
+        # Count the call, wait for the simulated latency, and raise a 429 if it is the turn of one.
+        with self.lock:
+            self.calls[method] += 1
+            number = sum(self.calls.values())
+        time.sleep(self.latency)
+        if self.throttle_every and number % self.throttle_every == 0:
+            raise SpotifyException(429, -1, "rate limited", headers={"Retry-After": str(self.retry_after)})
+
+    @staticmethod
+    def track(index):
+        return {"id": f"track{index}", "duration_ms": 200000, "explicit": False,
+                "artists": [{"id": f"artist{index % 40}", "name": f"Artist {index % 40}"}]}
+
+    @staticmethod
+    def features(track_id):
+        # Deterministic audio features of the track, spread between 0 and 1 (tempo between 60 and 180).
+        seed = sum(map(ord, track_id))
+        values = {key: (seed * (position + 3) % 97) / 96 for position, key in enumerate(AUDIO_FEATURES)}
+        values["tempo"] = 60 + values["tempo"] * 120
+        values["id"] = track_id
+        return values
+
+    def items(self, limit, offset):
+        end = min(offset + min(limit, self.page_size), self.playlist_size)
+        return [{"track": self.track(index)} for index in range(offset, end)]
+
+    def current_user(self):
+        self.call("current_user")
+        return {"id": "benchmark"}
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self.call("current_user_playlists")
+        return {"items": [{"id": "source", "name": "Source", "tracks": {"total": self.playlist_size}}], "total": 1}
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self.call("current_user_recently_played")
+        return {"items": self.items(limit, 0), "cursors": {"before": None, "after": None}}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        self.call("playlist_items")
+        return {"items": self.items(limit, offset), "total": self.playlist_size}
+
+    def audio_features(self, tracks):
+        self.call("audio_features")
+        return [self.features(track_id) for track_id in tracks]
+
+    def artists(self, artists):
+        self.call("artists")
+        return {"artists": [{"id": artist_id, "name": artist_id} for artist_id in artists]}
+
+    def recommendations(self, seed_artists=None, limit=20, **kwargs):
+        self.call("recommendations")
+        return {"tracks": [self.track(self.playlist_size + index * 7 + len(seed_artists)) for index in range(limit)]}
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=''):
+        self.call("user_playlist_create")
+        return {"id": "generated"}
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        self.call("playlist_add_items")
+        return {"snapshot_id": "snapshot"}
+
+    def playlist_upload_cover_image(self, playlist_id, image_b64):
+        self.call("playlist_upload_cover_image")
+
+
+def generate(fake_spotify, scheduler, track_count, max_workers, features_cache):
+    # Generate the playlist of one benchmark run and return its summary. The cover is uploaded before the summary
+    # returns, so its request is counted.
+    spotify_api = SpotifyAPI(features_cache, max_workers=max_workers, scheduler=scheduler)
+    spotify_api.user_session = fake_spotify
+    preferences = dict.fromkeys(AUDIO_FEATURES, 7)
+    return SpotifyPlaylist(spotify_api, cover_uploader=None).generate_playlist("source", track_count, preferences,
+                                                                                "N", "Benchmark")
+
+
+def run_benchmark(track_count, latency=0.0, page_size=50, throttle_every=0, max_workers=4, rate=1000.0,
+                  features_cache=None, memory_features_cache=None):
+    # Generate one playlist from a track_count long playlist of a FakeSpotify, the same steps as primary_func without
+    # the prompts. Return the wall time, the number of API calls by method, the retries and the peak memory.
+    # Tracing the allocations slows the run down several times, so the wall time is measured on an untraced run and
+    # the peak memory on a second, traced one, with the memory_features_cache, which must be in the same state as the
+    # features_cache. The calls and the retries are those of the timed run.
+    fake_spotify = FakeSpotify(track_count, latency, page_size, throttle_every)
+    scheduler = RequestScheduler(rate=rate, burst=max(rate, 1), max_in_flight=max_workers)
+    start_time = time.perf_counter()
+    summary = generate(fake_spotify, scheduler, track_count, max_workers, features_cache)
+    seconds = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    generate(FakeSpotify(track_count, latency, page_size, throttle_every),
+             RequestScheduler(rate=rate, burst=max(rate, 1), max_in_flight=max_workers), track_count, max_workers,
+             memory_features_cache)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"tracks": track_count,
+            "analyzed_tracks": summary["analyzed_tracks"],
+            "added_tracks": summary["added_tracks"],
+            "seconds": round(seconds, 4),
+            "api_calls": sum(fake_spotify.calls.values()),
+            "api_calls_by_method": dict(sorted(fake_spotify.calls.items())),
+            "retries": scheduler.stats()["retries"],
+            "peak_memory_bytes": peak_memory}
+
+
+def run_suite(sizes=(50, 500, 10000), **options):
+    # Run the benchmark for every size twice: first with an empty audio features cache, then with the cache filled by
+    # the first run. Return the results with the settings and the environment they were measured in.
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            features_cache = AudioFeaturesCache(os.path.join(directory, f"features-{size}.sqlite"))
+            memory_features_cache = AudioFeaturesCache(os.path.join(directory, f"features-{size}-memory.sqlite"))
+            for cache_state in ("cold", "warm"):
+                result = run_benchmark(size, features_cache=features_cache,
+                                       memory_features_cache=memory_features_cache, **options)
+                result["cache"] = cache_state
+                results.append(result)
+            features_cache.close()
+            memory_features_cache.close()
+
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": options,
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MelodyMystique against a simulated Spotify API.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 10000], help="source playlist sizes")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated seconds per API call")
+    parser.add_argument("--page-size", type=int, default=50, help="max items per page the fake API returns")
+    parser.add_argument("--throttle-every", type=int, default=0, help="every N-th call gets a 429 (0 = never)")
+    parser.add_argument("--workers", type=int, default=4, help="parallel requests per generation")
+    parser.add_argument("--rate", type=float, default=1000.0, help="request rate limit of the scheduler per second")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    arguments = parser.parse_args(argv)
+
+    # The progress messages of the runs go to stderr, so the report on stdout stays valid JSON.
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_suite(arguments.sizes, latency=arguments.latency, page_size=arguments.page_size,
+                           throttle_every=arguments.throttle_every, max_workers=arguments.workers,
+                           rate=arguments.rate)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import threading
+import time
+from metrics import REGISTRY
+
+
+class AudioFeaturesCache:
+    # Audio features of a track never change, so they are kept in a SQLite database on disk between runs.
+    # The least recently used entries get evicted once the cache holds more than max_entries tracks.
+    def __init__(self, path=".features_cache.sqlite", max_entries=50000, metrics=REGISTRY):
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS audio_features ("
+                                "track_id TEXT PRIMARY KEY, features TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS audio_features_last_used ON audio_features (last_used)")
+        self.connection.commit()
+
+    def __len__(self):
+        # Return the number of tracks stored in the cache.
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM audio_features").fetchone()[0]
+
+    def get_many(self, track_ids):
+        # Return a dictionary of the cached audio features by track ID. Track IDs missing from the cache are left out.
+        unique_ids = list(dict.fromkeys(track_ids))
+        result = {}
+        with self.lock:
+            # SQLite limits the number of parameters in a single query, so the lookup is done in batches of 500.
+            for start in range(0, len(unique_ids), 500):
+                batch = unique_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT track_id, features FROM audio_features WHERE track_id IN ({placeholders})", batch)
+                for track_id, features in rows:
+                    result[track_id] = json.loads(features)
+
+            if result:
+                # Mark the found tracks as recently used, so they are the last ones to get evicted.
+                now = time.time()
+                self.connection.executemany("UPDATE audio_features SET last_used = ? WHERE track_id = ?",
+                                            [(now, track_id) for track_id in result])
+                self.connection.commit()
+
+            self.hits += len(result)
+            self.misses += len(unique_ids) - len(result)
+        if self.metrics is not None:
+            self.metrics.increment("features_cache_hits_total", len(result))
+            self.metrics.increment("features_cache_misses_total", len(unique_ids) - len(result))
+        return result
+
+    def put_many(self, tracks_audio_features):
+        # Store the audio features returned by Spotify, then evict the least recently used tracks over max_entries.
+        now = time.time()
+        rows = [(track["id"], json.dumps(track), now) for track in tracks_audio_features if track is not None]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO audio_features (track_id, features, last_used) VALUES (?, ?, ?)", rows)
+            excess = self.connection.execute("SELECT COUNT(*) FROM audio_features").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute("DELETE FROM audio_features WHERE track_id IN "
+                                        "(SELECT track_id FROM audio_features ORDER BY last_used LIMIT ?)", (excess,))
+            self.connection.commit()
+
+    def stats(self):
+        # Return the hit and miss counters, so it can be checked how many lookups the cache saved.
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
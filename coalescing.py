@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import Future
+from metrics import REGISTRY
+
+
+class RequestCoalescer:
+    # Single-flight layer of the SpotifyAPI requests: identical requests that are in flight at the same time are sent
+    # once, and every caller gets the same result (or exception). For the batch endpoints (audio features, artists)
+    # the IDs are coalesced one by one, so overlapping ID sets share the upstream calls of the IDs in common.
+    # Only data that is the same for every user may go through it, so one coalescer can be shared by the SpotifyAPI
+    # objects of every user of the server mode. Nothing is kept once a request is complete, caching is done elsewhere.
+    # Only the successful results are shared: an error can be the caller's own (for example its expired or revoked
+    # token), so when the call a caller waited for fails, the caller sends the request itself, with its own session.
+    def __init__(self, metrics=REGISTRY):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.items = {}
+
+    def count(self, method, coalesced):
+        if self.metrics is not None and coalesced:
+            self.metrics.increment("spotify_coalesced_total", coalesced, method=method)
+
+    def call(self, key, func):
+        # Return func(), or the result of the call of the same key that is already in flight. Key must be hashable
+        # and start with the name of the method, for example ('recommendations', seed_artists, ...).
+        with self.lock:
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = self.calls[key] = Future()
+        if not owner:
+            self.count(key[0], 1)
+            try:
+                return future.result()
+            except Exception:
+                return func()
+
+        try:
+            result = func()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def call_many(self, method, ids, fetch):
+        # Return a dictionary of the results by ID. Fetch(ids) requests the IDs in one upstream call and returns their
+        # results in the same order. The IDs that another caller is already requesting are not sent again, their
+        # results are waited for once the remaining IDs are fetched. The IDs whose call failed are fetched again.
+        owned, waiting = [], {}
+        with self.lock:
+            for item_id in dict.fromkeys(ids):
+                future = self.items.get((method, item_id))
+                if future is None:
+                    self.items[(method, item_id)] = Future()
+                    owned.append(item_id)
+                else:
+                    waiting[item_id] = future
+        self.count(method, len(waiting))
+
+        results = {}
+        if owned:
+            with self.lock:
+                futures = {item_id: self.items[(method, item_id)] for item_id in owned}
+            try:
+                results.update(zip(owned, fetch(owned)))
+            except BaseException as error:
+                for future in futures.values():
+                    future.set_exception(error)
+                raise
+            else:
+                for item_id, future in futures.items():
+                    future.set_result(results.get(item_id))
+            finally:
+                with self.lock:
+                    for item_id in owned:
+                        del self.items[(method, item_id)]
+
+        failed = []
+        for item_id, future in waiting.items():
+            try:
+                results[item_id] = future.result()
+            except Exception:
+                failed.append(item_id)
+        if failed:
+            results.update(zip(failed, fetch(failed)))
+        return results
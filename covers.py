@@ -0,0 +1,124 @@
+import base64
+import io
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Spotify accepts cover images of at most 256 KB, counted on the base64 encoded JPEG.
+MAX_COVER_BYTES = 256 * 1024
+COVER_PATHS = tuple(os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ("1.jpeg", "2.jpeg"))
+JPEG_SIGNATURE = b"\xff\xd8"
+
+
+def reencode(data, max_bytes):
+    # Return the image as a base64 encoded JPEG of at most max_bytes, lowering the quality first, then halving the
+    # pixels (3/4 of the width and height) until it fits. Pillow is needed, ImportError is raised without it.
+    from PIL import Image
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    quality = 90
+    while True:
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+        encoded = base64.b64encode(output.getvalue())
+        if len(encoded) <= max_bytes:
+            return encoded
+        if quality > 60:
+            quality -= 10
+        elif image.width > 1 or image.height > 1:
+            image = image.resize((max(image.width * 3 // 4, 1), max(image.height * 3 // 4, 1)))
+        else:
+            raise ValueError(f"a JPEG image does not fit in {max_bytes} bytes")
+
+
+def encode_cover(data, max_bytes=MAX_COVER_BYTES):
+    # Return the image as base64 encoded JPEG that Spotify accepts as a cover. A JPEG that fits is only encoded, a
+    # larger or other format image is re-encoded and downscaled with Pillow. Return None if that is not possible.
+    encoded = base64.b64encode(data)
+    if data.startswith(JPEG_SIGNATURE) and len(encoded) <= max_bytes:
+        return encoded
+    try:
+        return reencode(data, max_bytes)
+    except ImportError:
+        return None
+
+
+class CoverAssets:
+    # The cover images, read, checked and encoded once on the first use, then kept in memory. The images that
+    # cannot be used as a cover (too large or not JPEG, without Pillow to convert them) are left out.
+    def __init__(self, paths=COVER_PATHS, max_bytes=MAX_COVER_BYTES):
+        self.paths = paths
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.encoded = None
+
+    def load(self):
+        # Return the encoded covers, they are only read the first time.
+        with self.lock:
+            if self.encoded is None:
+                self.encoded = []
+                for path in self.paths:
+                    with open(path, 'rb') as image_file:
+                        encoded = encode_cover(image_file.read(), self.max_bytes)
+                    if encoded is None:
+                        print(f"The cover image {path} is too large or not a JPEG, install Pillow to convert it.")
+                    else:
+                        self.encoded.append(encoded)
+            return self.encoded
+
+    def choose(self, rng=random):
+        # Return a random encoded cover, or None if there is no usable cover.
+        encoded = self.load()
+        return rng.choice(encoded) if encoded else None
+
+
+class CoverUploader:
+    # Upload the covers in background threads, so a playlist generation is complete without waiting for the cover,
+    # which Spotify only accepts once the playlist is fully created. The threads only start with the first upload.
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="cover-upload")
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def submit(self, func, *args):
+        # Run func(*args) in the background and return its Future.
+        future = self.executor.submit(func, *args)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def wait(self, timeout=None):
+        # Wait for the pending uploads, for example before the batch mode exits. Return True if none is left, False if
+        # some are still pending after timeout seconds.
+        with self.lock:
+            pending = list(self.pending)
+        return not wait(pending, timeout).not_done
+
+
+def when_done(futures, callback):
+    # Call callback once every future is done, right away if there is none.
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            callback()
+
+    if not futures:
+        callback()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+# The covers and the uploader used by default, shared by every SpotifyPlaylist of the process.
+COVER_ASSETS = CoverAssets()
+COVER_UPLOADER = CoverUploader()
@@ -0,0 +1,235 @@
+import math
+import numpy as np
+
+ACOUSTICNESS = 'acousticness'
+DANCEABILITY = 'danceability'
+ENERGY = 'energy'
+INSTRUMENTALNESS = 'instrumentalness'
+LIVENESS = 'liveness'
+SPEECHINESS = 'speechiness'
+TEMPO = 'tempo'
+VALENCE = 'valence'
+
+AUDIO_FEATURES = (ACOUSTICNESS, DANCEABILITY, ENERGY, INSTRUMENTALNESS, LIVENESS, SPEECHINESS, TEMPO, VALENCE)
+
+
+class RunningStatistics:
+    # Running mean, variance, minimum and maximum of a stream of values, updated with Welford's algorithm,
+    # so only five numbers are kept no matter how many values have been added.
+    __slots__ = ("count", "mean", "m2", "minimum", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        # Update the statistics with a new value.
+        self.count += 1
+        if self.count == 1:
+            self.mean = float(value)
+            self.minimum = value
+            self.maximum = value
+            return
+
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def remove(self, value):
+        # Take a value that was added earlier out of the statistics (Welford's update in reverse). The minimum and
+        # maximum can not be restored, they stay the extremes of every value that was ever added.
+        if self.count <= 1:
+            self.__init__()
+            return
+        mean = (self.count * self.mean - value) / (self.count - 1)
+        self.m2 = max(self.m2 - (value - self.mean) * (value - mean), 0.0)
+        self.mean = mean
+        self.count -= 1
+
+    def to_list(self):
+        # Return the state of the statistics as a list, which can be stored as JSON and restored with from_list.
+        return [self.count, self.mean, self.m2, self.minimum, self.maximum]
+
+    @classmethod
+    def from_list(cls, state):
+        running_statistics = cls()
+        (running_statistics.count, running_statistics.mean, running_statistics.m2, running_statistics.minimum,
+         running_statistics.maximum) = state
+        return running_statistics
+
+    def merge(self, other):
+        # Combine the statistics of another stream into this one (Chan et al. parallel variant of Welford's algorithm).
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.minimum, self.maximum = other.minimum, other.maximum
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self):
+        # Return the sample variance, same as statistics.variance. It is 0 while there are less than two values.
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+
+class FeatureAggregator:
+    # Aggregate the audio features of tracks batch by batch, as the batches arrive from Spotify.
+    # Every analysis should use its own FeatureAggregator.
+    def __init__(self, keys=AUDIO_FEATURES):
+        self.statistics = {key: RunningStatistics() for key in keys}
+
+    def __getitem__(self, key):
+        return self.statistics[key]
+
+    def add_batch(self, tracks_audio_features):
+        # Update the running statistics with a batch of audio features returned by Spotify.
+        for track in tracks_audio_features:
+            for key, running_statistics in self.statistics.items():
+                running_statistics.add(track[key])
+
+    @property
+    def count(self):
+        # Return how many tracks have been aggregated.
+        return next(iter(self.statistics.values())).count if self.statistics else 0
+
+    def means(self):
+        # Return a new dictionary with the mean value of each audio feature.
+        return {key: running_statistics.mean for key, running_statistics in self.statistics.items()}
+
+    def bounds(self, spread=2.0):
+        # Return min_ and max_ recommendation parameters for each audio feature: the mean plus or minus spread standard
+        # deviations, kept inside the range of the values that were actually seen.
+        result = {}
+        for key, running_statistics in self.statistics.items():
+            if running_statistics.count == 0:
+                continue
+            deviation = spread * running_statistics.stdev
+            result[f"min_{key}"] = max(running_statistics.minimum, running_statistics.mean - deviation)
+            result[f"max_{key}"] = min(running_statistics.maximum, running_statistics.mean + deviation)
+        return result
+
+
+class SampleEstimate:
+    # Mean audio features of a playlist estimated from a uniform random sample of its pages, with their confidence
+    # intervals. The pages are the sampled units, so the intervals come from the spread of the page means, with the
+    # finite population correction: once every page is sampled they shrink to nothing.
+    def __init__(self, total_pages, keys=AUDIO_FEATURES):
+        self.total_pages = total_pages
+        self.keys = keys
+        self.tracks = FeatureAggregator(keys)
+        self.pages = FeatureAggregator(keys)
+
+    def add_page(self, tracks_audio_features):
+        # Update the estimate with the audio features of one sampled page.
+        tracks_audio_features = [track for track in tracks_audio_features if track is not None]
+        if not tracks_audio_features:
+            return
+        page = FeatureAggregator(self.keys)
+        page.add_batch(tracks_audio_features)
+        self.tracks.add_batch(tracks_audio_features)
+        self.pages.add_batch([page.means()])
+
+    def means(self):
+        return self.tracks.means()
+
+    def margins(self, z=1.96):
+        # Return the half width of the confidence interval of each mean, z is 1.96 for 95% confidence. The margins are
+        # infinite while less than two pages are sampled.
+        sampled_pages = self.pages.count
+        if sampled_pages < 2:
+            return dict.fromkeys(self.keys, math.inf)
+        correction = math.sqrt(max(self.total_pages - sampled_pages, 0) / max(self.total_pages - 1, 1))
+        return {key: z * self.pages[key].stdev / math.sqrt(sampled_pages) * correction for key in self.keys}
+
+    def confidence_intervals(self, z=1.96):
+        # Return the (low, high) confidence interval of each mean.
+        means = self.means()
+        return {key: (means[key] - margin, means[key] + margin) for key, margin in self.margins(z).items()}
+
+    def is_precise(self, tolerance=0.02, z=1.96):
+        # Return True if every margin is within the tolerance. Tempo moves 100 times more per preference step than the
+        # other audio features (see adjust_means), so its tolerance is 100 times larger.
+        return all(margin <= (tolerance * 100 if key == TEMPO else tolerance)
+                   for key, margin in self.margins(z).items())
+
+
+def adjust_means(means, preferences):
+    # Vectorized SpotifyPlaylist.adjust_mean: return a new dictionary with the mean value of each audio feature in
+    # preferences adjusted by the user's 0-10 preference. Tempo (mean above 10) moves by 10 BPM per step, the other
+    # audio features move by 0.1 per step and stay between 0 and 1.
+    keys = [key for key in preferences if means.get(key) is not None]
+    original = np.array([means[key] for key in keys], dtype=np.float64)
+    steps = np.array([int(preferences[key]) for key in keys], dtype=np.float64) - 5
+    adjusted = np.where(original > 10, original + steps * 10, np.clip(original + steps / 10, 0, 1))
+    # Python's round is used on the result, since np.round rounds halves differently than SpotifyPlaylist.adjust_mean.
+    return {key: round(float(value), 1) for key, value in zip(keys, adjusted)}
+
+
+class FeatureMatrix:
+    # Audio features of tracks in a NumPy array, one row per track and one column per audio feature.
+    # Values are stored as float32, the statistics are computed in float64.
+    def __init__(self, track_ids, values, columns=AUDIO_FEATURES):
+        self.track_ids = list(track_ids)
+        self.columns = tuple(columns)
+        self.values = np.asarray(values, dtype=np.float32).reshape(len(self.track_ids), len(self.columns))
+        self.column_index = {key: index for index, key in enumerate(self.columns)}
+
+    @classmethod
+    def from_audio_features(cls, tracks_audio_features, columns=AUDIO_FEATURES):
+        # Build the matrix straight from the audio_features responses. None entries (tracks without audio features)
+        # are skipped.
+        tracks_audio_features = [track for track in tracks_audio_features if track is not None]
+        values = np.fromiter((track[key] for track in tracks_audio_features for key in columns), dtype=np.float32,
+                             count=len(tracks_audio_features) * len(columns))
+        return cls([track["id"] for track in tracks_audio_features], values, columns)
+
+    @classmethod
+    def concatenate(cls, matrices, columns=AUDIO_FEATURES):
+        # Return one matrix with the rows of all the given matrices.
+        matrices = list(matrices)
+        if not matrices:
+            return cls([], [], columns)
+        return cls([track_id for matrix in matrices for track_id in matrix.track_ids],
+                   np.concatenate([matrix.values for matrix in matrices]), matrices[0].columns)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def select(self, track_ids):
+        # Return a new matrix with the rows of the given tracks, in the order of track_ids. Tracks without a row are
+        # left out.
+        rows = {track_id: index for index, track_id in enumerate(self.track_ids)}
+        kept_track_ids = [track_id for track_id in track_ids if track_id in rows]
+        return FeatureMatrix(kept_track_ids, self.values[[rows[track_id] for track_id in kept_track_ids]],
+                             self.columns)
+
+    def column(self, key):
+        # Return the values of one audio feature for every track.
+        return self.values[:, self.column_index[key]]
+
+    def to_dict(self, array):
+        # Return a dictionary of the per-column values in array by audio feature.
+        return {key: float(value) for key, value in zip(self.columns, array)}
+
+    def means(self):
+        # Return the mean value of each audio feature.
+        return self.to_dict(self.values.mean(axis=0, dtype=np.float64))
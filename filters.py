@@ -0,0 +1,69 @@
+from collections import Counter
+
+
+class RecommendationFilter:
+    # Filter recommended tracks in a single pass that keeps their order. The track and artist IDs to exclude are put
+    # in sets once, so every check is a hash lookup and the filtering stays linear in the number of tracks.
+    # Seen_track_ids are the analyzed tracks, history_track_ids the user's listening history, both are left out.
+    # Tracks of the excluded_artist_ids are left out, explicit tracks too if allow_explicit is False, and tracks outside
+    # the min_duration_ms - max_duration_ms window. At most max_tracks_per_artist tracks are kept from every artist.
+    def __init__(self, seen_track_ids=(), excluded_artist_ids=(), history_track_ids=(), allow_explicit=True,
+                 min_duration_ms=None, max_duration_ms=None, max_tracks_per_artist=None):
+        self.excluded_track_ids = set(seen_track_ids)
+        self.excluded_track_ids.update(history_track_ids)
+        self.excluded_artist_ids = set(excluded_artist_ids)
+        self.allow_explicit = allow_explicit
+        self.min_duration_ms = min_duration_ms
+        self.max_duration_ms = max_duration_ms
+        self.max_tracks_per_artist = max_tracks_per_artist
+        # The tracks kept by add, from all the batches so far.
+        self.kept_track_ids = set()
+        self.artist_counts = Counter()
+
+    def accepts(self, track):
+        # Return True if the track passes every constraint that does not depend on the other tracks.
+        if track["id"] in self.excluded_track_ids:
+            return False
+        if any(artist["id"] in self.excluded_artist_ids for artist in track["artists"]):
+            return False
+        if not self.allow_explicit and track.get("explicit"):
+            return False
+        duration_ms = track.get("duration_ms")
+        if duration_ms is not None:
+            if self.min_duration_ms is not None and duration_ms < self.min_duration_ms:
+                return False
+            if self.max_duration_ms is not None and duration_ms > self.max_duration_ms:
+                return False
+        return True
+
+    def filter(self, tracks, deduplicate=True):
+        # Return the tracks that pass the constraints, in their original order. With deduplicate, only the first
+        # occurrence of every track is kept.
+        return self.keep(tracks, set(), Counter(), deduplicate)
+
+    def add(self, tracks):
+        # Return the tracks of a batch that pass the constraints, without duplicates, like filter, but the tracks
+        # kept from the earlier batches count too. The batches of recommendations can be filtered one by one as they
+        # arrive, with the same result as filtering all of them at once.
+        return self.keep(tracks, self.kept_track_ids, self.artist_counts)
+
+    def keep(self, tracks, kept_track_ids, artist_counts, deduplicate=True):
+        # Return the tracks that pass the constraints, updating the kept track IDs and the artist counts.
+        result = []
+        for track in tracks:
+            if deduplicate and track["id"] in kept_track_ids:
+                continue
+            if not self.accepts(track):
+                continue
+            if self.max_tracks_per_artist is not None:
+                artist_ids = [artist["id"] for artist in track["artists"]]
+                if any(artist_counts[artist_id] >= self.max_tracks_per_artist for artist_id in artist_ids):
+                    continue
+                artist_counts.update(artist_ids)
+            kept_track_ids.add(track["id"])
+            result.append(track)
+        return result
+
+    def filter_ids(self, tracks):
+        # Return the IDs of the tracks that pass the constraints, without duplicates, in their original order.
+        return [track["id"] for track in self.filter(tracks)]
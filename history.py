@@ -0,0 +1,81 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+def played_at_ms(played_at):
+    # Return the played_at time of a recently played item (for example '2024-03-01T18:21:05.123Z') in milliseconds,
+    # the unit of the after and before cursors.
+    return int(datetime.fromisoformat(played_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def format_played_at(milliseconds):
+    # Inverse of played_at_ms: return the time in the played_at format of the Spotify API.
+    return datetime.fromtimestamp(milliseconds / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class HistoryStore:
+    # The recently played tracks of every user, kept in a SQLite database on disk. Each sync only requests the plays
+    # after the newest stored one, so the history grows past the 50 plays that Spotify returns at once.
+    def __init__(self, path=".history.sqlite", max_plays_per_user=None):
+        self.max_plays_per_user = max_plays_per_user
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tracks (track_id TEXT PRIMARY KEY, track TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS plays (user_id TEXT NOT NULL, played_at INTEGER NOT NULL, "
+                                "track_id TEXT NOT NULL, PRIMARY KEY (user_id, played_at))")
+        self.connection.commit()
+
+    def cursor(self, user_id):
+        # Return the time of the user's newest stored play in milliseconds, or None if nothing is stored yet.
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(played_at) FROM plays WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0]
+
+    def add_plays(self, user_id, items):
+        # Store recently played items, the plays already stored are ignored. Return the number of new plays.
+        plays = [(user_id, played_at_ms(item["played_at"]), item["track"]["id"]) for item in items]
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.executemany("INSERT OR IGNORE INTO plays (user_id, played_at, track_id) VALUES (?, ?, ?)",
+                                        plays)
+            added = self.connection.total_changes - before
+            self.connection.executemany("INSERT OR REPLACE INTO tracks (track_id, track) VALUES (?, ?)",
+                                        [(item["track"]["id"], json.dumps(item["track"])) for item in items])
+            if self.max_plays_per_user is not None:
+                self.connection.execute("DELETE FROM plays WHERE user_id = ? AND played_at NOT IN (SELECT played_at "
+                                        "FROM plays WHERE user_id = ? ORDER BY played_at DESC LIMIT ?)",
+                                        (user_id, user_id, self.max_plays_per_user))
+            self.connection.commit()
+        return added
+
+    def sync(self, spotify_api, user_id):
+        # Request the plays after the newest stored one, page by page, and store them. Return the number of new plays.
+        # Without stored plays the latest 50 plays are requested.
+        added = 0
+        while True:
+            response = spotify_api.get_recently_played_items(limit=50, after=self.cursor(user_id))
+            new_plays = self.add_plays(user_id, response["items"])
+            added += new_plays
+            if len(response["items"]) < 50 or new_plays == 0:
+                return added
+
+    def recent_items(self, user_id, limit):
+        # Return the user's latest plays, newest first, in the same format as the items of the recently played
+        # response.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT plays.played_at, tracks.track FROM plays JOIN tracks ON plays.track_id = tracks.track_id "
+                "WHERE plays.user_id = ? ORDER BY plays.played_at DESC LIMIT ?", (user_id, limit)).fetchall()
+        return [{"played_at": format_played_at(played_at), "track": json.loads(track)} for played_at, track in rows]
+
+    def track_ids(self, user_id):
+        # Return the set of every track ID in the user's history, for example to leave them out of the recommendations.
+        with self.lock:
+            rows = self.connection.execute("SELECT DISTINCT track_id FROM plays WHERE user_id = ?", (user_id,))
+            return {track_id for track_id, in rows}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,147 @@
+import json
+import sqlite3
+import threading
+import time
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from metrics import REGISTRY
+
+# Response headers kept with the cached body, the other ones are not needed to decode it again.
+STORED_HEADERS = ("Content-Type", "ETag", "Cache-Control")
+
+
+def parse_cache_control(value):
+    # Return the directives of a Cache-Control header as a dictionary, for example
+    # 'private, max-age=0' -> {'private': None, 'max-age': '0'}.
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+class ResponseCache:
+    # GET responses of the Spotify API with their ETag and Cache-Control headers, kept in a SQLite database on disk
+    # between runs. The least recently used responses get evicted once the bodies take more than max_bytes.
+    def __init__(self, path=".http_cache.sqlite", max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, headers TEXT NOT NULL, "
+                                "body BLOB NOT NULL, stored_at REAL NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def size(self):
+        # Return the number of bytes taken by the cached bodies.
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        # Return the headers, body and age in seconds of the cached response of the URL, or None if it is not cached.
+        with self.lock:
+            row = self.connection.execute("SELECT headers, body, stored_at FROM responses WHERE url = ?",
+                                          (url,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE url = ?", (time.time(), url))
+            self.connection.commit()
+        headers, body, stored_at = row
+        return json.loads(headers), body, max(time.time() - stored_at, 0)
+
+    def put(self, url, headers, body):
+        # Store the response, then evict the least recently used responses until the bodies fit in max_bytes.
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses (url, headers, body, stored_at, last_used) "
+                                    "VALUES (?, ?, ?, ?, ?)", (url, json.dumps(headers), body, now, now))
+            total = self.connection.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self.connection.execute("SELECT url, LENGTH(body) FROM responses ORDER BY last_used, url")
+                evicted = []
+                for evicted_url, length in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((evicted_url,))
+                    total -= length
+                self.connection.executemany("DELETE FROM responses WHERE url = ?", evicted)
+            self.connection.commit()
+
+    def refresh(self, url, headers):
+        # The server confirmed that the cached response is still current (304): restart its age with the new headers.
+        with self.lock:
+            self.connection.execute("UPDATE responses SET headers = ?, stored_at = ? WHERE url = ?",
+                                    (json.dumps(headers), time.time(), url))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ConditionalCacheAdapter(HTTPAdapter):
+    # Transport adapter of the requests session under spotipy that serves GET requests from a ResponseCache.
+    # A cached response is used without a request while it is fresh by its max-age, unless it is private: private
+    # responses (like the user's playlists) are always revalidated, so a cache shared by several users never serves
+    # someone else's data. Revalidation sends the ETag in If-None-Match, and a 304 answer is turned into the cached
+    # 200 response, so spotipy decodes it like a normal one.
+    def __init__(self, response_cache, metrics=REGISTRY, **kwargs):
+        super().__init__(**kwargs)
+        self.response_cache = response_cache
+        self.metrics = metrics
+
+    def count(self, outcome):
+        if self.metrics is not None:
+            self.metrics.increment("http_cache_requests_total", outcome=outcome)
+
+    def cached_response(self, request, headers, body):
+        response = Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        # The body was not received over the network this time, response_bytes_hook does not count it.
+        response.from_cache = True
+        return response
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        cached = self.response_cache.get(request.url)
+        if cached is not None:
+            headers, body, age = cached
+            cache_control = parse_cache_control(headers.get("Cache-Control"))
+            max_age = cache_control.get("max-age")
+            fresh = max_age is not None and max_age.isdigit() and age < int(max_age)
+            if fresh and "private" not in cache_control and "no-cache" not in cache_control:
+                self.count("hit")
+                return self.cached_response(request, headers, body)
+            if headers.get("ETag"):
+                request.headers["If-None-Match"] = headers["ETag"]
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            response.close()
+            headers.update((name, response.headers[name]) for name in STORED_HEADERS if name in response.headers)
+            self.response_cache.refresh(request.url, headers)
+            self.count("revalidated")
+            return self.cached_response(request, headers, body)
+
+        self.count("miss")
+        cache_control = parse_cache_control(response.headers.get("Cache-Control"))
+        if (response.status_code == 200 and "no-store" not in cache_control
+                and ("ETag" in response.headers or "max-age" in cache_control)):
+            headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+            self.response_cache.put(request.url, headers, response.content)
+        return response
@@ -0,0 +1,211 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class JobQueue:
+    # Durable queue of jobs in a SQLite database, shared by the worker processes that pull jobs from it, on one host
+    # or on several hosts that see the same file (on a filesystem with working file locks).
+    # A worker leases a job for visibility_timeout seconds and renews the lease while it works on it. A job whose
+    # lease expired (its worker died or hangs) becomes visible to the other workers again. A failed job is retried
+    # after retry_delay seconds, doubled at every attempt, until it was attempted max_attempts times, or right away
+    # if it failed permanently. A job can save its progress (see JobProgress), which the next attempt gets back, so a
+    # retried job does not repeat its side effects, for example creating a playlist again.
+    # The payload is only kept until the job is done or failed for good, since it can hold the user's access token,
+    # and secure_delete overwrites the deleted payloads in the database file.
+    def __init__(self, path=".jobs.sqlite", visibility_timeout=300, max_attempts=3, retry_delay=30, clock=time.time):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.clock = clock
+        self.lock = threading.Lock()
+        # The transactions are started explicitly, with BEGIN IMMEDIATE, so two processes never lease the same job.
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA secure_delete = ON")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                                "payload TEXT, attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL, "
+                                "lease_owner TEXT, lease_expires REAL, submitted REAL NOT NULL, started REAL, "
+                                "finished REAL, result TEXT, error TEXT, progress TEXT)")
+        # The progress column was added later, the queue databases created before get it here.
+        if "progress" not in {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")}:
+            self.connection.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_available ON jobs (status, available_at)")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def submit(self, payload):
+        # Queue a job with a JSON serializable payload and return its ID.
+        job_id = uuid.uuid4().hex
+        now = self.clock()
+        with self.transaction() as connection:
+            connection.execute("INSERT INTO jobs (id, status, payload, available_at, submitted) "
+                               "VALUES (?, 'queued', ?, ?, ?)", (job_id, json.dumps(payload), now, now))
+        return job_id
+
+    def lease(self, worker_id):
+        # Lease the oldest available job to the worker. Return a dictionary with its id, payload and attempt number,
+        # and the progress saved by an earlier attempt if there is one, or None if no job is available. The jobs whose
+        # lease expired on their last attempt are failed here.
+        now = self.clock()
+        with self.transaction() as connection:
+            connection.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', finished = ?, "
+                               "payload = NULL, lease_owner = NULL WHERE status = 'running' AND lease_expires < ? "
+                               "AND attempts >= ?", (now, now, self.max_attempts))
+            row = connection.execute("SELECT id, payload, attempts, progress FROM jobs WHERE (status = 'queued' AND "
+                                     "available_at <= ?) OR (status = 'running' AND lease_expires < ?) "
+                                     "ORDER BY available_at, submitted LIMIT 1", (now, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, "
+                               "lease_expires = ?, started = ? WHERE id = ?",
+                               (worker_id, now + self.visibility_timeout, now, row[0]))
+        job_id, payload, attempts, progress = row
+        job = {"id": job_id, "payload": json.loads(payload), "attempt": attempts + 1}
+        if progress is not None:
+            job["progress"] = json.loads(progress)
+        return job
+
+    def extend(self, job_id, worker_id):
+        # Renew the worker's lease of the job. Return False if the worker lost the lease, because it expired and the
+        # job was leased to another worker.
+        with self.transaction() as connection:
+            return connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND "
+                                      "status = 'running'", (self.clock() + self.visibility_timeout, job_id,
+                                                             worker_id)).rowcount == 1
+
+    def save_progress(self, job_id, worker_id, progress):
+        # Store the JSON serializable progress of the job for its next attempts. Return False if the worker lost the
+        # lease.
+        with self.transaction() as connection:
+            return connection.execute("UPDATE jobs SET progress = ? WHERE id = ? AND lease_owner = ? AND "
+                                      "status = 'running'", (json.dumps(progress), job_id, worker_id)).rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        # Store the result of the job. Return False if the worker lost the lease, the result is then dropped.
+        with self.transaction() as connection:
+            return connection.execute("UPDATE jobs SET status = 'done', result = ?, finished = ?, payload = NULL, "
+                                      "lease_owner = NULL WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                                      (json.dumps(result), self.clock(), job_id, worker_id)).rowcount == 1
+
+    def fail(self, job_id, worker_id, error, permanent=False):
+        # Queue the job again after the retry delay, or fail it for good after max_attempts attempts or if the failure
+        # is permanent. Return False if the worker lost the lease.
+        now = self.clock()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT attempts FROM jobs WHERE id = ? AND lease_owner = ? AND "
+                                     "status = 'running'", (job_id, worker_id)).fetchone()
+            if row is None:
+                return False
+            if row[0] < self.max_attempts and not permanent:
+                connection.execute("UPDATE jobs SET status = 'queued', error = ?, available_at = ?, "
+                                   "lease_owner = NULL WHERE id = ?",
+                                   (error, now + self.retry_delay * 2 ** (row[0] - 1), job_id))
+            else:
+                connection.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ?, payload = NULL, "
+                                   "lease_owner = NULL WHERE id = ?", (error, now, job_id))
+        return True
+
+    def status(self, job_id):
+        # Return the job's status like JobManager.status, or None if there is no job with the given ID.
+        with self.lock:
+            row = self.connection.execute("SELECT id, status, submitted, started, finished, attempts, result, error "
+                                          "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("id", "status", "submitted", "started", "finished", "attempts", "result", "error"), row))
+        if job["result"] is not None:
+            job["result"] = json.loads(job["result"])
+        return {key: value for key, value in job.items() if value is not None}
+
+    def counts(self):
+        # Return the number of jobs by status.
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class PermanentJobError(Exception):
+    # Raised by a job handler when retrying the job cannot help, for example when the user's token expired. The job
+    # is failed for good instead of queued again.
+    pass
+
+
+class JobProgress:
+    # The progress of a leased job, saved in the queue so the next attempt of the job can resume from it. Values is
+    # the progress saved by the earlier attempts.
+    def __init__(self, job_queue, job_id, worker_id, values=None):
+        self.job_queue = job_queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def save(self, **values):
+        # Add the values to the progress and store it in the queue.
+        self.values.update(values)
+        self.job_queue.save_progress(self.job_id, self.worker_id, self.values)
+
+
+class QueueWorker:
+    # Pull jobs from a JobQueue one by one and run handler(payload, progress) on them, with the job's JobProgress. The
+    # returned result must be JSON serializable. A PermanentJobError fails the job without retrying it. The lease of
+    # the running job is renewed in the background every third of the visibility timeout.
+    def __init__(self, job_queue, handler, worker_id=None, poll_interval=1.0):
+        self.job_queue = job_queue
+        self.handler = handler
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.poll_interval = poll_interval
+
+    def renew_lease(self, job_id, finished):
+        while not finished.wait(self.job_queue.visibility_timeout / 3):
+            if not self.job_queue.extend(job_id, self.worker_id):
+                return
+
+    def run_once(self):
+        # Run one job, return False if no job was available.
+        job = self.job_queue.lease(self.worker_id)
+        if job is None:
+            return False
+
+        finished = threading.Event()
+        threading.Thread(target=self.renew_lease, args=(job["id"], finished), daemon=True).start()
+        try:
+            result = self.handler(job["payload"], JobProgress(self.job_queue, job["id"], self.worker_id,
+                                                              job.get("progress")))
+        except PermanentJobError as error:
+            self.job_queue.fail(job["id"], self.worker_id, str(error), permanent=True)
+        except Exception as error:
+            self.job_queue.fail(job["id"], self.worker_id, str(error))
+        else:
+            self.job_queue.complete(job["id"], self.worker_id, result)
+        finally:
+            finished.set()
+        return True
+
+    def run(self, stop=None, until_empty=False):
+        # Run jobs until the stop event is set, or with until_empty until no job is available.
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if not self.run_once():
+                if until_empty:
+                    return
+                stop.wait(self.poll_interval)
@@ -0,0 +1,159 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Upper bounds of the latency histogram buckets in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DESCRIPTIONS = {
+    "spotify_request_seconds": "Latency of the requests sent to the Spotify API, including retries.",
+    "spotify_requests_total": "Requests sent to the Spotify API by spotipy method and outcome.",
+    "spotify_api_method_seconds": "Latency of the SpotifyAPI methods.",
+    "spotify_response_bytes_total": "Bytes received from the Spotify API by endpoint.",
+    "spotify_retries_total": "Requests retried by the RequestScheduler.",
+    "spotify_throttled_total": "Requests rate limited (429) by the Spotify API.",
+    "features_cache_hits_total": "Audio features served from the AudioFeaturesCache.",
+    "features_cache_misses_total": "Audio features missing from the AudioFeaturesCache.",
+    "pipeline_stage_seconds": "Duration of the stages of a playlist generation.",
+    "http_cache_requests_total": "GET requests by ResponseCache outcome: hit (no request), revalidated (304), miss.",
+    "spotify_coalesced_total": "Requests (or IDs of batch requests) served by an identical request already in flight.",
+}
+
+
+class Histogram:
+    # Cumulative bucket counts, sum and count of the observed values, like a Prometheus histogram.
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+
+
+def format_labels(labels, **extra):
+    # Return the labels in the Prometheus text format, for example {method="audio_features",le="0.5"}.
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class MetricsRegistry:
+    # Thread safe store of the counters and latency histograms, rendered in the Prometheus text format at /metrics.
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Observe how long the body of the with statement takes, even if it raises.
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def value(self, name, **labels):
+        # Return the value of a counter, 0 if it was never incremented.
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        # Return the histogram, or None if nothing was observed with the name and labels.
+        with self.lock:
+            return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        # Return every metric in the Prometheus text exposition format.
+        lines = []
+        with self.lock:
+            for metric_type, metrics in (("counter", self.counters), ("histogram", self.histograms)):
+                for name in sorted({name for name, labels in metrics}):
+                    lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    for (metric_name, labels), metric in sorted(metrics.items()):
+                        if metric_name != name:
+                            continue
+                        if metric_type == "counter":
+                            lines.append(f"{name}{format_labels(labels)} {metric}")
+                            continue
+                        for upper_bound, count in zip(metric.buckets, metric.counts):
+                            lines.append(f"{name}_bucket{format_labels(labels, le=upper_bound)} {count}")
+                        lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {metric.count}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {metric.sum}")
+                        lines.append(f"{name}_count{format_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry used by default, its metrics are served at /metrics.
+REGISTRY = MetricsRegistry()
+
+
+def instrumented(method):
+    # Decorator for the SpotifyAPI methods: observe their latency in the spotify_api_method_seconds histogram of the
+    # object's metrics registry.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.timer("spotify_api_method_seconds", method=method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def response_bytes_hook(metrics=REGISTRY):
+    # Return a requests response hook that counts the bytes received by endpoint, which is the first part of the API
+    # path, for example 'playlists' or 'audio-features'. Responses served by the ResponseCache are not counted.
+    def hook(response, *args, **kwargs):
+        if getattr(response, "from_cache", False):
+            return
+        parts = urlparse(response.url).path.strip("/").split("/")
+        endpoint = parts[1] if len(parts) > 1 else parts[0]
+        metrics.increment("spotify_response_bytes_total", len(response.content), endpoint=endpoint)
+    return hook
+
+
+class RunTimer:
+    # Time the stages of one playlist generation. The durations are kept for the run's breakdown, and observed in the
+    # pipeline_stage_seconds histogram of the metrics registry.
+    def __init__(self, metrics=REGISTRY):
+        self.metrics = metrics
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.stages[name] = round(self.stages.get(name, 0) + elapsed, 4)
+            if self.metrics is not None:
+                self.metrics.observe("pipeline_stage_seconds", elapsed, stage=name)
+
+    def report(self):
+        # Return the breakdown of the run, for example "fetch_tracks 0.52s, audio_features 0.31s (total 0.83s)".
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        return f"{stages} (total {sum(self.stages.values()):.2f}s)"
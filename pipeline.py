@@ -0,0 +1,67 @@
+import queue
+import threading
+
+# Put in the queue of a stage after its last item, with the exception that stopped the stage (or None).
+END = object()
+
+
+def buffered(stage, maxsize=2):
+    # Run the stage (any iterable, usually a generator) in its own thread, ahead of its consumer, and yield its items
+    # through a queue of at most maxsize items. The stage waits while the queue is full, so a fast stage never holds
+    # more than maxsize items in memory. An exception of the stage is raised to the consumer after the items before
+    # it. If the consumer stops early, the stage stops before its next item.
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in stage:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((END, error))
+        else:
+            put((END, None))
+
+    threading.Thread(target=produce, name="pipeline-stage", daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def chunks(items, size):
+    # Yield the items of an iterable in lists of size items (the last one can be shorter), as soon as each list is
+    # full, for example the track IDs of an earlier stage in batches of the 100 IDs a request accepts.
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def unique(items, seen=()):
+    # Yield the items of an iterable that were not yielded before and are not in seen, in their order.
+    seen = set(seen)
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
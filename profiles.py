@@ -0,0 +1,119 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from features import FeatureAggregator, RunningStatistics
+
+
+class TasteProfile:
+    # The analysis of one user's source (a playlist ID, or 'recent' for the recently played tracks): the running
+    # statistics of the audio features, the artist counts and the snapshot_id of the source they were computed from.
+    # When the source changes, only the added and removed tracks are applied to the profile.
+    # Tracks maps every track ID in the source to [count, artist IDs, analyzed], analyzed is False if the track had no
+    # audio features, so it is not taken out of the statistics when it is removed.
+    def __init__(self, user_id, source, snapshot_id=None, statistics=None, artist_counts=None, tracks=None):
+        self.user_id = user_id
+        self.source = source
+        self.snapshot_id = snapshot_id
+        self.features = FeatureAggregator()
+        if statistics:
+            self.features.statistics = {key: RunningStatistics.from_list(state) for key, state in statistics.items()}
+        self.artist_counts = Counter(artist_counts or {})
+        self.tracks = tracks or {}
+
+    @property
+    def track_count(self):
+        # Return the number of tracks in the source, every occurrence of a track is counted.
+        return sum(count for count, artist_ids, analyzed in self.tracks.values())
+
+    def track_ids(self):
+        return list(self.tracks)
+
+    def means(self):
+        return self.features.means()
+
+    def top_artists(self, limit=10):
+        # Return the (artist ID, track count) pairs of the top artists, like SpotifyPlaylist.get_user_top_artists.
+        # The order of the updates is not kept, so artists with the same count are ordered by their ID.
+        return sorted(self.artist_counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def diff(self, tracks):
+        # Return the added and removed track IDs as Counters of their occurrences, compared to the source's current
+        # tracks (TrackRecord objects).
+        current = Counter(track.id for track in tracks)
+        stored = Counter({track_id: entry[0] for track_id, entry in self.tracks.items()})
+        return current - stored, stored - current
+
+    def update(self, tracks, audio_features, snapshot_id=None):
+        # Apply the changes of the source's current tracks to the profile. Audio_features is a dictionary of the
+        # audio features by track ID, it needs the added and the removed tracks. Return the number of changed tracks.
+        added, removed = self.diff(tracks)
+        artist_ids = {track.id: track.artist_ids for track in tracks}
+
+        for track_id, occurrences in removed.items():
+            count, track_artist_ids, analyzed = self.tracks[track_id]
+            features = audio_features.get(track_id)
+            for _ in range(occurrences):
+                if analyzed and features is not None:
+                    for key, running_statistics in self.features.statistics.items():
+                        running_statistics.remove(features[key])
+                self.artist_counts.subtract(track_artist_ids)
+            if count == occurrences:
+                del self.tracks[track_id]
+            else:
+                self.tracks[track_id][0] -= occurrences
+
+        for track_id, occurrences in added.items():
+            features = audio_features.get(track_id)
+            if features is not None:
+                self.features.add_batch([features] * occurrences)
+            for _ in range(occurrences):
+                self.artist_counts.update(artist_ids[track_id])
+            if track_id in self.tracks:
+                self.tracks[track_id][0] += occurrences
+            else:
+                self.tracks[track_id] = [occurrences, list(artist_ids[track_id]), features is not None]
+
+        self.artist_counts = +self.artist_counts
+        self.snapshot_id = snapshot_id
+        return sum(added.values()) + sum(removed.values())
+
+    def to_json(self):
+        return json.dumps({"snapshot_id": self.snapshot_id,
+                           "statistics": {key: running_statistics.to_list()
+                                          for key, running_statistics in self.features.statistics.items()},
+                           "artist_counts": self.artist_counts,
+                           "tracks": self.tracks})
+
+    @classmethod
+    def from_json(cls, user_id, source, data):
+        return cls(user_id, source, **json.loads(data))
+
+
+class ProfileStore:
+    # The taste profiles of every user and source, kept in a SQLite database on disk between runs.
+    def __init__(self, path=".profiles.sqlite"):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS profiles (user_id TEXT NOT NULL, source TEXT NOT NULL, "
+                                "profile TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (user_id, source))")
+        self.connection.commit()
+
+    def get(self, user_id, source):
+        # Return the stored TasteProfile, or None if the user's source was never analyzed.
+        with self.lock:
+            row = self.connection.execute("SELECT profile FROM profiles WHERE user_id = ? AND source = ?",
+                                          (user_id, source)).fetchone()
+        return TasteProfile.from_json(user_id, source, row[0]) if row is not None else None
+
+    def put(self, profile):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO profiles (user_id, source, profile, updated) "
+                                    "VALUES (?, ?, ?, ?)", (profile.user_id, profile.source, profile.to_json(),
+                                                            time.time()))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,25 +1,32 @@
-import statistics
-from collections import Counter
-import base64
+from collections import Counter, deque
 import time
 import random
 from functools import partial
-from flask import Flask, redirect, request, Response
 import os
-import spotipy
-from spotipy import CacheFileHandler
-from spotipy.oauth2 import SpotifyOAuth
 from concurrent.futures import ThreadPoolExecutor
 import config
-
-ACOUSTICNESS = 'acousticness'
-DANCEABILITY = 'danceability'
-ENERGY = 'energy'
-INSTRUMENTALNESS = 'instrumentalness'
-LIVENESS = 'liveness'
-SPEECHINESS = 'speechiness'
-TEMPO = 'tempo'
-VALENCE = 'valence'
+from cache import AudioFeaturesCache
+from coalescing import RequestCoalescer
+from covers import COVER_ASSETS, COVER_UPLOADER
+from features import (ACOUSTICNESS, DANCEABILITY, ENERGY, INSTRUMENTALNESS, LIVENESS, SPEECHINESS, TEMPO, VALENCE,
+                      AUDIO_FEATURES, FeatureAggregator, FeatureMatrix, SampleEstimate, adjust_means)
+from filters import RecommendationFilter
+from history import HistoryStore
+from profiles import ProfileStore, TasteProfile
+from ranking import RecommendationRanker
+from records import PLAYLIST_ITEM_FIELDS, track_records
+from scheduler import RequestScheduler
+from metrics import REGISTRY, RunTimer, instrumented, response_bytes_hook
+from pipeline import buffered, chunks, unique
+
+# Maximum number of tracks in the generated playlist, the recommended tracks closest to the target features are kept.
+PLAYLIST_SIZE = 100
+
+# Maximum number of tracks analyzed by the sampling mode of large playlists.
+SAMPLE_MAX_TRACKS = 10000
+
+# The session methods whose requests (POST) must not be sent twice, the scheduler only retries them after a 429.
+NON_IDEMPOTENT_METHODS = {'user_playlist_create', 'playlist_add_items'}
 
 
 class Auth:
@@ -28,45 +35,108 @@ class Auth:
     CLIENTSECRET = config.CLIENTSECRET
     REDIRECTURI = "http://localhost:3000/callback"
 
-    # Create a CacheFileHandler instance with the desired cache_path
+    # Default path of the token cache file
     CACHE_PATH = ".cache"
-    cache_handler = CacheFileHandler(cache_path=CACHE_PATH)
-
-    # Spotify OAuth configuration
-    sp_oauth = SpotifyOAuth(CLIENTID, CLIENTSECRET, REDIRECTURI,
-                            scope=["user-read-recently-played", "playlist-read-private", "playlist-read-collaborative",
-                                   "playlist-modify-public", "playlist-modify-private", "ugc-image-upload",
-                                   "user-read-email", "user-read-private"], cache_handler=cache_handler)
 
-    def get_auth_url(self):
-        # Get the authorization URL
-        return self.sp_oauth.get_authorize_url()
+    def __init__(self, cache_path=CACHE_PATH, response_cache=None, token_store=None, user_key=None):
+        # The tokens are kept in a TokenStore under the user_key (the cache_path by default). Every user of the server
+        # mode gets their own key in a shared store, so their tokens are not overwritten by each other. Without a
+        # token_store, a store backed by the cache file at cache_path is used, so the login is kept between runs.
+        # The store refreshes the token in the background before it expires.
+        # The sessions are created with the optional response_cache (ResponseCache).
+        # Spotipy is imported by the methods that need it, so importing this module stays cheap.
+        from spotipy import CacheFileHandler
+        from spotipy.oauth2 import SpotifyOAuth
+        from tokens import TokenStore
+        self.token_store = token_store if token_store is not None else TokenStore(
+            backing=lambda key: CacheFileHandler(cache_path=cache_path))
+        self.user_key = user_key or cache_path
+        self.cache_handler = self.token_store.cache_handler(self.user_key)
+        self.response_cache = response_cache
+
+        # Spotify OAuth configuration
+        self.sp_oauth = SpotifyOAuth(self.CLIENTID, self.CLIENTSECRET, self.REDIRECTURI,
+                                     scope=["user-read-recently-played", "playlist-read-private",
+                                            "playlist-read-collaborative", "playlist-modify-public",
+                                            "playlist-modify-private", "ugc-image-upload", "user-read-email",
+                                            "user-read-private"], cache_handler=self.cache_handler)
+        self.token_store.register(self.user_key, self.sp_oauth.refresh_access_token)
+
+    def get_auth_url(self, state=None):
+        # Get the authorization URL. The state is sent back to the callback, the server mode identifies the user by it.
+        return self.sp_oauth.get_authorize_url(state=state)
 
     def get_spotify_session(self, code):
         # Get the access token, check if access token is expected type, then authorize with it and return active session
+        # The session reads the token from the token store on every request, so it keeps working after a refresh.
         access_token = self.sp_oauth.get_access_token(as_dict=False, code=code)
         type_of_access_token = type(access_token)
 
         if type_of_access_token != str:
             return f"Error access_token is not string, returned: {type_of_access_token}"
 
-        return spotipy.Spotify(auth=access_token)
+        return self.create_user_session()
+
+    def create_user_session(self):
+        # Return an active session with the user's token in the token store, for example one put there by a worker of
+        # the job queue.
+        return self.create_spotify_session(response_cache=self.response_cache,
+                                           auth_manager=self.token_store.token_manager(self.user_key))
+
+    def get_token_info(self, code):
+        # Exchange the code received by the callback for the user's token and return its token_info, so the playlist
+        # can be generated by another process, see worker.py.
+        self.sp_oauth.get_access_token(as_dict=False, code=code)
+        return self.token_store.get(self.user_key)
+
+    def get_cached_access_token(self):
+        # Return the access token saved in the cache file by an earlier login, refreshed if it expired, or None if
+        # there is no saved token.
+        token_info = self.sp_oauth.validate_token(self.cache_handler.get_cached_token())
+        return token_info["access_token"] if token_info else None
+
+    @staticmethod
+    def create_spotify_session(access_token=None, metrics=REGISTRY, response_cache=None, auth_manager=None):
+        # Return an active session authorized with the access token, or with the tokens of the auth_manager (for
+        # example a TokenManager). A plain requests session is used, without
+        # spotipy's own retries, so the 429 responses with their Retry-After header reach the RequestScheduler.
+        # The bytes of every response are counted in the metrics. With a response_cache (ResponseCache) the GET
+        # requests are revalidated with their ETag, and unchanged responses are read from the cache.
+        import requests
+        import spotipy
+        from http_cache import ConditionalCacheAdapter
+        requests_session = requests.Session()
+        requests_session.hooks["response"].append(response_bytes_hook(metrics))
+        if response_cache is not None:
+            requests_session.mount("https://", ConditionalCacheAdapter(response_cache, metrics))
+        return spotipy.Spotify(auth=access_token, auth_manager=auth_manager, requests_session=requests_session)
 
 
 class SpotifyAPI:
-    def __init__(self):
-        # Initialize the SpotifyAPI object with a user session and an empty dictionary of target features.
+    def __init__(self, features_cache=None, max_workers=1, scheduler=None, metrics=REGISTRY, history_store=None,
+                 profile_store=None, coalescer=None):
+        # Initialize the SpotifyAPI object with a user session and a dictionary of target features without values.
+        # The optional features_cache (AudioFeaturesCache) keeps the already retrieved audio features between runs.
+        # With max_workers above 1 the independent batch requests are sent in parallel, at most max_workers at a time.
+        # Every request is sent through the scheduler (RequestScheduler), which handles the rate limits and retries.
+        # The latency of the requests and the methods is recorded in the metrics (MetricsRegistry).
+        # With a history_store (HistoryStore) the recently played tracks are synced into it and read from it, so only
+        # the plays since the last run are requested. With a profile_store (ProfileStore) the taste profiles are kept
+        # between runs, see get_taste_profile.
+        # The audio features, artists and recommendations requests go through the coalescer (RequestCoalescer), so the
+        # identical requests in flight at the same time are sent once. Pass the same coalescer to several SpotifyAPI
+        # objects to coalesce the requests of several users.
         self.user_session = None
-        self.target_features = {
-            ACOUSTICNESS: [],
-            DANCEABILITY: [],
-            ENERGY: [],
-            INSTRUMENTALNESS: [],
-            LIVENESS: [],
-            SPEECHINESS: [],
-            TEMPO: [],
-            VALENCE: [],
-        }
+        self.current_user = (None, None)
+        self.features_cache = features_cache
+        self.history_store = history_store
+        self.profile_store = profile_store
+        self.metrics = metrics
+        self.scheduler = scheduler or RequestScheduler(max_in_flight=max_workers, metrics=metrics)
+        self.max_workers = max_workers
+        self.coalescer = coalescer if coalescer is not None else RequestCoalescer(metrics)
+        self.executor = ThreadPoolExecutor(max_workers) if max_workers > 1 else None
+        self.target_features = dict.fromkeys(AUDIO_FEATURES)
 
     def __getitem__(self, key):
         # Retrieve the value associated with the given key from the target_features dictionary.
@@ -76,10 +146,64 @@ class SpotifyAPI:
         # Set the value associated with the given key in the target_features dictionary.
         self.target_features[key] = value
 
+    def request(self, method, *args, **kwargs):
+        # Return the result of the user session's method (for example 'playlist_items'), sent through the scheduler.
+        status = "error"
+        try:
+            with self.metrics.timer("spotify_request_seconds", method=method):
+                result = self.scheduler.call(getattr(self.user_session, method), *args,
+                                             idempotent=method not in NON_IDEMPOTENT_METHODS, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            self.metrics.increment("spotify_requests_total", method=method, status=status)
+
+    def map_batches(self, func, batches):
+        # Yield the results of func called on each batch, in the same order as the batches, as soon as they are ready.
+        if self.executor is None or len(batches) < 2:
+            return (func(batch) for batch in batches)
+        return self.executor.map(func, batches)
+
+    def stream_batches(self, func, batches):
+        # Yield the results of func called on each batch, in the same order as the batches, like map_batches, but the
+        # batches can come from an earlier stage of a pipeline (a generator): every batch is submitted as soon as it is
+        # produced, and at most max_workers of them are in flight, so the results buffered here stay bounded.
+        if self.executor is None:
+            yield from map(func, batches)
+            return
+        pending = deque()
+        for batch in batches:
+            pending.append(self.executor.submit(func, batch))
+            if len(pending) >= self.max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def get_current_user_id(self):
+        # Return the ID of the user of the session, requested once per session.
+        user_session, user_id = self.current_user
+        if user_session is not self.user_session or user_id is None:
+            user_id = self.request('current_user')['id']
+            self.current_user = (self.user_session, user_id)
+        return user_id
+
+    @instrumented
+    def get_history_track_ids(self):
+        # Return the set of the track IDs of the user's listening history, for example to leave them out of the
+        # recommendations. With a history_store the history is synced first and every stored play counts, without it
+        # only the latest 50 plays are known.
+        if self.history_store is None:
+            return {track.id for track in self.get_recently_or_playlist(50, True)}
+        user_id = self.get_current_user_id()
+        self.history_store.sync(self, user_id)
+        return self.history_store.track_ids(user_id)
+
+    @instrumented
     def get_playlists(self, limit):
         # Return current users playlist. The limit maximum is 50.
-        return self.user_session.current_user_playlists(limit=limit)
+        return self.request('current_user_playlists', limit=limit)
 
+    @instrumented
     def get_tracks(self, limit, playlist_num=None, playlist_id=None):
         # Return the tracks based on user's choice of recently played/playlist tracks
         if playlist_num == 0:
@@ -87,100 +211,256 @@ class SpotifyAPI:
         else:
             return self.get_recently_or_playlist(limit, False, playlist_id)
 
+    @instrumented
     def get_recently_played_items(self, limit, after=None, before=None):
         # Return users recently played tracks
-        return self.user_session.current_user_recently_played(limit=limit, after=after, before=before)
+        return self.request('current_user_recently_played', limit=limit, after=after, before=before)
 
+    @instrumented
     def get_playlist_items(self, limit, fields=None, offset=0, market=None, playlist_id=None):
         # Return users playlist tracks with the playlist ID.
-        return self.user_session.playlist_items(playlist_id=playlist_id, fields=fields, limit=limit, offset=offset,
-                                                market=market)
+        return self.request('playlist_items', playlist_id=playlist_id, fields=fields, limit=limit, offset=offset,
+                            market=market)
 
+    @instrumented
     def get_recently_or_playlist(self, limit, recently_played, playlist_id=None):
         # Recently_played parameter can be True or False. Parameter defines if we grab the users recently played tracks
         # (True) or tracks from a playlist by playlist_id (False).
-        # Return tracks from user depending on the given recently_played parameter
+        # Return tracks from user depending on the given recently_played parameter, as TrackRecord objects. Only the
+        # fields of the playlist items that are used are requested.
         tracks = []
         before = None
-        offset = 0
         limit = int(limit)
 
+        if recently_played and self.history_store is not None:
+            user_id = self.get_current_user_id()
+            self.history_store.sync(self, user_id)
+            return track_records(self.history_store.recent_items(user_id, limit))
+
+        if not recently_played:
+            return self.get_playlist_pages(limit, playlist_id)
+
         while limit > 0:
             # Since Spotify limits the number of songs that can be retrieved in a single request to 50, the code also
             # retrieves the songs in batches of 50.
             batch_limit = min(limit, 50)
 
-            if recently_played:
-                response = self.get_recently_played_items(limit=batch_limit, before=before)
-
-                if before is not None:
-                    before = response["cursors"]["before"]
-                else:
-                    break
-            else:
-                response = self.get_playlist_items(playlist_id=playlist_id, limit=batch_limit, offset=offset)
-
+            response = self.get_recently_played_items(limit=batch_limit, before=before)
             tracks.extend(response['items'])
             limit -= batch_limit
-            offset += batch_limit
 
-            if len(response['items']) < batch_limit:
+            # The next page is the plays before the oldest one of this page, Spotify returns no cursors after the last.
+            before = (response.get("cursors") or {}).get("before")
+            if len(response['items']) < batch_limit or before is None:
                 # If there are no more tracks available, break out of while
                 break
 
-        return tracks
+        return track_records(tracks)
 
-    def get_track_audio_features(self, track_ids):
-        # Return audio features of tracks by track_ids in a dictionary.
-        # A 'copy' of track_ids is created, because the already looped through elements need to be deleted from it.
-        temporary_track_ids = list(track_ids)
-        retrieve_num = len(temporary_track_ids)
-        while retrieve_num > 0:
-            # Since Spotify limits the number of songs that can be analyzed in a single request to 100, the code also
-            # retrieve the songs audio features in batches of 100.
-            batch_limit = min(retrieve_num, 100)
-            tracks_audio_features = self.user_session.audio_features(tracks=temporary_track_ids[0:batch_limit])
-            for track in tracks_audio_features:
-                for key in self.target_features:
-                    self.target_features[key].append(track[key])
-            del temporary_track_ids[:batch_limit]
-            retrieve_num -= batch_limit
-            if retrieve_num == 0:
-                # If there are no more tracks available, break out of while
-                break
+    @instrumented
+    def get_playlist_pages(self, limit, playlist_id):
+        # Return tracks from a playlist, see iter_playlist_pages.
+        return [track for page in self.iter_playlist_pages(limit, playlist_id) for track in page]
+
+    def iter_playlist_pages(self, limit, playlist_id):
+        # Yield the tracks of a playlist page by page (TrackRecord objects), as soon as each page arrives. Once the
+        # first page reports the total number of tracks in the playlist, the rest of the pages are requested in
+        # parallel by their offset. A first page shorter than requested while more tracks remain means the API
+        # returns smaller pages, the offsets of the rest then follow its length so no track is skipped.
+        limit = int(limit)
+        first_page = self.get_playlist_items(playlist_id=playlist_id, limit=min(limit, 50), fields=PLAYLIST_ITEM_FIELDS)
+        end = min(limit, first_page['total'])
+        page_size = min(len(first_page['items']), 50)
+        yield track_records(first_page['items'])
+        if not page_size:
+            return
+
+        def get_page(offset):
+            return self.get_playlist_items(playlist_id=playlist_id, limit=min(end - offset, page_size), offset=offset,
+                                           fields=PLAYLIST_ITEM_FIELDS)['items']
+
+        for page in self.map_batches(get_page, list(range(page_size, end, page_size))):
+            yield track_records(page)
+
+    def iter_track_pages(self, limit, playlist_id=None):
+        # Yield the tracks of the playlist page by page, or the recently played tracks in one page without playlist_id.
+        if playlist_id is None:
+            yield self.get_recently_or_playlist(limit, True)
+        else:
+            yield from self.iter_playlist_pages(limit, playlist_id)
+
+    @instrumented
+    def sample_playlist(self, playlist_id, max_tracks=SAMPLE_MAX_TRACKS, tolerance=0.02, z=1.96, min_tracks=250,
+                        rng=random):
+        # Analyze a uniform random sample of the playlist's pages instead of its first tracks, for playlists too large
+        # to analyze whole. The pages are requested in rounds, and the sampling stops once the confidence intervals of
+        # the mean audio features are within the tolerance (see SampleEstimate.is_precise) after at least min_tracks
+        # tracks, or once max_tracks tracks are sampled. Return the sampled tracks (TrackRecord objects) and the
+        # SampleEstimate, whose means become the target features.
+        total = self.get_playlist_items(playlist_id=playlist_id, limit=1, fields="total")['total']
+        offsets = list(range(0, total, 50))
+        rng.shuffle(offsets)
+        estimate = SampleEstimate(len(offsets))
+        tracks = []
 
-        # Overwrite the audio feature values in the target_features dictionary by key with the mean value of the values
-        for key in self.target_features:
-            self.target_features[key] = statistics.mean(self.target_features[key])
+        def get_page(offset):
+            return track_records(self.get_playlist_items(playlist_id=playlist_id, limit=50, offset=offset,
+                                                         fields=PLAYLIST_ITEM_FIELDS)['items'])
+
+        round_size = max(self.max_workers, 2)
+        for start in range(0, len(offsets), round_size):
+            pages = list(self.map_batches(get_page, offsets[start:start + round_size]))
+            audio_features = {track["id"]: track
+                              for track in self.get_audio_features([track.id for page in pages for track in page])}
+            for page in pages:
+                tracks.extend(page)
+                estimate.add_page([audio_features.get(track.id) for track in page])
+            if len(tracks) >= max_tracks or (len(tracks) >= min_tracks and estimate.is_precise(tolerance, z)):
+                break
 
+        self.target_features = estimate.means()
+        return tracks, estimate
+
+    def iter_audio_features(self, track_ids):
+        # Yield the audio features of the tracks batch by batch, as soon as each batch is available. Audio features
+        # found in the features cache are not requested again, only the missing track IDs are sent to Spotify.
+        # A track that appears multiple times in track_ids is yielded as many times.
+        occurrences = Counter(track_ids)
+        if self.features_cache is not None:
+            cached = self.features_cache.get_many(occurrences)
+            if cached:
+                yield [cached[track_id] for track_id in track_ids if track_id in cached]
+        else:
+            cached = {}
+
+        missing_track_ids = [track_id for track_id in occurrences if track_id not in cached]
+        # Since Spotify limits the number of songs that can be analyzed in a single request to 100, the code also
+        # retrieve the songs audio features in batches of 100.
+        batches = [missing_track_ids[start:start + 100] for start in range(0, len(missing_track_ids), 100)]
+        for response in self.map_batches(self.request_audio_features, batches):
+            # Spotify returns None for tracks without audio features (for example local files), these are skipped.
+            retrieved = [track for track in response if track is not None]
+            if self.features_cache is not None and retrieved:
+                self.features_cache.put_many(retrieved)
+            yield [track for track in retrieved for _ in range(occurrences[track["id"]])]
+
+    def request_audio_features(self, track_ids):
+        # Return the audio features of at most 100 tracks, in the order of track_ids, like the audio_features method.
+        # The tracks that are already requested by another call are not requested again.
+        audio_features = self.coalescer.call_many(
+            'audio_features', track_ids, lambda batch: self.request('audio_features', tracks=batch))
+        return [audio_features[track_id] for track_id in track_ids]
+
+    @instrumented
+    def get_audio_features(self, track_ids):
+        # Return the audio features of the tracks in the order of track_ids.
+        audio_features = {}
+        for batch in self.iter_audio_features(track_ids):
+            audio_features.update((track["id"], track) for track in batch)
+        return [audio_features[track_id] for track_id in track_ids if track_id in audio_features]
+
+    @instrumented
+    def analyze_audio_features(self, track_ids):
+        # Return a new FeatureAggregator with the running statistics of the tracks' audio features. Each batch is
+        # aggregated as soon as it arrives, so the analysis overlaps with the retrieval of the next batches.
+        aggregator = FeatureAggregator()
+        for batch in self.iter_audio_features(track_ids):
+            aggregator.add_batch(batch)
+        return aggregator
+
+    @instrumented
+    def get_feature_matrix(self, track_ids):
+        # Return a FeatureMatrix with the audio features of the tracks, one row per track in the order they arrive.
+        return FeatureMatrix.concatenate(FeatureMatrix.from_audio_features(batch)
+                                         for batch in self.iter_audio_features(track_ids))
+
+    @instrumented
+    def get_track_audio_features(self, track_ids):
+        # Return the mean audio features of tracks by track_ids in a new dictionary, which also becomes the target
+        # features for the recommendations.
+        self.target_features = self.analyze_audio_features(track_ids).means()
         return self.target_features
 
+    @instrumented
+    def get_taste_profile(self, track_limit, playlist_id=None):
+        # Return the TasteProfile of the user's playlist, or of the recently played tracks without playlist_id, and
+        # set its means as the target features. With a profile_store the stored profile is reused: a playlist with the
+        # same snapshot_id (and track_limit) as before is not requested at all, otherwise only the audio features of
+        # the added and removed tracks are applied to the profile.
+        # The tracks are analyzed in a pipeline: the audio features of the new tracks of every page are requested as
+        # soon as the page arrives, while the next pages are still requested.
+        source = playlist_id or "recent"
+        profile = snapshot_id = None
+        if self.profile_store is not None:
+            profile = self.profile_store.get(self.get_current_user_id(), source)
+            if playlist_id is not None:
+                playlist_snapshot = self.request('playlist', playlist_id, fields='snapshot_id')['snapshot_id']
+                snapshot_id = f"{playlist_snapshot}/{track_limit}"
+        if profile is None:
+            profile = TasteProfile(self.get_current_user_id() if self.profile_store is not None else None, source)
+
+        if snapshot_id is None or profile.snapshot_id != snapshot_id:
+            tracks = []
+
+            def new_track_ids():
+                for page in buffered(self.iter_track_pages(track_limit, playlist_id)):
+                    tracks.extend(page)
+                    yield from (track.id for track in page)
+
+            audio_features = {}
+            for batch in self.stream_batches(self.get_audio_features, chunks(unique(new_track_ids(), profile.tracks),
+                                                                             100)):
+                audio_features.update((track["id"], track) for track in batch)
+            # The removed tracks, and the tracks of the profile that occur more times, are only known at the end.
+            added, removed = profile.diff(tracks)
+            missing_track_ids = [track_id for track_id in added + removed if track_id not in audio_features]
+            audio_features.update((track["id"], track) for track in self.get_audio_features(missing_track_ids))
+            profile.update(tracks, audio_features, snapshot_id)
+            if self.profile_store is not None:
+                self.profile_store.put(profile)
+
+        self.target_features = profile.means()
+        return profile
+
+    @instrumented
     def get_artist_info(self, artist_ids):
-        # Return artist info by artist IDs.
-        return self.user_session.artists(artist_ids)
+        # Return artist info by artist IDs (at most 50).
+        artists = self.coalescer.call_many('artists', artist_ids,
+                                           lambda batch: self.request('artists', batch)['artists'])
+        return {"artists": [artists[artist_id] for artist_id in artist_ids]}
 
-    def get_recommended_tracks(self, seed_artists, limit=100):
+    @instrumented
+    def get_recommended_tracks(self, seed_artists, limit=100, bounds=None, target_features=None):
         # Return track recommendations based on seed artist and the target audio features.
         # Seed_artists is a list of maximum 5 artist_ids
-        return self.user_session.recommendations(seed_artists=seed_artists,
-                                                 limit=limit,
-                                                 target_acousticness=self.target_features.get(ACOUSTICNESS),
-                                                 target_danceability=self.target_features.get(DANCEABILITY),
-                                                 target_energy=self.target_features.get(ENERGY),
-                                                 target_instrumentalness=self.target_features.get(INSTRUMENTALNESS),
-                                                 target_liveness=self.target_features.get(LIVENESS),
-                                                 target_speechiness=self.target_features.get(SPEECHINESS),
-                                                 target_tempo=self.target_features.get(TEMPO),
-                                                 target_valence=self.target_features.get(VALENCE))
-
+        # Bounds is an optional dictionary of min_ and max_ audio feature parameters, see FeatureAggregator.bounds.
+        # Target_features replaces the object's target features, for example for the variants of generate_variants.
+        # The same request in flight for another job is not sent again, the responses are shared, so they are not
+        # modified by the callers.
+        target_features = target_features if target_features is not None else self.target_features
+        parameters = dict(bounds or {},
+                          target_acousticness=target_features.get(ACOUSTICNESS),
+                          target_danceability=target_features.get(DANCEABILITY),
+                          target_energy=target_features.get(ENERGY),
+                          target_instrumentalness=target_features.get(INSTRUMENTALNESS),
+                          target_liveness=target_features.get(LIVENESS),
+                          target_speechiness=target_features.get(SPEECHINESS),
+                          target_tempo=target_features.get(TEMPO),
+                          target_valence=target_features.get(VALENCE))
+        key = ('recommendations', tuple(seed_artists), limit, tuple(sorted(parameters.items())))
+        return self.coalescer.call(key, lambda: self.request('recommendations', seed_artists=seed_artists,
+                                                             limit=limit, **parameters))
+
+    @instrumented
     def create_playlist(self, name):
         # Creating a public playlist for the user and assign it to the user by user ID.
-        return self.user_session.user_playlist_create(self.user_session.current_user()['id'],
-                                                      name,
-                                                      public=True,
-                                                      collaborative=False,
-                                                      description='A playlist, personalized for me.')
+        return self.request('user_playlist_create', self.get_current_user_id(),
+                            name,
+                            public=True,
+                            collaborative=False,
+                            description='A playlist, personalized for me.')
 
+    @instrumented
     def add_tracks_to_playlist(self, playlist_id, track_ids):
         # Add tracks to the newly created playlist.
         retrieve_num = len(track_ids)
@@ -188,26 +468,42 @@ class SpotifyAPI:
             # Since Spotify limits the number of songs that can be added in a single request to 100, the code also
             # adds the songs audio features in batches of 100.
             batch_limit = min(retrieve_num, 100)
-            self.user_session.playlist_add_items(playlist_id, track_ids[0:99])
+            self.request('playlist_add_items', playlist_id, track_ids[0:batch_limit])
             del track_ids[:batch_limit]
             retrieve_num -= batch_limit
             if retrieve_num == 0:
                 # If there are no more tracks available, break out of while
                 break
 
+    @instrumented
+    def remove_tracks_from_playlist(self, playlist_id, track_ids):
+        # Remove every occurrence of the tracks from the playlist, in batches of 100, the limit of a single request.
+        for start in range(0, len(track_ids), 100):
+            self.request('playlist_remove_all_occurrences_of_items', playlist_id, track_ids[start:start + 100])
+
+    @instrumented
     def add_cover_photo_to_playlist(self, playlist_id, imagebase64):
         # Add a cover image to the newly created playlist.
+        from spotipy import SpotifyException
         try:
-            self.user_session.playlist_upload_cover_image(playlist_id=playlist_id, image_b64=imagebase64)
+            self.request('playlist_upload_cover_image', playlist_id=playlist_id, image_b64=imagebase64)
             return True
-        except spotipy.SpotifyException:
+        except SpotifyException:
             return False
 
 
 class SpotifyPlaylist:
-    def __init__(self, sp_api):
+    def __init__(self, sp_api, cover_assets=COVER_ASSETS, cover_uploader=COVER_UPLOADER, on_playlist_created=None):
+        # The covers are taken from the cover_assets (CoverAssets), encoded once per process, and uploaded in the
+        # background by the cover_uploader (CoverUploader). Without a cover_uploader publish_playlist waits for the
+        # upload. The Futures of the uploads started by this object are kept in cover_uploads.
+        # On_playlist_created(playlist_id) is called as soon as a playlist is created, before its tracks are added, for
+        # example to record it so a retried job refreshes that playlist instead of creating another one.
         self.spotify_api = sp_api
-        self.remaining_tracks = None
+        self.cover_assets = cover_assets
+        self.cover_uploader = cover_uploader
+        self.on_playlist_created = on_playlist_created
+        self.cover_uploads = []
 
     @staticmethod
     def get_user_input(prompt, validation_func):
@@ -227,15 +523,8 @@ class SpotifyPlaylist:
 
     @staticmethod
     def get_user_top_artists(tracks):
-        # Get the top (max 10) artists based on a playlist or the recently played tracks.
-        result = []
-        for item in tracks:
-            artists = item['track']['artists']
-            for artist in artists:
-                artist_id = artist['id']
-                result.append(artist_id)
-
-        artist_counts = Counter(result)
+        # Get the top (max 10) artists based on a playlist or the recently played tracks (TrackRecord objects).
+        artist_counts = Counter(artist_id for track in tracks for artist_id in track.artist_ids)
         return artist_counts.most_common(10)
 
     @staticmethod
@@ -251,75 +540,227 @@ class SpotifyPlaylist:
             for i in range(len(top_artists_names)):
                 print(f"{top_artists_names[i]} - {top_artists[i][1]}")
 
-    @staticmethod
-    def recommended_tracks(seed_artists):
+    def recommended_tracks(self, seed_artists):
         # Retrieve the recommended tracks based on how many seed artist the user have.
-        # Seed_artists is a list of maximum 5 artist_ids
+        # Since Spotify limits the number of seed artists in a single request to 5, the seed artists are split into
+        # batches of 5, and every batch retrieves 100 recommended tracks.
+        batches = [seed_artists[start:start + 5] for start in range(0, len(seed_artists), 5)]
         recommended_tracks = list()
-        temporary_seed_artists = list(seed_artists)
-        # A 'copy' of seed_artists is created, because the already looped through elements need to be deleted from it.
-        retrieve_num = len(temporary_seed_artists)
-
-        while retrieve_num > 0:
-            # Since Spotify limits the number of songs that can be retrieved in a single request to 100, the code also
-            # retrieves the songs in batches of 100.
-            batch_limit = min(retrieve_num, 5)
-            response = spotify_api.get_recommended_tracks(temporary_seed_artists[:batch_limit], limit=100)['tracks']
+        for response in self.spotify_api.map_batches(
+                lambda batch: self.spotify_api.get_recommended_tracks(batch, limit=100)['tracks'], batches):
             recommended_tracks += response
-            del temporary_seed_artists[:batch_limit]
-            retrieve_num -= batch_limit
-
-            if batch_limit == 0:
-                # If there are no more tracks available, break out of while
-                break
 
         return recommended_tracks
 
-    def filter_recommendations(self, artist_included, artists_to_delete, recommendations, track_ids):
-        # Return filtered recommendations based on user's choice
-        if artist_included == 'Y':
-            return self.filter_tracks(recommendations, track_ids)
+    def generate_recommendations(self, track_ids, features, top_artist_ids, artist_inclusion, timer=None,
+                                 filter_options=None):
+        # Return the IDs of the recommended tracks, filtered by the user's choice about the top artists and the
+        # filter_options, keeping the ones that are the closest to the adjusted audio features. The stages are timed
+        # by the timer (RunTimer), the recommendations stage includes the filtering, see collect_candidates.
+        timer = timer or RunTimer(self.spotify_api.metrics)
+        recommendation_filter = self.recommendation_filter(artist_inclusion, top_artist_ids, track_ids, filter_options,
+                                                           self.history_track_ids([filter_options]))
+        with timer.stage("recommendations"):
+            candidates, candidate_features, request_count = self.collect_candidates(top_artist_ids, [features],
+                                                                                    [recommendation_filter])
+        with timer.stage("rank"):
+            return RecommendationRanker(self.spotify_api).rank(candidates[0], features, top_n=PLAYLIST_SIZE,
+                                                               features=candidate_features)
+
+    def collect_candidates(self, top_artist_ids, targets, recommendation_filters):
+        # Request the recommendations of every target features dictionary, with the seed artists in batches of 5 like
+        # recommended_tracks, filter them with the target's RecommendationFilter, then request the audio features of
+        # the kept candidates. The stages run as a pipeline: every response is filtered as soon as it arrives, and the
+        # audio features of the candidates are requested while the next recommendations are still requested, so only
+        # the candidate IDs are kept from the responses. The requests that are the same for several targets are sent
+        # once. Return the candidate IDs of every target, the FeatureMatrix of all the candidates and the number of
+        # recommendations requests.
+        batches = [tuple(top_artist_ids[start:start + 5]) for start in range(0, len(top_artist_ids), 5)]
+        target_keys = [tuple(sorted(target.items())) for target in targets]
+        request_keys = list(dict.fromkeys((batch, target_key) for target_key in target_keys for batch in batches))
+        candidates = [[] for _ in targets]
+
+        def candidate_ids():
+            # The responses arrive in the order of request_keys, so the batches of every target are filtered in order.
+            responses = self.spotify_api.map_batches(
+                lambda key: self.spotify_api.get_recommended_tracks(list(key[0]), limit=100,
+                                                                    target_features=dict(key[1]))['tracks'],
+                request_keys)
+            for (batch, target_key), tracks in zip(request_keys, responses):
+                for index, recommendation_filter in enumerate(recommendation_filters):
+                    if target_keys[index] == target_key:
+                        kept_track_ids = [track["id"] for track in recommendation_filter.add(tracks)]
+                        candidates[index].extend(kept_track_ids)
+                        yield from kept_track_ids
+
+        feature_batches = self.spotify_api.stream_batches(self.spotify_api.get_audio_features,
+                                                          chunks(unique(buffered(candidate_ids())), 100))
+        candidate_features = FeatureMatrix.concatenate(FeatureMatrix.from_audio_features(batch)
+                                                       for batch in feature_batches)
+        return candidates, candidate_features, len(request_keys)
+
+    def publish_playlist(self, playlist_name, track_ids, timer=None):
+        # Create the playlist, add the tracks to it and upload a random cover photo. Return the created playlist ID.
+        # The cover is uploaded in the background, the cover stage only times the start of the upload.
+        timer = timer or RunTimer(self.spotify_api.metrics)
+        with timer.stage("write_playlist"):
+            generated_playlist_id = self.spotify_api.create_playlist(playlist_name)['id']
+            if self.on_playlist_created is not None:
+                self.on_playlist_created(generated_playlist_id)
+            self.spotify_api.add_tracks_to_playlist(generated_playlist_id, list(track_ids))
+        with timer.stage("cover"):
+            self.upload_cover(generated_playlist_id)
+        return generated_playlist_id
+
+    def upload_cover(self, playlist_id):
+        # Upload a random cover photo to the playlist, in the background if there is a cover_uploader.
+        base64encoded = self.get_playlist_imagebase64()
+        if base64encoded is not None and self.cover_uploader is None:
+            self.wait_for_playlist_cover_to_be_uploaded(playlist_id, base64encoded)
+        elif base64encoded is not None:
+            self.cover_uploads.append(self.cover_uploader.submit(
+                self.wait_for_playlist_cover_to_be_uploaded, playlist_id, base64encoded))
+
+    def refresh_playlist(self, playlist_id, track_ids, timer=None):
+        # Replace the tracks of an existing playlist with track_ids, sending only the difference: the tracks that are
+        # no longer recommended are removed, the new ones are added after the kept ones in their ranked order. The
+        # playlist ID and its cover stay the same. Return the number of added and removed tracks.
+        timer = timer or RunTimer(self.spotify_api.metrics)
+        with timer.stage("write_playlist"):
+            # A playlist holds at most 10000 tracks.
+            current_track_ids = [track.id for track in self.spotify_api.get_recently_or_playlist(10000, False,
+                                                                                                 playlist_id)]
+            new_track_ids = set(track_ids)
+            removed = list(dict.fromkeys(track_id for track_id in current_track_ids if track_id not in new_track_ids))
+            current_track_ids = set(current_track_ids)
+            added = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in current_track_ids]
+            self.spotify_api.remove_tracks_from_playlist(playlist_id, removed)
+            self.spotify_api.add_tracks_to_playlist(playlist_id, list(added))
+        return {"added_tracks": len(added), "removed_tracks": len(removed)}
+
+    def generate_playlist(self, playlist_id, track_limit, preferences, artist_inclusion, playlist_name,
+                          filter_options=None, sample=False, target_playlist_id=None):
+        # Non-interactive version of primary_func, every choice is given in the parameters. Playlist_id is the ID of
+        # the analyzed playlist, or None to analyze the recently played tracks. Preferences is a dictionary of the 0-10
+        # preference by audio feature, filter_options the extra constraints of RecommendationFilter. With sample the
+        # playlist is sampled (see SpotifyAPI.sample_playlist) with track_limit as the maximum number of tracks.
+        # With target_playlist_id no new playlist is created, that earlier generated playlist is refreshed instead
+        # (see refresh_playlist). Return a summary of the generated playlist with the time of each stage.
+        variant = {"preferences": preferences, "artist_inclusion": artist_inclusion, "playlist_name": playlist_name,
+                   "filter_options": filter_options, "target_playlist_id": target_playlist_id}
+        summary = self.generate_variants(playlist_id, track_limit, [variant], sample)
+        playlist = summary["playlists"][0]
+        result = {"playlist_id": playlist["playlist_id"],
+                  "analyzed_tracks": summary["analyzed_tracks"],
+                  "added_tracks": playlist["added_tracks"],
+                  "timings": summary["timings"]}
+        if "removed_tracks" in playlist:
+            result["removed_tracks"] = playlist["removed_tracks"]
+        if "confidence_intervals" in summary:
+            result["confidence_intervals"] = summary["confidence_intervals"]
+        return result
+
+    def generate_variants(self, playlist_id, track_limit, variants, sample=False):
+        # Generate several playlists from one analysis of the source, for example a high-energy, a chill and a
+        # discovery one. Playlist_id, track_limit and sample are the same as for generate_playlist, every variant is a
+        # dictionary of the other generate_playlist parameters: preferences, artist_inclusion, playlist_name and the
+        # optional filter_options and target_playlist_id. The recommendations requests that are the same for several
+        # variants (same seed artists and adjusted target features) are sent once, and the audio features of every
+        # variant's candidates are retrieved together. Return a summary with the generated playlists and the time of
+        # each stage.
+        timer = RunTimer(self.spotify_api.metrics)
+        summary = {}
+        if sample and playlist_id is not None:
+            with timer.stage("sample_tracks"):
+                tracks, estimate = self.spotify_api.sample_playlist(playlist_id, track_limit)
+                track_ids = [track.id for track in tracks]
+                top_artists = self.get_user_top_artists(tracks)
+                summary["analyzed_tracks"] = len(tracks)
+                summary["confidence_intervals"] = estimate.confidence_intervals()
         else:
-            self.remaining_tracks = self.exclude_top_artists(artists_to_delete, recommendations)
-            return self.filter_tracks(self.remaining_tracks, track_ids)
+            with timer.stage("taste_profile"):
+                profile = self.spotify_api.get_taste_profile(track_limit, playlist_id)
+                track_ids = profile.track_ids()
+                top_artists = profile.top_artists()
+                summary["analyzed_tracks"] = profile.track_count
+        if not summary["analyzed_tracks"]:
+            # Without tracks there are no seed artists nor target features, so no (empty) playlist is written.
+            raise ValueError("no tracks were found to analyze")
+        features = dict(self.spotify_api.target_features)
+        top_artist_ids = [artist_id for artist_id, count in top_artists]
+
+        # The recommendations of every variant are requested with the variant's adjusted target features.
+        targets = [dict(features, **adjust_means(features, variant["preferences"])) for variant in variants]
+        history_track_ids = self.history_track_ids([variant.get("filter_options") for variant in variants])
+        recommendation_filters = [self.recommendation_filter(variant["artist_inclusion"], top_artist_ids, track_ids,
+                                                             variant.get("filter_options"), history_track_ids)
+                                  for variant in variants]
+        with timer.stage("recommendations"):
+            candidates, candidate_features, request_count = self.collect_candidates(top_artist_ids, targets,
+                                                                                    recommendation_filters)
+        with timer.stage("rank"):
+            ranker = RecommendationRanker(self.spotify_api)
+            final_track_ids = [ranker.rank(variant_track_ids, target, top_n=PLAYLIST_SIZE, features=candidate_features)
+                               for variant_track_ids, target in zip(candidates, targets)]
+
+        summary["playlists"] = []
+        for variant, variant_track_ids in zip(variants, final_track_ids):
+            playlist = {"playlist_name": variant["playlist_name"], "added_tracks": len(variant_track_ids)}
+            if variant.get("target_playlist_id"):
+                playlist["playlist_id"] = variant["target_playlist_id"]
+                playlist.update(self.refresh_playlist(variant["target_playlist_id"], variant_track_ids, timer))
+            else:
+                playlist["playlist_id"] = self.publish_playlist(variant["playlist_name"], variant_track_ids, timer)
+            summary["playlists"].append(playlist)
+        summary["recommendation_requests"] = request_count
+        summary["timings"] = timer.stages
+        return summary
 
     @staticmethod
-    def filter_tracks(tracks, filter_track_ids):
-        # Return a filtered list of track ids that were not present in the filter_track_ids parameter
-        track_ids = list()
-        track_ids += [track["id"] for track in tracks]
-        filtered_track_ids = [track_id for track_id in track_ids if track_id not in filter_track_ids]
-        get_rid_of_duplicates = set(filtered_track_ids)
-        filtered_track_ids = list(get_rid_of_duplicates)
-        return filtered_track_ids
+    def filter_recommendations(artist_included, artists_to_delete, recommendations, track_ids, filter_options=None):
+        # Return filtered recommendation IDs based on user's choice, in the order of the recommendations.
+        # Filter_options are the extra constraints of RecommendationFilter, for example max_tracks_per_artist.
+        return SpotifyPlaylist.recommendation_filter(artist_included, artists_to_delete, track_ids,
+                                                     filter_options).filter_ids(recommendations)
 
     @staticmethod
-    def exclude_top_artists(artists_to_delete, tracks):
-        # Return a filtered list of tracks which artist_id is not present in artists_to_delete parameter
-        result = list()
-        for track in tracks:
-            has_top_artist = any(artist["id"] in artists_to_delete for artist in track["artists"])
-            if not has_top_artist:
-                result.append(track)
-        return result
+    def recommendation_filter(artist_included, artists_to_delete, track_ids, filter_options=None,
+                              history_track_ids=()):
+        # Return the RecommendationFilter of the user's choices, see filter_recommendations. The history_track_ids
+        # are only left out if the filter_options have exclude_history.
+        excluded_artist_ids = artists_to_delete if artist_included == 'N' else ()
+        filter_options = dict(filter_options or {})
+        if not filter_options.pop("exclude_history", False):
+            history_track_ids = ()
+        return RecommendationFilter(track_ids, excluded_artist_ids, history_track_ids, **filter_options)
+
+    def history_track_ids(self, filter_options):
+        # Return the track IDs of the user's listening history if one of the filter_options (a list, one per playlist)
+        # has exclude_history, otherwise an empty tuple, so the history is only requested when it is needed.
+        if any((options or {}).get("exclude_history") for options in filter_options):
+            return self.spotify_api.get_history_track_ids()
+        return ()
 
     @staticmethod
-    def get_playlist_imagebase64():
-        # Open a random cover photo as binary data, encode it to base64.
-        list_of_cover_photos = ["1.jpeg", "2.jpeg"]
-        random_cover_photo = random.choice(list_of_cover_photos)
-
-        with open(random_cover_photo, 'rb') as imageFile:
-            binary_data = imageFile.read()
+    def filter_tracks(tracks, filter_track_ids):
+        # Return a filtered list of track ids that were not present in the filter_track_ids parameter, without
+        # duplicates, in the order of the tracks
+        return RecommendationFilter(seen_track_ids=filter_track_ids).filter_ids(tracks)
 
-            base64_encoded = base64.b64encode(binary_data)
+    @staticmethod
+    def exclude_top_artists(artists_to_delete, tracks):
+        # Return a filtered list of tracks which artist_id is not present in artists_to_delete parameter
+        return RecommendationFilter(excluded_artist_ids=artists_to_delete).filter(tracks, deduplicate=False)
 
-        return base64_encoded
+    def get_playlist_imagebase64(self):
+        # Return a random cover photo encoded to base64, or None if there is no usable cover photo. The photos are
+        # only read and encoded once, see CoverAssets.
+        return self.cover_assets.choose()
 
-    @staticmethod
-    def wait_for_playlist_cover_to_be_uploaded(playlist_id, base64encoded):
+    def wait_for_playlist_cover_to_be_uploaded(self, playlist_id, base64encoded):
         # Set start time to measure elapsed time
         start_time = time.time()
+        attempt = 0
 
         # Set max wait time to wait for image to be added to the created playlist
         timeout = 1000
@@ -327,7 +768,7 @@ class SpotifyPlaylist:
         # Continue looping until the playlist image is successfully added or the timeout is reached.
         while True:
             # Attempt to add the playlist cover image using the provided base64-encoded data.
-            success = spotify_api.add_cover_photo_to_playlist(playlist_id=playlist_id, imagebase64=base64encoded)
+            success = self.spotify_api.add_cover_photo_to_playlist(playlist_id=playlist_id, imagebase64=base64encoded)
 
             # Check if the image was added successfully
             if success:
@@ -339,9 +780,11 @@ class SpotifyPlaylist:
                 print("Timeout reached. Exiting loop.")
                 break
 
-            # If neither success nor timeout, continue waiting
+            # If neither success nor timeout, wait with a growing, jittered delay before the next attempt.
             else:
                 print("Waiting for playlist cover image to be uploaded...")
+                time.sleep(self.spotify_api.scheduler.backoff(attempt))
+                attempt += 1
 
     @staticmethod
     def validate_playlist_index(input_str, num):
@@ -353,12 +796,21 @@ class SpotifyPlaylist:
             return False
 
     @staticmethod
-    def validate_track_limit(input_str):
+    def validate_track_limit(input_str, maximum=500):
         # Validate the track limit that gets retrieved.
-        if input_str.isdigit() and 1 <= int(input_str) <= 500:
+        if input_str.isdigit() and 1 <= int(input_str) <= maximum:
             return True
         else:
-            print("Please enter a number between 1 and 500.")
+            print(f"Please enter a number between 1 and {maximum}.")
+            return False
+
+    @staticmethod
+    def validate_yes_no(input_str):
+        # Validate a 'Y' or 'N' answer.
+        if input_str in ("Y", "N"):
+            return True
+        else:
+            print("Please type 'Y' or 'N'.")
             return False
 
     @staticmethod
@@ -396,6 +848,70 @@ class SpotifyPlaylist:
             print("Error: Playlist name exceeds the maximum character limit. Please try again.")
             return False
 
+    @staticmethod
+    def parse_options(values):
+        # Return the generate_playlist options from a dictionary of strings, for example the query parameters of the
+        # server mode or a job of the batch mode. Raise ValueError if they are invalid.
+        # Playlist is the analyzed playlist's ID (the recently played tracks are analyzed without it), limit is 1-500,
+        # the audio features are 0-10 (5 by default), include_artists is 'Y' or 'N', name is max 150 characters long.
+        # The optional filters: explicit is 'Y' or 'N' (explicit tracks allowed or not), min_duration and max_duration
+        # are in seconds, max_per_artist is the maximum number of tracks from the same artist, with exclude_history 'Y'
+        # the tracks of the user's listening history are left out.
+        # With sample 'Y' the playlist is sampled, and limit is the maximum number of sampled tracks, up to 10000.
+        # With refresh (the ID of an earlier generated playlist) that playlist is refreshed instead of creating a new
+        # one.
+        sample = values.get("sample", "N")
+        if sample not in ("Y", "N"):
+            raise ValueError("sample must be 'Y' or 'N'")
+        maximum = SAMPLE_MAX_TRACKS if sample == "Y" else 500
+        track_limit = str(values.get("limit", "50"))
+        if not SpotifyPlaylist.validate_track_limit(track_limit, maximum):
+            raise ValueError(f"limit must be a number between 1 and {maximum}")
+
+        preferences = {}
+        for key in AUDIO_FEATURES:
+            preference = values.get(key, "5")
+            if not SpotifyPlaylist.validate_audio_pref(preference):
+                raise ValueError(f"{key} must be a number between 0 and 10")
+            preferences[key] = int(preference)
+
+        artist_inclusion = values.get("include_artists", "Y")
+        if artist_inclusion not in ("Y", "N"):
+            raise ValueError("include_artists must be 'Y' or 'N'")
+
+        playlist_name = values.get("name", "MelodyMystique")
+        if not SpotifyPlaylist.validate_playlist_name(playlist_name):
+            raise ValueError("name must be max 150 characters long")
+
+        filter_options = {}
+        explicit = values.get("explicit", "Y")
+        if explicit not in ("Y", "N"):
+            raise ValueError("explicit must be 'Y' or 'N'")
+        filter_options["allow_explicit"] = explicit == "Y"
+
+        exclude_history = values.get("exclude_history", "N")
+        if exclude_history not in ("Y", "N"):
+            raise ValueError("exclude_history must be 'Y' or 'N'")
+        if exclude_history == "Y":
+            filter_options["exclude_history"] = True
+
+        for key, option, multiplier in (("min_duration", "min_duration_ms", 1000),
+                                        ("max_duration", "max_duration_ms", 1000),
+                                        ("max_per_artist", "max_tracks_per_artist", 1)):
+            if key in values:
+                if not str(values[key]).isdigit():
+                    raise ValueError(f"{key} must be a whole number")
+                filter_options[option] = int(values[key]) * multiplier
+
+        return {"playlist_id": values.get("playlist") or None,
+                "track_limit": int(track_limit),
+                "preferences": preferences,
+                "artist_inclusion": artist_inclusion,
+                "playlist_name": playlist_name,
+                "filter_options": filter_options,
+                "sample": sample == "Y",
+                "target_playlist_id": values.get("refresh") or None}
+
     @staticmethod
     def adjust_mean(user_preference, original_mean):
         # Calculate the adjusted mean value for each audio preference, based on the given user input.
@@ -408,24 +924,13 @@ class SpotifyPlaylist:
         return round(adjusted_mean, 1)
 
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-auth = Auth()
-spotify_api = SpotifyAPI()
-spotify_playlist = SpotifyPlaylist(spotify_api)
-executor = ThreadPoolExecutor(1)
-
-print(
-    "\n\nWelcome to MelodyMystique - your Spotify personalized playlist generator!\n"
-    "After the Spotify authentication choose from your playlist list that you want\n"
-    "MelodyMystique to use to base it's analysis from, or choose the\n"
-    "'Use my recently played tracks' option If you like.\n"
-    "To authenticate, please visit: http://localhost:3000\nAfter that, please go back to the CLI.\n\n")
-
-
-def primary_func(response_code):
+def primary_func(auth, spotify_playlist, response_code):
+    spotify_api = spotify_playlist.spotify_api
     spotify_api.user_session = auth.get_spotify_session(response_code)
 
+    # Time the stages of the run that are not waiting for the user.
+    timer = RunTimer(spotify_api.metrics)
+
     playlists = spotify_api.get_playlists(30)
 
     print("Your playlists:")
@@ -447,23 +952,40 @@ def primary_func(response_code):
     # Set the selected playlist ID.
     selected_playlist_id = user_playlists_ids[playlist_num - 1]
 
-    # Get a user input about how many tracks they want to analyze (max 500), then validate it, then set it.
-    track_limit = int(spotify_playlist.get_user_input("Type in how many tracks would you like to analyze (max 500): ",
-                                                      lambda input_str: spotify_playlist.validate_track_limit(
-                                                          input_str)))
-
-    # Set the tracks.
-    tracks = spotify_api.get_tracks(track_limit, playlist_num, selected_playlist_id)
-
-    print("Retrieving your tracks, please wait...")
-
-    print(f"Successfully retrieved {len(tracks)} tracks.")
-
-    # Set the tracks' IDs from the tracks.
-    track_ids = [track['track']['id'] for track in tracks]
+    # Playlists over 500 tracks can be sampled instead of analyzing only their first tracks.
+    playlist_size = playlists['items'][playlist_num - 1]['tracks']['total'] if playlist_num != 0 else 0
+    sample = playlist_size > 500 and spotify_playlist.get_user_input(
+        f"This playlist has {playlist_size} tracks. Type 'Y' to analyze a random sample of the whole playlist, "
+        "or 'N' to analyze its first tracks. ", spotify_playlist.validate_yes_no) == "Y"
+
+    if sample:
+        print("Sampling your playlist, please wait...")
+        with timer.stage("sample_tracks"):
+            tracks = spotify_api.sample_playlist(selected_playlist_id)[0]
+        print(f"Successfully sampled {len(tracks)} of {playlist_size} tracks.")
+        track_ids = [track.id for track in tracks]
+        top_artists = spotify_playlist.get_user_top_artists(tracks)
+    else:
+        # Get a user input about how many tracks they want to analyze (max 500), then validate it, then set it.
+        track_limit = int(spotify_playlist.get_user_input(
+            "Type in how many tracks would you like to analyze (max 500): ",
+            lambda input_str: spotify_playlist.validate_track_limit(input_str)))
+
+        print("Retrieving your tracks, please wait...")
+
+        # Set the taste profile of the tracks: the mean audio features and the top artists. A stored profile is only
+        # updated with the tracks that changed since the last run.
+        with timer.stage("taste_profile"):
+            profile = spotify_api.get_taste_profile(track_limit, selected_playlist_id if playlist_num != 0 else None)
+
+        print(f"Successfully retrieved {profile.track_count} tracks.")
+
+        # Set the tracks' IDs and the top artists from the profile.
+        track_ids = profile.track_ids()
+        top_artists = profile.top_artists()
 
     # Set the audio features for each track to a dictionary.
-    features = spotify_api.get_track_audio_features(track_ids)
+    features = spotify_api.target_features
 
     # Explanations for the audio features.
     audio_explanations = {
@@ -502,20 +1024,21 @@ def primary_func(response_code):
         }
     }
 
-    # Replace all the audio features with the adjusted audio features.
-    for key, values in audio_explanations.items():
-        features[key] = spotify_playlist.adjust_mean(
-            int(spotify_playlist.get_user_preferences(key, values)), features[key])
+    # Get the user preferences, then replace all the audio features with the adjusted audio features.
+    preferences = {key: int(spotify_playlist.get_user_preferences(key, values))
+                   for key, values in audio_explanations.items()}
+    features.update(adjust_means(features, preferences))
 
-    # Set the top artist IDs.
-    top_artist_ids = [artistID[0] for artistID in spotify_playlist.get_user_top_artists(tracks)]
+    with timer.stage("top_artists"):
+        # Set the top artist IDs.
+        top_artist_ids = [artistID[0] for artistID in top_artists]
 
-    # Set the top artist names.
-    top_artists_names = [name["name"] for name in spotify_api.get_artist_info(top_artist_ids)["artists"]]
+        # Set the top artist names.
+        top_artists_names = [name["name"] for name in spotify_api.get_artist_info(top_artist_ids)["artists"]]
 
     # Print out the top artists for the user
     spotify_playlist.print_top_artists(playlist_num, top_artists_names,
-                                       spotify_playlist.get_user_top_artists(tracks),
+                                       top_artists,
                                        playlists['items'][playlist_num - 1]['name'])
 
     # Get a user input about the top artist inclusion, then validate it, then set it.
@@ -526,46 +1049,65 @@ def primary_func(response_code):
         "but its most likely that you will get tracks from artists that you never heard before. ",
         spotify_playlist.validate_artist_inclusion)
 
-    # Set the recommended tracks.
-    recommendations = spotify_playlist.recommended_tracks(top_artist_ids)
-
-    # Set the filtered tracks IDs.
-    final_track_ids = spotify_playlist.filter_recommendations(artist_inclusion, top_artist_ids, recommendations,
-                                                              track_ids)
+    # Set the recommended, filtered tracks IDs, closest to the adjusted audio features.
+    final_track_ids = spotify_playlist.generate_recommendations(track_ids, features, top_artist_ids, artist_inclusion,
+                                                                timer)
 
     # Get a user input about the playlist name, then validate it, then set it.
     playlist_name = spotify_playlist.get_user_input(
         "Type in (max 150 characters) what the name of your personalized playlist should be: ",
         spotify_playlist.validate_playlist_name)
 
-    # Set the created playlist.
-    melody_mystique_playlist = spotify_api.create_playlist(playlist_name)
-
-    # Set the created playlist ID.
-    generated_playlist_id = melody_mystique_playlist['id']
-
-    # Add tracks to the created playlist.
-    spotify_api.add_tracks_to_playlist(generated_playlist_id, final_track_ids)
-
-    # Set the cover image base64.
-    img_base64 = spotify_playlist.get_playlist_imagebase64()
-    spotify_playlist.wait_for_playlist_cover_to_be_uploaded(generated_playlist_id, img_base64)
+    # Create the playlist, add the tracks and the cover image to it.
+    spotify_playlist.publish_playlist(playlist_name, final_track_ids, timer)
 
     print("Check your Spotify playlists. MelodyMystique generated a personalized playlist for you!")
-
-
-@app.route('/')
-def login():
-    # Initiate the Spotify authentication
-    return redirect(auth.get_auth_url())
-
-
-@app.route('/callback')
-def callback():
-    # Run the primary_func in a separate thread and let the current function return its response
-    executor.submit(partial(primary_func, request.args["code"]))
-    return Response("You can close this window, please go back to the CLI.", mimetype="text/plain")
+    print(f"Time spent: {timer.report()}")
+
+
+def create_app():
+    # Create the Flask app of the CLI, with the objects of the user's run and its caches. Nothing of this happens when
+    # the module is only imported, for example by the tests, the server or the batch mode.
+    from flask import Flask, redirect, request, Response
+    from http_cache import ResponseCache
+
+    app = Flask(__name__)
+    app.secret_key = os.urandom(24)
+    auth = Auth(response_cache=ResponseCache())
+    spotify_api = SpotifyAPI(AudioFeaturesCache(), max_workers=4, history_store=HistoryStore(),
+                             profile_store=ProfileStore())
+    spotify_playlist = SpotifyPlaylist(spotify_api)
+    executor = ThreadPoolExecutor(1)
+
+    @app.route('/')
+    def login():
+        # Initiate the Spotify authentication
+        return redirect(auth.get_auth_url())
+
+    @app.route('/metrics')
+    def metrics():
+        # Serve the request latencies, call counts, bytes, retries and cache hits in the Prometheus text format
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/callback')
+    def callback():
+        # Run the primary_func in a separate thread and let the current function return its response
+        executor.submit(partial(primary_func, auth, spotify_playlist, request.args["code"]))
+        return Response("You can close this window, please go back to the CLI.", mimetype="text/plain")
+
+    return app
+
+
+def main():
+    app = create_app()
+    print(
+        "\n\nWelcome to MelodyMystique - your Spotify personalized playlist generator!\n"
+        "After the Spotify authentication choose from your playlist list that you want\n"
+        "MelodyMystique to use to base it's analysis from, or choose the\n"
+        "'Use my recently played tracks' option If you like.\n"
+        "To authenticate, please visit: http://localhost:3000\nAfter that, please go back to the CLI.\n\n")
+    app.run(host="localhost", port=3000)
 
 
 if __name__ == "__main__":
-    app.run(host="localhost", port=3000)
+    main()
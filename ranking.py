@@ -0,0 +1,43 @@
+import numpy as np
+from features import AUDIO_FEATURES
+
+
+class RecommendationRanker:
+    # Rank recommended tracks by how close their audio features are to the user's adjusted target features.
+    # The candidates' audio features are retrieved through SpotifyAPI, so the features cache is used, and the
+    # distances of all candidates are computed at once in a vectorized way.
+    def __init__(self, spotify_api, columns=AUDIO_FEATURES):
+        self.spotify_api = spotify_api
+        self.columns = columns
+
+    @staticmethod
+    def distances(matrix, target):
+        # Return the Euclidean distance of each row of the FeatureMatrix from the target features. Every audio feature
+        # is scaled by its standard deviation among the candidates, so tempo (in BPM) does not outweigh the rest.
+        columns = [key for key in matrix.columns if target.get(key) is not None]
+        indexes = [matrix.column_index[key] for key in columns]
+        values = matrix.values[:, indexes].astype(np.float64)
+        scale = values.std(axis=0) if len(values) > 1 else np.ones(len(columns))
+        scale[scale == 0] = 1
+        target_vector = np.array([target[key] for key in columns], dtype=np.float64)
+        return np.sqrt((((values - target_vector) / scale) ** 2).sum(axis=1))
+
+    def rank(self, track_ids, target, top_n=None, features=None):
+        # Return the track IDs ordered from the closest to the farthest from the target features, keeping at most top_n
+        # of them. Tracks without audio features are left out. The audio features are taken from the features
+        # FeatureMatrix if it is given, for example when several playlists are ranked from the same candidates.
+        if features is not None:
+            matrix = features.select(list(dict.fromkeys(track_ids)))
+        else:
+            matrix = self.spotify_api.get_feature_matrix(list(dict.fromkeys(track_ids)))
+        if len(matrix) == 0:
+            return []
+
+        distances = self.distances(matrix, target)
+        if top_n is not None and top_n < len(distances):
+            # Select the top_n closest in linear time, only those get sorted.
+            closest = np.argpartition(distances, top_n - 1)[:top_n]
+        else:
+            closest = np.arange(len(distances))
+        order = closest[np.argsort(distances[closest], kind="stable")]
+        return [matrix.track_ids[index] for index in order]
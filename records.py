@@ -0,0 +1,35 @@
+import sys
+
+# The fields of the playlist items that are used by the analysis, requested with the fields parameter, so Spotify
+# leaves out the albums, images and available markets of the tracks.
+PLAYLIST_ITEM_FIELDS = "items(track(id,artists(id))),total"
+
+
+class TrackRecord:
+    # The parts of a playlist or recently played item that are kept: the track ID and the IDs of its artists.
+    # The artist IDs are interned, so the many tracks of the same artist share one string.
+    __slots__ = ("id", "artist_ids")
+
+    def __init__(self, track_id, artist_ids=()):
+        self.id = track_id
+        self.artist_ids = tuple(artist_ids)
+
+    def __eq__(self, other):
+        return isinstance(other, TrackRecord) and (self.id, self.artist_ids) == (other.id, other.artist_ids)
+
+    def __repr__(self):
+        return f"TrackRecord({self.id!r}, {self.artist_ids!r})"
+
+    @classmethod
+    def from_item(cls, item):
+        # Return the record of a playlist or recently played item, or None if it has no track ID, like local files
+        # and tracks removed from Spotify.
+        track = item.get("track")
+        if not track or not track.get("id"):
+            return None
+        return cls(track["id"], (sys.intern(artist["id"]) for artist in track.get("artists") or () if artist.get("id")))
+
+
+def track_records(items):
+    # Return the records of the items, in their order, without the items that have no track ID.
+    return [record for record in map(TrackRecord.from_item, items) if record is not None]
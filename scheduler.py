@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+from metrics import REGISTRY
+
+
+class RequestScheduler:
+    # Every Spotify API request goes through the scheduler. It limits the request rate with a token bucket, caps the
+    # number of requests in flight, and retries rate limited (429) and server error responses. A 429 pauses all the
+    # requests for the Retry-After seconds, other retries wait with jittered exponential backoff.
+    # A request that is not idempotent (creating a playlist, adding tracks) is only retried after a 429: after a server
+    # error or a timeout the request may have been applied, and sending it again would duplicate the playlist or tracks.
+    def __init__(self, rate=20.0, burst=20, max_in_flight=4, max_retries=5, base_delay=0.5, max_delay=30.0,
+                 clock=time.monotonic, sleep=time.sleep, metrics=REGISTRY):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.metrics = metrics
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def backoff(self, attempt):
+        # Return a random delay between 0 and base_delay * 2^attempt seconds, capped at max_delay ("full jitter").
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(error):
+        # Return the Retry-After header of a 429 response in seconds, or None if it is missing or not a number.
+        try:
+            return float(error.headers.get("Retry-After"))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def is_retryable(error, idempotent=True):
+        # Rate limits, server errors and connection problems are worth retrying, other errors are not. Only rate limits
+        # are retried for the requests that are not idempotent.
+        import requests
+        from spotipy import SpotifyException
+        if isinstance(error, SpotifyException) and error.http_status == 429:
+            return True
+        if not idempotent:
+            return False
+        if isinstance(error, SpotifyException):
+            return error.http_status >= 500
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def acquire(self):
+        # Block until the scheduler is not paused and the token bucket has a token, then take the token.
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def pause(self, seconds):
+        # Hold back every request for the given seconds, for example after a 429 response.
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def call(self, func, *args, idempotent=True, **kwargs):
+        # Return func(*args, **kwargs), sent when the rate limit allows it and retried if it failed temporarily. Pass
+        # idempotent=False for the requests that must not be sent twice.
+        # Requests and spotipy are imported here, so importing the scheduler stays cheap.
+        import requests
+        from spotipy import SpotifyException
+        attempt = 0
+        while True:
+            self.acquire()
+            with self.in_flight:
+                try:
+                    with self.lock:
+                        self.requests += 1
+                    return func(*args, **kwargs)
+                except (SpotifyException, requests.exceptions.RequestException) as error:
+                    if attempt >= self.max_retries or not self.is_retryable(error, idempotent):
+                        raise
+                    throttled = isinstance(error, SpotifyException) and error.http_status == 429
+                    delay = self.retry_after(error) if throttled else None
+                    if delay is None:
+                        delay = self.backoff(attempt)
+                    with self.lock:
+                        self.retries += 1
+                        self.throttled += throttled
+                    if self.metrics is not None:
+                        self.metrics.increment("spotify_retries_total")
+                        self.metrics.increment("spotify_throttled_total", throttled)
+
+            # The wait happens outside the in-flight slot, so other requests are not held up by it. A 429 holds back
+            # every request, since the rate limit applies to the whole app.
+            if throttled:
+                self.pause(delay)
+            else:
+                self.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        # Return the request, retry and 429 counters.
+        with self.lock:
+            return {"requests": self.requests, "retries": self.retries, "throttled": self.throttled}
@@ -0,0 +1,197 @@
+import argparse
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import Flask, Response, jsonify, redirect, request
+from cache import AudioFeaturesCache
+from coalescing import RequestCoalescer
+from covers import when_done
+from history import HistoryStore
+from http_cache import ResponseCache
+from job_queue import JobQueue
+from profiles import ProfileStore
+from tokens import TokenStore
+from metrics import REGISTRY
+from project import Auth, SpotifyAPI, SpotifyPlaylist
+from scheduler import RequestScheduler
+
+
+class UserSession:
+    # Everything that belongs to one user of the server mode: their generation options, their token,
+    # SpotifyAPI and SpotifyPlaylist objects. Nothing is shared between users, except the audio features cache, the
+    # listening history and taste profile stores, which are keyed by user ID, the token store, which is keyed by
+    # session ID, the HTTP response cache, which always revalidates the private responses, the request coalescer,
+    # which only handles the requests that are the same for every user, and the RequestScheduler, since the rate
+    # limit of Spotify is the same for every user of the app.
+    def __init__(self, options, features_cache=None, max_workers=1, history_store=None, response_cache=None,
+                 profile_store=None, token_store=None, coalescer=None, scheduler=None):
+        self.session_id = uuid.uuid4().hex
+        self.created = time.monotonic()
+        self.options = options
+        self.token_store = token_store if token_store is not None else TokenStore()
+        self.auth = Auth(response_cache=response_cache, token_store=self.token_store, user_key=self.session_id)
+        self.spotify_api = SpotifyAPI(features_cache, max_workers=max_workers, history_store=history_store,
+                                      profile_store=profile_store, coalescer=coalescer, scheduler=scheduler)
+        self.spotify_playlist = SpotifyPlaylist(self.spotify_api)
+
+    def run(self, code):
+        # Authorize with the code received by the callback, then generate the playlist with the session's options.
+        # The token is forgotten once the playlist is generated and its cover is uploaded in the background.
+        try:
+            user_session = self.auth.get_spotify_session(code)
+            if isinstance(user_session, str):
+                raise RuntimeError(user_session)
+            self.spotify_api.user_session = user_session
+            return self.spotify_playlist.generate_playlist(**self.options)
+        finally:
+            when_done(self.spotify_playlist.cover_uploads, partial(self.token_store.discard, self.session_id))
+
+
+class JobManager:
+    # Run jobs in a worker pool of max_workers threads and keep track of their status. The status of a finished job
+    # is kept for job_ttl seconds, then forgotten, so a long running server does not keep every result.
+    def __init__(self, max_workers=4, job_ttl=3600, clock=time.time):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.job_ttl = job_ttl
+        self.clock = clock
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def expire_jobs(self):
+        # Forget the jobs that finished more than job_ttl seconds ago.
+        deadline = self.clock() - self.job_ttl
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items() if "finished" in job and job["finished"] <= deadline]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def submit(self, func, *args):
+        # Queue func(*args) and return the job ID, its status can be checked with status(job_id).
+        self.expire_jobs()
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {"id": job_id, "status": "queued", "submitted": self.clock()}
+        self.executor.submit(self.run, job_id, func, *args)
+        return job_id
+
+    def update(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+
+    def run(self, job_id, func, *args):
+        self.update(job_id, status="running", started=self.clock())
+        try:
+            result = func(*args)
+        except Exception as error:
+            self.update(job_id, status="failed", error=str(error), finished=self.clock())
+        else:
+            self.update(job_id, status="done", result=result, finished=self.clock())
+
+    def status(self, job_id):
+        # Return a copy of the job's status, or None if there is no job with the given ID (or it expired).
+        self.expire_jobs()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+def create_server_app(max_workers=4, features_cache=None, api_workers=1, history_store=None, response_cache=None,
+                      profile_store=None, token_store=None, coalescer=None, job_queue=None, scheduler=None,
+                      session_ttl=600, job_ttl=3600):
+    # Create the Flask app of the server mode. Every user starts at /generate with their options in the query string,
+    # authenticates with Spotify, then their playlist is generated by the worker pool. /jobs/<job_id> returns the
+    # status of the generation, /metrics the metrics of every user's requests.
+    # The tokens of every user are kept in memory only, in one TokenStore, no token files are written, except in
+    # queue mode: the access token of a queued job (not its refresh token) is stored in the job queue database until
+    # the job is done or failed, so the worker processes can use it.
+    # The concurrent jobs share one RequestCoalescer, so they send the identical requests once, and one
+    # RequestScheduler, so a 429 answer pauses the requests of every user, like the app's rate limit.
+    # With a job_queue (JobQueue) the playlists are not generated by this process: the callback only exchanges the
+    # code for the user's token and queues the job, the worker processes of worker.py generate them.
+    # The sessions of the users who do not come back from the Spotify authentication within session_ttl seconds are
+    # forgotten, with their token. The status of a finished job is kept for job_ttl seconds (without a job_queue).
+    app = Flask(__name__)
+    app.config["SESSIONS"] = {}
+    app.config["JOBS"] = job_queue if job_queue is not None else JobManager(max_workers, job_ttl)
+    features_cache = features_cache if features_cache is not None else AudioFeaturesCache()
+    history_store = history_store if history_store is not None else HistoryStore()
+    response_cache = response_cache if response_cache is not None else ResponseCache()
+    profile_store = profile_store if profile_store is not None else ProfileStore()
+    token_store = token_store if token_store is not None else TokenStore()
+    coalescer = coalescer if coalescer is not None else RequestCoalescer()
+    scheduler = scheduler if scheduler is not None else RequestScheduler(max_in_flight=max_workers * api_workers)
+    sessions_lock = threading.Lock()
+
+    def expire_sessions():
+        deadline = time.monotonic() - session_ttl
+        with sessions_lock:
+            expired = [session_id for session_id, user_session in app.config["SESSIONS"].items()
+                       if user_session.created <= deadline]
+            for session_id in expired:
+                del app.config["SESSIONS"][session_id]
+        for session_id in expired:
+            token_store.discard(session_id)
+
+    @app.route('/generate')
+    def generate():
+        # Create the user's session, then send them to the Spotify authentication with the session ID as state.
+        expire_sessions()
+        try:
+            options = SpotifyPlaylist.parse_options(request.args)
+        except ValueError as error:
+            return jsonify({"error": str(error)}), 400
+
+        user_session = UserSession(options, features_cache, api_workers, history_store, response_cache,
+                                   profile_store, token_store, coalescer, scheduler)
+        with sessions_lock:
+            app.config["SESSIONS"][user_session.session_id] = user_session
+        return redirect(user_session.auth.get_auth_url(state=user_session.session_id))
+
+    @app.route('/callback')
+    def callback():
+        # Find the user's session by the state, then queue the generation of their playlist.
+        expire_sessions()
+        with sessions_lock:
+            user_session = app.config["SESSIONS"].pop(request.args.get("state"), None)
+        if user_session is None or "code" not in request.args:
+            return jsonify({"error": "unknown or expired session"}), 400
+
+        if job_queue is None:
+            job_id = app.config["JOBS"].submit(user_session.run, request.args["code"])
+        else:
+            try:
+                token_info = user_session.auth.get_token_info(request.args["code"])
+            finally:
+                token_store.discard(user_session.session_id)
+            if token_info is None:
+                return jsonify({"error": "the Spotify authentication failed"}), 400
+            # The refresh token never leaves this process, the job has to start before the access token expires.
+            access_token_info = {key: value for key, value in token_info.items() if key != "refresh_token"}
+            job_id = job_queue.submit({"options": user_session.options, "token_info": access_token_info})
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+    @app.route('/jobs/<job_id>')
+    def job_status(job_id):
+        job = app.config["JOBS"].status(job_id)
+        if job is None:
+            return jsonify({"error": "unknown job"}), 404
+        return jsonify(job)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run MelodyMystique in multi-user server mode.")
+    parser.add_argument("--workers", type=int, default=4, help="number of playlists generated at the same time")
+    parser.add_argument("--api-workers", type=int, default=1, help="parallel Spotify requests per generation")
+    parser.add_argument("--queue", help="queue the jobs in this database for the processes of worker.py")
+    arguments = parser.parse_args()
+    create_server_app(arguments.workers, api_workers=arguments.api_workers,
+                      job_queue=JobQueue(arguments.queue) if arguments.queue else None).run(host="localhost",
+                                                                                            port=3000, threaded=True)
@@ -1,5 +1,82 @@
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 import pytest
-from project import SpotifyPlaylist, SpotifyAPI
+import requests
+from spotipy import SpotifyException
+from async_client import AsyncSpotifyClient, create_connection_pool
+from batch import BatchRunner, read_job_specs
+from benchmark import main as benchmark_main, run_benchmark, run_suite
+from cache import AudioFeaturesCache
+from coalescing import RequestCoalescer
+from covers import COVER_PATHS, COVER_UPLOADER, CoverAssets, CoverUploader, encode_cover, when_done
+from metrics import MetricsRegistry, RunTimer
+from profiles import ProfileStore, TasteProfile
+from filters import RecommendationFilter
+from history import HistoryStore, format_played_at, played_at_ms
+from http_cache import ConditionalCacheAdapter, ResponseCache
+from job_queue import JobQueue, PermanentJobError, QueueWorker
+from features import FeatureAggregator, FeatureMatrix, RunningStatistics, SampleEstimate, adjust_means
+from project import Auth, SpotifyPlaylist, SpotifyAPI
+from pipeline import buffered, chunks, unique
+from ranking import RecommendationRanker
+from records import PLAYLIST_ITEM_FIELDS, TrackRecord, track_records
+from scheduler import RequestScheduler
+from server import JobManager, UserSession, create_server_app
+from tokens import TokenStore
+from worker import GenerationWorker
+
+
+class FakeSession:
+    # Stand-in for spotipy.Spotify that records the calls made to it.
+    def __init__(self, playlist_size=0, energies=None):
+        self.audio_features_calls = []
+        self.playlist_size = playlist_size
+        self.energies = energies or {}
+
+    def audio_features(self, tracks):
+        self.audio_features_calls.append(list(tracks))
+        return [{"id": track_id, "acousticness": 0.5, "danceability": 0.5, "energy": self.energies.get(track_id, 0.5),
+                 "instrumentalness": 0.5, "liveness": 0.5, "speechiness": 0.5, "tempo": 120.0, "valence": 0.5}
+                for track_id in tracks]
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        items = [{"track": {"id": str(i), "artists": [{"id": f"artist{i % 7}"}]}}
+                 for i in range(offset, min(offset + limit, self.playlist_size))]
+        return {"items": items, "total": self.playlist_size}
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        return self.playlist_items("recent", limit=limit)
+
+    def recommendations(self, seed_artists, limit, **targets):
+        return {"tracks": [{"id": f"{artist}-{i}", "artists": [{"id": artist}]} for artist in seed_artists
+                           for i in range(limit // len(seed_artists))]}
+
+    def current_user(self):
+        return {"id": "user"}
+
+    def playlist(self, playlist_id, fields=None):
+        return {"snapshot_id": f"snapshot-{self.playlist_size}"}
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=''):
+        self.created_playlist = {"id": "generated", "name": name, "items": []}
+        return self.created_playlist
+
+    def playlist_add_items(self, playlist_id, items):
+        self.created_playlist["items"] += items
+
+    def playlist_upload_cover_image(self, playlist_id, image_b64):
+        self.created_playlist["cover"] = image_b64
 
 
 @pytest.fixture
@@ -83,5 +160,1275 @@ def test_adjust_mean_reach_max(spotify_playlist_instance):
     assert adjusted_mean == 1
 
 
+def test_audio_features_cache_skips_cached_tracks(tmp_path):
+    features_cache = AudioFeaturesCache(str(tmp_path / "features.sqlite"))
+    api = SpotifyAPI(features_cache)
+    api.user_session = FakeSession()
+    track_ids = [str(i) for i in range(250)]
+
+    first = api.get_audio_features(track_ids)
+    assert [track["id"] for track in first] == track_ids
+    assert len(api.user_session.audio_features_calls) == 3
+
+    api.user_session = FakeSession()
+    second = api.get_audio_features(track_ids + ["new"])
+    assert second[:250] == first
+    assert second[250]["id"] == "new"
+    assert api.user_session.audio_features_calls == [["new"]]
+    assert features_cache.stats()["hits"] == 250
+
+
+def test_audio_features_cache_evicts_least_recently_used(tmp_path):
+    features_cache = AudioFeaturesCache(str(tmp_path / "features.sqlite"), max_entries=2)
+    features_cache.put_many([{"id": "1"}])
+    features_cache.put_many([{"id": "2"}])
+    features_cache.get_many(["1"])
+    features_cache.put_many([{"id": "3"}])
+    assert len(features_cache) == 2
+    assert set(features_cache.get_many(["1", "2", "3"])) == {"1", "3"}
+
+
+@pytest.mark.parametrize("limit", [1, 50, 120, 500])
+def test_concurrent_fetching_matches_sequential(limit):
+    sequential_api = SpotifyAPI()
+    sequential_api.user_session = FakeSession(playlist_size=230)
+    concurrent_api = SpotifyAPI(max_workers=4)
+    concurrent_api.user_session = FakeSession(playlist_size=230)
+
+    tracks = concurrent_api.get_recently_or_playlist(limit, False, "playlist")
+    assert tracks == sequential_api.get_recently_or_playlist(limit, False, "playlist")
+
+    track_ids = [track.id for track in tracks]
+    assert concurrent_api.get_audio_features(track_ids) == sequential_api.get_audio_features(track_ids)
+
+    seed_artists = [f"artist{i}" for i in range(12)]
+    assert (SpotifyPlaylist(concurrent_api).recommended_tracks(seed_artists) ==
+            SpotifyPlaylist(sequential_api).recommended_tracks(seed_artists))
+
+
+def test_running_statistics_match_statistics_module():
+    values = [0.1, 0.75, 0.3, 0.9, 0.42, 0.05]
+    running_statistics = RunningStatistics()
+    for value in values:
+        running_statistics.add(value)
+    assert running_statistics.mean == pytest.approx(statistics.mean(values))
+    assert running_statistics.variance == pytest.approx(statistics.variance(values))
+    assert (running_statistics.minimum, running_statistics.maximum) == (0.05, 0.9)
+
+    first, second = RunningStatistics(), RunningStatistics()
+    for value in values[:2]:
+        first.add(value)
+    for value in values[2:]:
+        second.add(value)
+    first.merge(second)
+    assert first.mean == pytest.approx(running_statistics.mean)
+    assert first.variance == pytest.approx(running_statistics.variance)
+
+
+def test_feature_aggregator_bounds_stay_inside_seen_values():
+    aggregator = FeatureAggregator(keys=("energy",))
+    aggregator.add_batch([{"energy": 0.2}, {"energy": 0.4}])
+    aggregator.add_batch([{"energy": 0.6}])
+    assert aggregator.count == 3
+    assert aggregator.means() == {"energy": pytest.approx(0.4)}
+    assert aggregator.bounds(spread=1.0) == {"min_energy": pytest.approx(0.2), "max_energy": pytest.approx(0.6)}
+    assert aggregator.bounds(spread=0.5) == {"min_energy": pytest.approx(0.3), "max_energy": pytest.approx(0.5)}
+
+
+def test_track_audio_features_can_be_analyzed_again():
+    api = SpotifyAPI()
+    api.user_session = FakeSession()
+    first = api.get_track_audio_features(["1", "2", "3"])
+    first["energy"] = 0.9
+    second = api.get_track_audio_features(["4", "5"])
+    assert second is not first
+    assert second["energy"] == 0.5
+    assert api.target_features is second
+
+
+def test_feature_matrix_statistics():
+    tracks = [{"id": str(i), "energy": energy, "tempo": tempo}
+              for i, (energy, tempo) in enumerate([(0.2, 100), (0.4, 110), (0.6, 120), (0.8, 130), (0.5, 400)])]
+    matrix = FeatureMatrix.from_audio_features(tracks + [None], columns=("energy", "tempo"))
+    assert len(matrix) == 5
+    assert matrix.means() == {"energy": pytest.approx(0.5), "tempo": pytest.approx(172)}
+    assert matrix.column("tempo").tolist() == [100, 110, 120, 130, 400]
+    assert matrix.select(["3", "missing", "1"]).column("energy").tolist() == pytest.approx([0.8, 0.4])
+
+
+def test_adjust_means_matches_adjust_mean(spotify_playlist_instance):
+    means = {"acousticness": 0.6, "energy": 0.2, "tempo": 110, "valence": 0.8}
+    preferences = {"acousticness": 8, "energy": 1, "tempo": 6, "valence": 9}
+    assert adjust_means(means, preferences) == {
+        key: spotify_playlist_instance.adjust_mean(preferences[key], means[key]) for key in means}
+
+
+def test_ranker_keeps_closest_tracks(tmp_path):
+    api = SpotifyAPI(AudioFeaturesCache(str(tmp_path / "features.sqlite")))
+    api.user_session = FakeSession(energies={"a": 0.1, "b": 0.85, "c": 0.5, "d": 0.97, "e": 0.7})
+    target = {"energy": 0.9, "tempo": 120.0}
+    ranker = RecommendationRanker(api)
+
+    assert ranker.rank(["a", "b", "c", "d", "e", "b"], target) == ["b", "d", "e", "c", "a"]
+    assert ranker.rank(["a", "b", "c", "d", "e"], target, top_n=2) == ["b", "d"]
+    assert len(api.user_session.audio_features_calls) == 1
+
+
+class FakeClock:
+    # Clock for the RequestScheduler tests, sleeping only moves the time forward.
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def failing(errors, result="ok"):
+    # Return a function that raises the given errors one after the other, then returns result.
+    errors = list(errors)
+
+    def call():
+        if errors:
+            raise errors.pop(0)
+        return result
+    return call
+
+
+def test_scheduler_honours_retry_after():
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock, sleep=clock.sleep)
+    rate_limited = SpotifyException(429, -1, "Too many requests", headers={"Retry-After": "7"})
+    assert scheduler.call(failing([rate_limited, rate_limited])) == "ok"
+    assert clock.now == 14
+    assert scheduler.stats() == {"requests": 3, "retries": 2, "throttled": 2}
+
+
+def test_scheduler_backs_off_on_server_errors_only():
+    clock = FakeClock()
+    scheduler = RequestScheduler(max_retries=2, base_delay=1, clock=clock, sleep=clock.sleep)
+    server_error = SpotifyException(502, -1, "Bad gateway")
+    with pytest.raises(SpotifyException):
+        scheduler.call(failing([server_error] * 3))
+    assert len(clock.sleeps) == 2
+    assert 0 <= clock.sleeps[0] <= 1 and 0 <= clock.sleeps[1] <= 2
+
+    with pytest.raises(SpotifyException):
+        scheduler.call(failing([SpotifyException(404, -1, "Not found")]))
+    assert len(clock.sleeps) == 2
+
+
+def test_scheduler_retries_non_idempotent_requests_only_after_429():
+    clock = FakeClock()
+    scheduler = RequestScheduler(base_delay=1, clock=clock, sleep=clock.sleep)
+    rate_limited = SpotifyException(429, -1, "Too many requests", headers={"Retry-After": "1"})
+    assert scheduler.call(failing([rate_limited]), idempotent=False) == "ok"
+    for error in (SpotifyException(500, -1, "Server error"), requests.exceptions.ReadTimeout()):
+        with pytest.raises(type(error)):
+            scheduler.call(failing([error]), idempotent=False)
+    assert scheduler.stats() == {"requests": 4, "retries": 1, "throttled": 1}
+
+    # The tracks are added once, even if the server applied the request that failed.
+    api = SpotifyAPI(scheduler=scheduler)
+    api.user_session = FailingWriteSession(0)
+    with pytest.raises(SpotifyException):
+        api.add_tracks_to_playlist("existing", ["1", "2"])
+    assert api.user_session.writes == [("failed", 2)]
+
+
+def test_scheduler_token_bucket_limits_rate():
+    clock = FakeClock()
+    scheduler = RequestScheduler(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+    for _ in range(6):
+        scheduler.call(failing([]))
+    assert clock.now == pytest.approx(2)
+
+
+def wait_for_job(jobs, job_id):
+    for _ in range(200):
+        job = jobs.status(job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    return jobs.status(job_id)
+
+
+class FakeCacheHandler:
+    def __init__(self, token_info=None):
+        self.token_info = token_info
+        self.reads = 0
+        self.saved = []
+
+    def get_cached_token(self):
+        self.reads += 1
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.saved.append(token_info)
+
+
+def token_info(name, expires_at):
+    return {"access_token": name, "refresh_token": f"refresh-{name}", "expires_at": expires_at}
+
+
+def test_token_store_reads_the_backing_once():
+    backing = FakeCacheHandler(token_info("stored", 1000))
+    store = TokenStore(backing=lambda key: backing, clock=lambda: 0)
+    manager = store.token_manager("user")
+    assert [manager.get_access_token() for _ in range(5)] == ["stored"] * 5
+    assert backing.reads == 1
+
+    store.cache_handler("user").save_token_to_cache(token_info("new", 2000))
+    assert manager.get_access_token() == "new"
+    assert backing.saved == [token_info("new", 2000)]
+    assert TokenStore().token_manager("unknown").get_access_token() is None
+
+    # Like SpotifyOAuth.refresh_access_token, the refresh function saves the new token through the cache handler.
+    def refresh(refresh_token):
+        new_token_info = token_info("refreshed", 3000)
+        store.cache_handler("user").save_token_to_cache(new_token_info)
+        return new_token_info
+
+    store.register("user", refresh)
+    assert store.refresh("user") == token_info("refreshed", 3000)
+    assert backing.saved == [token_info("new", 2000), token_info("refreshed", 3000)]
+    store.stop()
+
+
+def test_token_store_refreshes_before_expiry():
+    now = [0]
+    refreshed = []
+
+    def refresh(refresh_token):
+        refreshed.append(refresh_token)
+        return token_info(f"token-{len(refreshed)}", now[0] + 3600)
+
+    store = TokenStore(refresh_margin=300, check_interval=3600, clock=lambda: now[0])
+    store.put("user", token_info("token-0", 3600))
+    store.put("other", token_info("other", 100000))
+    store.register("user", refresh)
+    store.register("other", refresh)
+    assert store.refresh_due() == []
+
+    now[0] = 3400
+    assert store.refresh_due() == ["user"]
+    assert refreshed == ["refresh-token-0"]
+    assert store.token_manager("user").get_access_token() == "token-1"
+    assert store.refresh_due() == []
+
+    store.register("user", lambda refresh_token: 1 / 0)
+    now[0] = 7000
+    assert store.refresh_due() == []
+    assert store.token_manager("user").get_access_token() == "token-1"
+    store.discard("user")
+    assert store.get("user") is None
+    store.stop()
+
+
+def test_token_manager_refreshes_an_expired_token():
+    now = [5000]
+    store = TokenStore(check_interval=3600, clock=lambda: now[0])
+    store.put("user", token_info("expired", 4000))
+    store.register("user", lambda refresh_token: token_info("fresh", 9000))
+    assert store.token_manager("user").get_access_token() == "fresh"
+    assert store.token_manager("user").get_access_token(as_dict=True)["expires_at"] == 9000
+    store.stop()
+
+
+class BlockingSession(FakeSession):
+    # Audio features and recommendations that wait for release, so the concurrent requests overlap.
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.recommendations_calls = []
+
+    def audio_features(self, tracks):
+        result = super().audio_features(tracks)
+        self.release.wait(5)
+        return result
+
+    def recommendations(self, seed_artists, limit, **targets):
+        self.recommendations_calls.append(tuple(seed_artists))
+        self.release.wait(5)
+        return super().recommendations(seed_artists, limit, **targets)
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    registry = MetricsRegistry()
+    coalescer = RequestCoalescer(registry)
+    session = BlockingSession()
+    apis = [SpotifyAPI(metrics=registry, coalescer=coalescer) for _ in range(4)]
+    for api in apis:
+        api.user_session = session
+        api.target_features = {feature: 0.5 for feature in api.target_features}
+    results = {}
+
+    def run(name, func, *args):
+        thread = threading.Thread(target=lambda: results.__setitem__(name, func(*args)))
+        thread.start()
+        return thread
+
+    threads = [run("first", apis[0].get_audio_features, [str(i) for i in range(100)])]
+    wait_until(lambda: len(session.audio_features_calls) == 1)
+    threads.append(run("overlapping", apis[1].get_audio_features, [str(i) for i in range(50, 150)]))
+    wait_until(lambda: len(session.audio_features_calls) == 2)
+    threads.append(run("recommendations", apis[2].get_recommended_tracks, ["a", "b"]))
+    wait_until(lambda: len(session.recommendations_calls) == 1)
+    threads.append(run("same recommendations", apis[3].get_recommended_tracks, ["a", "b"]))
+    wait_until(lambda: registry.value("spotify_coalesced_total", method="recommendations") == 1)
+    session.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert session.audio_features_calls[1] == [str(i) for i in range(100, 150)]
+    assert registry.value("spotify_coalesced_total", method="audio_features") == 50
+    assert [track["id"] for track in results["overlapping"]] == [str(i) for i in range(50, 150)]
+    assert len(results["first"]) == 100
+    assert session.recommendations_calls == [("a", "b")]
+    assert results["recommendations"] is results["same recommendations"]
+    assert not coalescer.calls and not coalescer.items
+
+
+class RevokedSession(FakeSession):
+    # A user whose token was revoked: the artists and recommendations requests wait for release, then fail with 401.
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def artists(self, artists):
+        self.release.wait(5)
+        raise SpotifyException(401, -1, "The access token expired")
+
+    def recommendations(self, seed_artists, limit, **targets):
+        self.release.wait(5)
+        raise SpotifyException(401, -1, "The access token expired")
+
+
+class ArtistsSession(FakeSession):
+    def artists(self, artists):
+        return {"artists": [{"id": artist_id} for artist_id in artists]}
+
+
+def test_coalescer_does_not_share_errors_between_users():
+    registry = MetricsRegistry()
+    coalescer = RequestCoalescer(registry)
+    revoked = RevokedSession()
+    apis = [SpotifyAPI(metrics=registry, coalescer=coalescer) for _ in range(2)]
+    apis[0].user_session, apis[1].user_session = revoked, ArtistsSession()
+    errors, results = [], {}
+
+    def run(name, func, *args):
+        def target():
+            try:
+                results[name] = func(*args)
+            except SpotifyException as error:
+                errors.append(error.http_status)
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    threads = [run("revoked artists", apis[0].get_artist_info, ["x"]),
+               run("revoked recommendations", apis[0].get_recommended_tracks, ["a"], 10, None, {})]
+    wait_until(lambda: coalescer.items and coalescer.calls)
+    threads += [run("artists", apis[1].get_artist_info, ["x", "y"]),
+                run("recommendations", apis[1].get_recommended_tracks, ["a"], 10, None, {})]
+    wait_until(lambda: registry.value("spotify_coalesced_total", method="artists") == 1 and
+               registry.value("spotify_coalesced_total", method="recommendations") == 1)
+    revoked.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == [401, 401]
+    assert results["artists"] == {"artists": [{"id": "x"}, {"id": "y"}]}
+    assert len(results["recommendations"]["tracks"]) == 10
+    assert not coalescer.calls and not coalescer.items
+
+
+def test_coalescer_raises_errors_and_forgets_them():
+    coalescer = RequestCoalescer(metrics=None)
+    with pytest.raises(ZeroDivisionError):
+        coalescer.call_many("artists", ["a"], lambda ids: 1 / 0)
+    assert coalescer.call_many("artists", ["a", "a"], lambda ids: [f"artist {item_id}" for item_id in ids]) == \
+        {"a": "artist a"}
+    assert not coalescer.items
+
+
+def test_job_queue_leases_retries_and_expires(tmp_path):
+    now = [1000.0]
+    path = str(tmp_path / "jobs.sqlite")
+    jobs = JobQueue(path, visibility_timeout=60, max_attempts=2, retry_delay=10, clock=lambda: now[0])
+    other_process = JobQueue(path, visibility_timeout=60, max_attempts=2, retry_delay=10, clock=lambda: now[0])
+    first, second = jobs.submit({"n": 1}), jobs.submit({"n": 2})
+
+    job = jobs.lease("worker-a")
+    assert job == {"id": first, "payload": {"n": 1}, "attempt": 1}
+    assert other_process.lease("worker-b")["id"] == second
+    assert other_process.lease("worker-b") is None
+    assert jobs.complete(first, "worker-a", {"playlist_id": "p1"})
+    assert other_process.status(first)["result"] == {"playlist_id": "p1"}
+
+    # The lease of worker-b expires, worker-a takes the job over and worker-b can no longer complete it.
+    now[0] += 61
+    assert jobs.lease("worker-a") == {"id": second, "payload": {"n": 2}, "attempt": 2}
+    assert not other_process.complete(second, "worker-b", {})
+    assert jobs.fail(second, "worker-a", "timeout")
+    assert jobs.status(second)["status"] == "failed" and jobs.status(second)["error"] == "timeout"
+
+    third = jobs.submit({"n": 3})
+    jobs.lease("worker-a")
+    assert jobs.fail(third, "worker-a", "server error")
+    assert jobs.status(third)["status"] == "queued" and jobs.lease("worker-a") is None
+    now[0] += 10
+    assert jobs.lease("worker-a")["attempt"] == 2
+    now[0] += 61
+    assert jobs.lease("worker-b") is None
+    assert jobs.status(third)["error"] == "lease expired"
+    assert jobs.counts() == {"done": 1, "failed": 2}
+    assert jobs.connection.execute("SELECT COUNT(*) FROM jobs WHERE payload IS NOT NULL").fetchone()[0] == 0
+    assert jobs.status("missing") is None
+
+
+def square_job(payload, progress):
+    return {"square": payload["n"] ** 2, "pid": os.getpid()}
+
+
+def drain_queue(path):
+    QueueWorker(JobQueue(path), square_job, poll_interval=0.01).run(until_empty=True)
+
+
+def test_worker_processes_share_the_queue(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    jobs = JobQueue(path)
+    job_ids = [jobs.submit({"n": n}) for n in range(12)]
+    processes = [multiprocessing.Process(target=drain_queue, args=(path,)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+
+    results = [jobs.status(job_id) for job_id in job_ids]
+    assert [job["result"]["square"] for job in results] == [n ** 2 for n in range(12)]
+    assert all(job["attempts"] == 1 for job in results)
+    assert {job["result"]["pid"] for job in results} <= {process.pid for process in processes}
+
+
+def test_server_mode_expires_abandoned_sessions(tmp_path):
+    token_store = TokenStore()
+    app = create_server_app(features_cache=AudioFeaturesCache(str(tmp_path / "features.sqlite")),
+                            history_store=HistoryStore(str(tmp_path / "history.sqlite")),
+                            response_cache=ResponseCache(str(tmp_path / "http_cache.sqlite")),
+                            profile_store=ProfileStore(str(tmp_path / "profiles.sqlite")), token_store=token_store,
+                            session_ttl=0)
+    client = app.test_client()
+    client.get("/generate?limit=20")
+    abandoned = list(app.config["SESSIONS"])[0]
+    assert abandoned in token_store.refreshers
+    client.get("/generate?limit=30")
+    assert abandoned not in app.config["SESSIONS"] and abandoned not in token_store.refreshers
+    assert len(app.config["SESSIONS"]) == len(token_store.refreshers) == 1
+    assert client.get(f"/callback?code=secret&state={abandoned}").status_code == 400
+    assert not app.config["SESSIONS"] and not token_store.refreshers
+    token_store.stop()
+
+
+def test_server_queues_jobs_for_worker_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(Auth, "get_token_info", lambda self, code: token_info(code, 4000000000))
+    monkeypatch.setattr(Auth, "create_user_session", lambda self: FakeSession(playlist_size=120))
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    app = create_server_app(features_cache=AudioFeaturesCache(str(tmp_path / "features.sqlite")),
+                            history_store=HistoryStore(str(tmp_path / "history.sqlite")),
+                            response_cache=ResponseCache(str(tmp_path / "http_cache.sqlite")),
+                            profile_store=ProfileStore(str(tmp_path / "profiles.sqlite")), job_queue=job_queue)
+    client = app.test_client()
+    client.get("/generate?playlist=abc&limit=80&name=Queued")
+    session_id = list(app.config["SESSIONS"])[0]
+    status_url = client.get(f"/callback?code=secret&state={session_id}").get_json()["status_url"]
+    assert client.get(status_url).get_json()["status"] == "queued"
+    stored = job_queue.connection.execute("SELECT payload FROM jobs").fetchone()[0]
+    assert "access_token" in stored and "refresh_token" not in stored
+    assert job_queue.connection.execute("PRAGMA secure_delete").fetchone()[0] == 1
+
+    generation_worker = GenerationWorker(features_cache=AudioFeaturesCache(str(tmp_path / "features.sqlite")),
+                                         history_store=HistoryStore(str(tmp_path / "history.sqlite")),
+                                         response_cache=ResponseCache(str(tmp_path / "http_cache.sqlite")),
+                                         profile_store=ProfileStore(str(tmp_path / "profiles.sqlite")))
+    assert QueueWorker(job_queue, generation_worker).run_once()
+    job = client.get(status_url).get_json()
+    assert job["status"] == "done", job
+    assert job["result"]["analyzed_tracks"] == 80 and job["result"]["added_tracks"] == 100
+    assert generation_worker.scheduler.stats()["requests"] > 0
+    with pytest.raises(PermanentJobError):
+        generation_worker({"options": {}, "token_info": token_info("expired", time.time() - 1)})
+
+
+def test_job_manager_reports_status():
+    jobs = JobManager(max_workers=2)
+    assert wait_for_job(jobs, jobs.submit(lambda value: value * 2, 21))["result"] == 42
+    failed = wait_for_job(jobs, jobs.submit(lambda: 1 / 0))
+    assert failed["status"] == "failed" and "division" in failed["error"]
+    assert jobs.status("missing") is None
+
+    now = [1000.0]
+    jobs = JobManager(max_workers=1, job_ttl=60, clock=lambda: now[0])
+    finished = jobs.submit(lambda: "result")
+    assert wait_for_job(jobs, finished)["status"] == "done"
+    running = threading.Event()
+    pending = jobs.submit(running.wait, 5)
+    now[0] += 61
+    assert jobs.status(finished) is None and jobs.status(pending)["status"] in ("queued", "running")
+    running.set()
+    assert wait_for_job(jobs, pending)["status"] == "done" and list(jobs.jobs) == [pending]
+
+
+def test_server_mode_keeps_users_separate(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(UserSession, "run", lambda self, code: {"code": code, "options": self.options})
+    app = create_server_app(max_workers=2, features_cache=AudioFeaturesCache(str(tmp_path / "features.sqlite")),
+                            history_store=HistoryStore(str(tmp_path / "history.sqlite")),
+                            response_cache=ResponseCache(str(tmp_path / "http_cache.sqlite")),
+                            profile_store=ProfileStore(str(tmp_path / "profiles.sqlite")))
+    client = app.test_client()
+
+    assert client.get("/generate?limit=900").status_code == 400
+    first = client.get("/generate?playlist=abc&energy=9&include_artists=N")
+    second = client.get("/generate?limit=20&name=Chill")
+    assert first.status_code == second.status_code == 302
+    sessions = list(app.config["SESSIONS"].values())
+    assert len(sessions) == 2
+    assert sessions[0].auth.user_key != sessions[1].auth.user_key
+    assert sessions[0].auth.token_store is sessions[1].auth.token_store
+    assert not list(tmp_path.glob(".cache*"))
+    assert sessions[0].spotify_api is not sessions[1].spotify_api
+    assert sessions[0].spotify_api.scheduler is sessions[1].spotify_api.scheduler
+
+    response = client.get(f"/callback?code=secret&state={sessions[0].session_id}")
+    assert response.status_code == 202
+    job = wait_for_job(app.config["JOBS"], response.get_json()["job_id"])
+    assert job["result"]["code"] == "secret"
+    assert job["result"]["options"]["playlist_id"] == "abc"
+    assert job["result"]["options"]["preferences"]["energy"] == 9
+    assert client.get(response.get_json()["status_url"]).get_json()["status"] == "done"
+    assert client.get(f"/callback?code=secret&state={sessions[0].session_id}").status_code == 400
+    assert client.get("/metrics").mimetype == "text/plain"
+
+
+def test_generate_playlist_without_prompts():
+    api = SpotifyAPI()
+    api.user_session = FakeSession(playlist_size=120)
+    spotify_playlist = SpotifyPlaylist(api)
+    summary = spotify_playlist.generate_playlist("playlist", 80, {"energy": 7}, "Y", "Generated")
+    assert len(spotify_playlist.cover_uploads) == 1
+    spotify_playlist.cover_uploads[0].result(5)
+    created = api.user_session.created_playlist
+
+    assert list(summary.pop("timings")) == ["taste_profile", "recommendations", "rank", "write_playlist", "cover"]
+    assert summary == {"playlist_id": "generated", "analyzed_tracks": 80, "added_tracks": 100}
+    assert created["name"] == "Generated" and created["cover"]
+    assert created["items"] and all(track_id.startswith("artist") for track_id in created["items"])
+    assert len(set(created["items"])) == len(created["items"]) == 100
+
+
+def test_buffered_stage_keeps_order_and_raises_errors():
+    produced = []
+
+    def stage():
+        for item in range(10):
+            produced.append(item)
+            yield item
+        raise ValueError("stage failed")
+
+    items = buffered(stage(), maxsize=2)
+    assert next(items) == 0
+    time.sleep(0.05)
+    # The stage is at most the two queued items (and the one waiting to be queued) ahead of its consumer.
+    assert len(produced) <= 4
+    collected = []
+    with pytest.raises(ValueError):
+        for item in items:
+            collected.append(item)
+    assert collected == list(range(1, 10))
+    assert list(chunks(unique([3, 1, 3, 2, 4, 1, 5], seen=[4]), 2)) == [[3, 1], [2, 5]]
+
+
+class PipelinedSession(FakeSession):
+    # The last page of the playlist is only returned once audio features were requested, which only happens if the
+    # analysis of the first pages starts before every page arrived.
+    def __init__(self, playlist_size):
+        super().__init__(playlist_size)
+        self.features_requested = threading.Event()
+        self.overlapped = False
+
+    def audio_features(self, tracks):
+        self.features_requested.set()
+        return super().audio_features(tracks)
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        if offset + limit >= self.playlist_size > offset:
+            self.overlapped = self.features_requested.wait(5)
+        return super().playlist_items(playlist_id, fields, limit, offset, market)
+
+
+def test_taste_profile_requests_features_while_pages_arrive():
+    api = SpotifyAPI(max_workers=4)
+    api.user_session = PipelinedSession(playlist_size=300)
+    profile = api.get_taste_profile(300, "playlist")
+
+    assert api.user_session.overlapped
+    assert profile.track_count == 300 and len(profile.track_ids()) == 300
+    assert sorted(len(call) for call in api.user_session.audio_features_calls) == [100, 100, 100]
+
+
+def test_cover_assets_are_encoded_once_within_the_size_limit(monkeypatch):
+    with open(COVER_PATHS[0], "rb") as image_file:
+        data = image_file.read()
+    assets = CoverAssets()
+    encoded = assets.load()
+    assert encoded[0] == base64.b64encode(data) and len(encoded) == 2
+    assert assets.load() is encoded and assets.choose() in encoded
+
+    # Too large covers are skipped without Pillow to downscale them.
+    monkeypatch.setitem(sys.modules, "PIL", None)
+    assert encode_cover(data, max_bytes=len(data)) is None
+    assert CoverAssets(max_bytes=1000).choose() is None
+
+
+def test_cover_is_downscaled_to_the_size_limit():
+    pytest.importorskip("PIL")
+    with open(COVER_PATHS[0], "rb") as image_file:
+        data = image_file.read()
+    encoded = encode_cover(data, max_bytes=20000)
+    assert len(encoded) <= 20000 and base64.b64decode(encoded).startswith(b"\xff\xd8")
+
+
+def test_cover_upload_runs_in_the_background():
+    release = threading.Event()
+    uploaded = []
+    uploader = CoverUploader()
+    future = uploader.submit(lambda: uploaded.append(release.wait(5)))
+    finished = []
+    when_done([future], lambda: finished.append(True))
+    assert not uploaded and not finished
+    assert not uploader.wait(0.01)
+    release.set()
+    assert uploader.wait(5)
+    assert uploaded == [True] and finished == [True]
+    when_done([], lambda: finished.append(True))
+    assert finished == [True, True]
+
+
+def test_running_statistics_remove_undoes_add():
+    values = [0.2, 0.9, 0.4, 0.7, 0.1]
+    running_statistics = RunningStatistics()
+    for value in values + [0.5, 0.3]:
+        running_statistics.add(value)
+    running_statistics.remove(0.5)
+    running_statistics.remove(0.3)
+    assert running_statistics.count == len(values)
+    assert running_statistics.mean == pytest.approx(statistics.mean(values))
+    assert running_statistics.variance == pytest.approx(statistics.variance(values))
+    assert RunningStatistics.from_list(running_statistics.to_list()).to_list() == running_statistics.to_list()
+
+
+class ChangingPlaylistSession(FakeSession):
+    # Playlist items counted by call, with the tracks given by track_numbers, which the tests change between runs.
+    def __init__(self, track_numbers, energies):
+        super().__init__(energies=energies)
+        self.track_numbers = track_numbers
+        self.playlist_items_calls = 0
+
+    def playlist(self, playlist_id, fields=None):
+        return {"snapshot_id": ",".join(map(str, self.track_numbers))}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        self.playlist_items_calls += 1
+        items = [{"track": {"id": str(i), "artists": [{"id": f"artist{i % 7}"}]}}
+                 for i in self.track_numbers[offset:offset + limit]]
+        return {"items": items, "total": len(self.track_numbers)}
+
+
+def test_taste_profile_applies_only_changed_tracks(tmp_path):
+    energies = {str(i): i / 200 for i in range(200)}
+    fake_session = ChangingPlaylistSession(list(range(120)), energies)
+    spotify_api = SpotifyAPI(profile_store=ProfileStore(str(tmp_path / "profiles.sqlite")))
+    spotify_api.user_session = fake_session
+    profile = spotify_api.get_taste_profile(150, "playlist")
+    assert profile.track_count == 120
+
+    fake_session.playlist_items_calls = 0
+    fake_session.audio_features_calls.clear()
+    assert spotify_api.get_taste_profile(150, "playlist").means() == profile.means()
+    assert fake_session.playlist_items_calls == 0 and not fake_session.audio_features_calls
+
+    fake_session.track_numbers = list(range(10, 120)) + list(range(150, 170)) + [150]
+    profile = spotify_api.get_taste_profile(150, "playlist")
+    assert sorted(map(int, sum(fake_session.audio_features_calls, []))) == list(range(10)) + list(range(150, 170))
+
+    fresh = TasteProfile(None, "playlist")
+    tracks = SpotifyAPI.get_recently_or_playlist(spotify_api, 150, False, "playlist")
+    fresh.update(tracks, {track["id"]: track for track in spotify_api.get_audio_features([t.id for t in tracks])})
+    assert profile.track_count == fresh.track_count == 131
+    assert profile.means() == pytest.approx(fresh.means())
+    assert profile.artist_counts == fresh.artist_counts
+    assert [count for artist_id, count in profile.top_artists()] == [
+        count for artist_id, count in SpotifyPlaylist.get_user_top_artists(tracks)]
+
+
+class CountingRecommendationsSession(FakeSession):
+    # Recommendations that record the seed artists and the target energy of every request.
+    def __init__(self, playlist_size):
+        super().__init__(playlist_size)
+        self.recommendations_calls = []
+
+    def recommendations(self, seed_artists, limit, **targets):
+        self.recommendations_calls.append((tuple(seed_artists), targets["target_energy"]))
+        return super().recommendations(seed_artists, limit, **targets)
+
+
+def test_generate_variants_shares_analysis_and_requests():
+    api = SpotifyAPI()
+    api.user_session = CountingRecommendationsSession(playlist_size=120)
+    variants = [{"preferences": {"energy": 9}, "artist_inclusion": "Y", "playlist_name": "High energy"},
+                {"preferences": {"energy": 1}, "artist_inclusion": "Y", "playlist_name": "Chill"},
+                {"preferences": {"energy": 9}, "artist_inclusion": "Y", "playlist_name": "Discovery",
+                 "filter_options": {"max_tracks_per_artist": 3}}]
+    summary = SpotifyPlaylist(api).generate_variants("playlist", 80, variants)
+
+    # 7 top artists are 2 seed batches, the first and the last variant have the same target features.
+    assert summary["recommendation_requests"] == 4
+    assert sorted(api.user_session.recommendations_calls) == sorted(set(api.user_session.recommendations_calls))
+    assert {energy for seeds, energy in api.user_session.recommendations_calls} == {0.9, 0.1}
+    candidate_ids = [track_id for call in api.user_session.audio_features_calls[1:] for track_id in call]
+    assert len(candidate_ids) == len(set(candidate_ids))
+    assert [playlist["playlist_name"] for playlist in summary["playlists"]] == ["High energy", "Chill", "Discovery"]
+    assert summary["analyzed_tracks"] == 80
+    assert summary["playlists"][2]["added_tracks"] == 7 * 3 < summary["playlists"][0]["added_tracks"]
+
+
+class RefreshSession(FakeSession):
+    # An earlier generated playlist ('existing') with the given tracks, which records the add and remove requests.
+    def __init__(self, playlist_size, existing_track_ids):
+        super().__init__(playlist_size)
+        self.existing_track_ids = list(existing_track_ids)
+        self.writes = []
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        if playlist_id != "existing":
+            return super().playlist_items(playlist_id, fields, limit, offset, market)
+        items = [{"track": {"id": track_id, "artists": [{"id": track_id.split("-")[0]}]}}
+                 for track_id in self.existing_track_ids[offset:offset + limit]]
+        return {"items": items, "total": len(self.existing_track_ids)}
+
+    def playlist_add_items(self, playlist_id, items):
+        self.writes.append(("add", len(items)))
+        self.existing_track_ids += items
+
+    def playlist_remove_all_occurrences_of_items(self, playlist_id, items):
+        self.writes.append(("remove", len(items)))
+        self.existing_track_ids = [track_id for track_id in self.existing_track_ids if track_id not in items]
+
+
+def test_refresh_playlist_sends_only_the_difference():
+    api = SpotifyAPI()
+    api.user_session = FakeSession(playlist_size=120)
+    expected = SpotifyPlaylist(api).generate_playlist("playlist", 80, {"energy": 7}, "Y", "Generated")
+    expected_track_ids = api.user_session.created_playlist["items"]
+
+    kept = expected_track_ids[:60]
+    api.user_session = RefreshSession(120, ["stale-1", "stale-2"] + kept)
+    summary = SpotifyPlaylist(api).generate_playlist("playlist", 80, {"energy": 7}, "Y", "Generated",
+                                                     target_playlist_id="existing")
+    assert summary["playlist_id"] == "existing"
+    assert summary["added_tracks"] == 40 and summary["removed_tracks"] == 2
+    assert api.user_session.writes == [("remove", 2), ("add", 40)]
+    assert sorted(api.user_session.existing_track_ids) == sorted(expected_track_ids)
+    assert "cover" not in getattr(api.user_session, "created_playlist", {})
+    assert expected["added_tracks"] == 100
+
+
+class FailingWriteSession(RefreshSession):
+    # Creates the 'existing' playlist, then fails the first add request with a server error.
+    def __init__(self, playlist_size):
+        super().__init__(playlist_size, [])
+        self.created = []
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=''):
+        self.created.append(name)
+        return {"id": "existing"}
+
+    def playlist_add_items(self, playlist_id, items):
+        if not self.writes:
+            self.writes.append(("failed", len(items)))
+            raise SpotifyException(500, -1, "server error")
+        super().playlist_add_items(playlist_id, items)
+
+    def playlist_upload_cover_image(self, playlist_id, image_b64):
+        self.writes.append(("cover", playlist_id))
+
+
+def test_retried_job_refreshes_the_playlist_it_created(tmp_path, monkeypatch):
+    session = FailingWriteSession(120)
+    monkeypatch.setattr(Auth, "create_user_session", lambda self: session)
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"), retry_delay=0)
+    generation_worker = GenerationWorker(features_cache=AudioFeaturesCache(str(tmp_path / "features.sqlite")),
+                                         history_store=HistoryStore(str(tmp_path / "history.sqlite")),
+                                         response_cache=ResponseCache(str(tmp_path / "http_cache.sqlite")),
+                                         profile_store=ProfileStore(str(tmp_path / "profiles.sqlite")),
+                                         scheduler=RequestScheduler(max_retries=0))
+    queue_worker = QueueWorker(job_queue, generation_worker)
+    options = {"playlist_id": "abc", "track_limit": 80, "preferences": {}, "artist_inclusion": "Y",
+               "playlist_name": "Queued"}
+    job_id = job_queue.submit({"options": options, "token_info": token_info("token", 4000000000)})
+
+    assert queue_worker.run_once()
+    assert job_queue.status(job_id)["status"] == "queued"
+    assert queue_worker.run_once()
+    job = job_queue.status(job_id)
+    assert job["status"] == "done" and job["attempts"] == 2
+    assert job["result"]["playlist_id"] == "existing" and session.created == ["Queued"]
+    assert len(session.existing_track_ids) == job["result"]["added_tracks"] == 100
+    assert COVER_UPLOADER.wait(5) and ("cover", "existing") in session.writes
+
+    # A source without tracks cannot be analyzed on a later attempt either, the job is not retried.
+    session.playlist_size = 0
+    job_id = job_queue.submit({"options": dict(options, playlist_id="empty"),
+                               "token_info": token_info("token", 4000000000)})
+    assert queue_worker.run_once()
+    assert job_queue.status(job_id)["status"] == "failed" and job_queue.status(job_id)["attempts"] == 1
+
+
+def test_read_job_specs_formats():
+    expected = {"playlist": "abc", "limit": "30", "name": "Mix"}
+    assert read_job_specs(io.StringIO("playlist,limit,name\nabc,30,Mix\n")) == [expected]
+    assert read_job_specs(io.StringIO('[{"playlist": "abc", "limit": 30, "name": "Mix"}]')) == [
+        {"playlist": "abc", "limit": 30, "name": "Mix"}]
+    assert len(read_job_specs(io.StringIO('{"limit": 30}\n{"limit": 40}\n'))) == 2
+
+
+def test_batch_runner_reports_each_job(tmp_path):
+    specs = [{"playlist": "a", "limit": 60, "energy": 8, "include_artists": True, "name": "First"},
+             {"limit": "", "name": "Second"},
+             {"limit": 900, "name": "Invalid"}]
+    output = io.StringIO()
+    results = BatchRunner(lambda: PagedHistorySession(plays=100, playlist_size=100), max_workers=2,
+                          history_store=HistoryStore(str(tmp_path / "history.sqlite"))).run(specs, out=output)
+
+    assert [result["status"] for result in results] == ["done", "done", "failed"]
+    assert results[0]["analyzed_tracks"] == 60 and results[0]["playlist_id"] == "generated"
+    assert results[1]["analyzed_tracks"] > 0 and results[1]["added_tracks"] > 0
+    assert "limit" in results[2]["error"]
+    assert all(result["seconds"] >= 0 for result in results)
+    assert len(output.getvalue().splitlines()) == 3
+
+    empty = BatchRunner(lambda: FakeSession(playlist_size=0)).run([{"name": "Empty"}], out=io.StringIO())
+    assert empty[0]["status"] == "failed" and "no tracks" in empty[0]["error"]
+
+
+class StubSpotifyHandler(BaseHTTPRequestHandler):
+    # Local stand-in for the Spotify Web API, answering from a FakeSession. The first audio-features request gets a
+    # 429, and every new connection is counted to check that the connections are kept alive. Playlist items have an
+    # ETag, and get a 304 when the request's If-None-Match matches it. Adding the track 'fail' gets a 500.
+    protocol_version = "HTTP/1.1"
+    fake_session = FakeSession(playlist_size=130)
+    connections = set()
+    throttled = []
+    not_modified = []
+    failed_posts = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/v1/audio-features" and not self.throttled:
+            self.throttled.append(True)
+            return self.send_json(429, {"error": {"status": 429}}, {"Retry-After": "0"})
+        if url.path == "/v1/audio-features":
+            return self.send_json(200, {"audio_features": self.fake_session.audio_features(query["ids"].split(","))})
+        if url.path.startswith("/v1/playlists/"):
+            etag = f'"{self.fake_session.playlist_size}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.not_modified.append(self.path)
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            return self.send_json(200, self.fake_session.playlist_items(
+                "playlist", limit=int(query["limit"]), offset=int(query.get("offset", 0))),
+                {"ETag": etag, "Cache-Control": "private, max-age=0"})
+        if url.path == "/v1/recommendations":
+            return self.send_json(200, self.fake_session.recommendations(query["seed_artists"].split(","), 10))
+        self.send_json(404, {"error": {"status": 404}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if "spotify:track:fail" in body["uris"]:
+            self.failed_posts.append(self.path)
+            return self.send_json(500, {"error": {"status": 500}})
+        self.send_json(201, {"snapshot_id": "snapshot", "added": body["uris"]})
+
+
+@pytest.fixture
+def stub_spotify_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSpotifyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_client_against_stub_server(stub_spotify_url):
+    async def run():
+        async with create_connection_pool(stub_spotify_url, max_connections=2) as pool:
+            client = AsyncSpotifyClient("token", pool, base_delay=0)
+            tracks = await client.get_recently_or_playlist(120, False, "playlist")
+            track_ids = [track.id for track in tracks]
+            audio_features = await client.get_audio_features(track_ids)
+            recommendations = await client.get_recommended_tracks(["a", "b", "c", "d", "e", "f"], {"energy": 0.5})
+            added = await client.playlist_add_items("generated", ["1", "spotify:track:2"])
+            with pytest.raises(SpotifyException):
+                await client.artists(["a"])
+            with pytest.raises(SpotifyException):
+                await client.playlist_add_items("generated", ["fail"])
+            return track_ids, audio_features, recommendations, added
+
+    track_ids, audio_features, recommendations, added = asyncio.run(run())
+    assert track_ids == [str(i) for i in range(120)]
+    assert [track["id"] for track in audio_features] == track_ids
+    assert len(recommendations) == 20
+    assert added["added"] == ["spotify:track:1", "spotify:track:2"]
+    assert StubSpotifyHandler.throttled == [True]
+    assert len(StubSpotifyHandler.failed_posts) == 1
+    assert len(StubSpotifyHandler.connections) <= 2
+
+
+def test_async_client_uses_features_cache_off_the_event_loop(stub_spotify_url, tmp_path):
+    class ThreadRecordingCache(AudioFeaturesCache):
+        def get_many(self, track_ids):
+            threads.append(threading.get_ident())
+            return super().get_many(track_ids)
+
+        def put_many(self, audio_features):
+            threads.append(threading.get_ident())
+            return super().put_many(audio_features)
+
+    threads = []
+    features_cache = ThreadRecordingCache(str(tmp_path / "features.sqlite"))
+
+    async def run():
+        async with create_connection_pool(stub_spotify_url) as pool:
+            client = AsyncSpotifyClient("token", pool, base_delay=0, features_cache=features_cache)
+            await client.get_audio_features(["1", "2"])
+            return threading.get_ident(), await client.get_audio_features(["1", "2"])
+
+    loop_thread, audio_features = asyncio.run(run())
+    assert [track["id"] for track in audio_features] == ["1", "2"]
+    assert len(threads) == 3 and loop_thread not in threads
+    features_cache.close()
+
+
+def test_benchmark_counts_calls_and_retries():
+    result = run_benchmark(120, throttle_every=4)
+    assert result["analyzed_tracks"] == 120
+    assert result["api_calls_by_method"]["playlist_items"] >= 3
+    assert result["api_calls"] == sum(result["api_calls_by_method"].values())
+    assert result["retries"] == result["api_calls"] // 4
+    assert result["peak_memory_bytes"] > 0
+
+
+def test_benchmark_small_pages_analyze_every_track():
+    result = run_benchmark(500, page_size=20)
+    assert result["analyzed_tracks"] == 500
+    assert result["api_calls_by_method"]["playlist_items"] == 25
+
+
+def test_benchmark_suite_warm_cache_skips_audio_features():
+    report = run_suite(sizes=[60])
+    cold, warm = report["results"]
+    assert (cold["cache"], warm["cache"]) == ("cold", "warm")
+    assert "audio_features" not in warm["api_calls_by_method"]
+    assert json.loads(json.dumps(report)) == report
+
+
+def test_benchmark_report_on_stdout_is_valid_json(capsys):
+    assert benchmark_main(["--sizes", "60", "--latency", "0"]) == 0
+    captured = capsys.readouterr()
+    assert [result["tracks"] for result in json.loads(captured.out)["results"]] == [60, 60]
+    assert "Playlist cover image uploaded successfully" in captured.err
+
+
+def test_metrics_record_requests_retries_and_cache_hits(tmp_path):
+    registry = MetricsRegistry()
+    api = SpotifyAPI(AudioFeaturesCache(str(tmp_path / "features.sqlite"), metrics=registry), metrics=registry)
+    api.user_session = FakeSession()
+    api.get_track_audio_features(["1", "2"])
+    api.get_track_audio_features(["1", "3"])
+
+    assert registry.value("spotify_requests_total", method="audio_features", status="ok") == 2
+    assert registry.value("features_cache_hits_total") == 1
+    assert registry.value("features_cache_misses_total") == 3
+    assert registry.histogram("spotify_api_method_seconds", method="get_track_audio_features").count == 2
+
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock, sleep=clock.sleep, metrics=registry)
+    scheduler.call(failing([SpotifyException(429, -1, "Too many requests", headers={"Retry-After": "1"})]))
+    assert registry.value("spotify_retries_total") == registry.value("spotify_throttled_total") == 1
+
+    text = registry.render()
+    assert "# TYPE spotify_request_seconds histogram" in text
+    assert 'spotify_requests_total{method="audio_features",status="ok"} 2' in text
+    assert 'spotify_request_seconds_bucket{method="audio_features",le="+Inf"} 2' in text
+
+
+def test_run_timer_breakdown():
+    registry = MetricsRegistry()
+    timer = RunTimer(registry)
+    with timer.stage("fetch_tracks"):
+        pass
+    with pytest.raises(ValueError):
+        with timer.stage("rank"):
+            raise ValueError
+    assert list(timer.stages) == ["fetch_tracks", "rank"]
+    assert timer.report().startswith("fetch_tracks 0.00s, rank 0.00s (total")
+    assert registry.histogram("pipeline_stage_seconds", stage="rank").count == 1
+
+
+def test_recommendation_filter_single_pass_constraints():
+    recommendations = [
+        {"id": "1", "artists": [{"id": "artist1"}], "explicit": True, "duration_ms": 200000},
+        {"id": "2", "artists": [{"id": "artist1"}], "explicit": False, "duration_ms": 200000},
+        {"id": "3", "artists": [{"id": "artist2"}], "explicit": False, "duration_ms": 100000},
+        {"id": "4", "artists": [{"id": "artist1"}, {"id": "artist3"}], "explicit": False, "duration_ms": 180000},
+        {"id": "2", "artists": [{"id": "artist1"}], "explicit": False, "duration_ms": 200000},
+        {"id": "5", "artists": [{"id": "artist3"}], "explicit": False, "duration_ms": 240000},
+        {"id": "6", "artists": [{"id": "artist4"}], "explicit": False, "duration_ms": 240000},
+        {"id": "7", "artists": [{"id": "artist5"}]},
+    ]
+    assert RecommendationFilter().filter_ids(recommendations) == ["1", "2", "3", "4", "5", "6", "7"]
+    assert RecommendationFilter(seen_track_ids=["5"], history_track_ids=["6"], allow_explicit=False,
+                                min_duration_ms=150000, max_duration_ms=230000,
+                                max_tracks_per_artist=1).filter_ids(recommendations) == ["2", "7"]
+
+    recommendation_filter = RecommendationFilter(max_tracks_per_artist=2)
+    batches = [recommendations[:3], recommendations[3:6], recommendations[6:]]
+    assert ([track["id"] for batch in batches for track in recommendation_filter.add(batch)] ==
+            RecommendationFilter(max_tracks_per_artist=2).filter_ids(recommendations) == ["1", "2", "3", "5", "6", "7"])
+
+
+def test_parse_options_filters():
+    options = SpotifyPlaylist.parse_options({"explicit": "N", "min_duration": "90", "max_per_artist": 2})
+    assert options["filter_options"] == {"allow_explicit": False, "min_duration_ms": 90000,
+                                         "max_tracks_per_artist": 2}
+    with pytest.raises(ValueError):
+        SpotifyPlaylist.parse_options({"max_duration": "-1"})
+    with pytest.raises(ValueError):
+        SpotifyPlaylist.parse_options({"exclude_history": "yes"})
+
+
+class ListenedSession(FakeSession):
+    # The given tracks were played recently, one per minute.
+    def __init__(self, playlist_size, played_track_ids):
+        super().__init__(playlist_size)
+        self.played_track_ids = played_track_ids
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        items = [{"played_at": format_played_at(1700000000000 + index * 60000),
+                  "track": {"id": track_id, "artists": [{"id": track_id.split("-")[0]}]}}
+                 for index, track_id in enumerate(self.played_track_ids)]
+        return {"items": [item for item in items if after is None or played_at_ms(item["played_at"]) > after]}
+
+
+def test_exclude_history_option_leaves_out_played_tracks(tmp_path):
+    api = SpotifyAPI()
+    api.user_session = FakeSession(playlist_size=120)
+    SpotifyPlaylist(api).generate_playlist(**SpotifyPlaylist.parse_options({"playlist": "abc", "limit": "80"}))
+    played_track_ids = api.user_session.created_playlist["items"][:10]
+
+    api = SpotifyAPI(history_store=HistoryStore(str(tmp_path / "history.sqlite")))
+    api.user_session = ListenedSession(120, played_track_ids)
+    options = SpotifyPlaylist.parse_options({"playlist": "abc", "limit": "80", "exclude_history": "Y"})
+    assert options["filter_options"]["exclude_history"] is True
+    summary = SpotifyPlaylist(api).generate_playlist(**options)
+    created_track_ids = api.user_session.created_playlist["items"]
+    assert summary["added_tracks"] == len(created_track_ids) == 100
+    assert not set(played_track_ids) & set(created_track_ids)
+    assert api.history_store.track_ids("user") == set(played_track_ids)
+
+
+def test_sample_estimate_intervals_shrink_to_the_population_mean():
+    pages = [[{"id": str(page * 10 + i), "energy": (page * 10 + i) % 7 / 7} for i in range(10)] for page in range(6)]
+    estimate = SampleEstimate(len(pages), keys=("energy",))
+    estimate.add_page(pages[0])
+    assert estimate.margins()["energy"] == float("inf")
+    for page in pages[1:]:
+        estimate.add_page(page)
+    population = [track["energy"] for page in pages for track in page]
+    assert estimate.means()["energy"] == pytest.approx(statistics.mean(population))
+    assert estimate.margins()["energy"] == 0
+    assert estimate.is_precise(tolerance=0.001)
+
+
+def test_sampling_large_playlist_stops_when_precise():
+    rng = random.Random(7)
+    energies = {str(i): rng.random() for i in range(10000)}
+    spotify_api = SpotifyAPI(max_workers=4)
+    spotify_api.user_session = FakeSession(playlist_size=10000, energies=energies)
+
+    tracks, estimate = spotify_api.sample_playlist("playlist", tolerance=0.02, rng=random.Random(1))
+    assert 250 <= len(tracks) < 10000
+    assert len({track.id for track in tracks}) == len(tracks)
+    low, high = estimate.confidence_intervals()["energy"]
+    assert high - low <= 0.04
+    assert low <= statistics.mean(energies.values()) <= high
+    assert spotify_api.target_features["energy"] == estimate.means()["energy"]
+
+    options = SpotifyPlaylist.parse_options({"playlist": "playlist", "limit": "5000", "sample": "Y"})
+    assert options["sample"] and options["track_limit"] == 5000
+    with pytest.raises(ValueError):
+        SpotifyPlaylist.parse_options({"limit": "5000"})
+
+
+class ProjectedSession(FakeSession):
+    # Playlist items that record the requested fields, with a local file (no track ID) as the third item.
+    def __init__(self, playlist_size):
+        super().__init__(playlist_size)
+        self.fields = []
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None):
+        self.fields.append(fields)
+        response = super().playlist_items(playlist_id, fields, limit, offset, market)
+        if offset == 0:
+            response["items"][2] = {"track": {"id": None, "artists": [{"id": None, "name": "Local"}]}}
+        return response
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_playlist_items_are_projected_to_track_records(max_workers):
+    spotify_api = SpotifyAPI(max_workers=max_workers)
+    spotify_api.user_session = ProjectedSession(playlist_size=120)
+    tracks = spotify_api.get_recently_or_playlist(120, False, "playlist")
+    assert set(spotify_api.user_session.fields) == {PLAYLIST_ITEM_FIELDS}
+    assert len(tracks) == 119 and "2" not in {track.id for track in tracks}
+    assert tracks[0] == TrackRecord("0", ["artist0"])
+    assert not hasattr(tracks[0], "__dict__")
+    items = [{"track": None}, {"track": {"id": "1", "artists": [{"id": "a"}]}}]
+    assert track_records(items) == [TrackRecord("1", ["a"])]
+
+
+def test_response_cache_revalidates_with_etag(stub_spotify_url, tmp_path):
+    metrics = MetricsRegistry()
+    response_cache = ResponseCache(str(tmp_path / "http_cache.sqlite"))
+    session = Auth.create_spotify_session("token", metrics, response_cache)
+    session._session.mount("http://", ConditionalCacheAdapter(response_cache, metrics))
+    session.prefix = stub_spotify_url
+    StubSpotifyHandler.not_modified.clear()
+
+    first = session.playlist_items("playlist", limit=50, offset=0)
+    received = metrics.value("spotify_response_bytes_total", endpoint="playlists")
+    second = session.playlist_items("playlist", limit=50, offset=0)
+    assert second == first
+    assert len(StubSpotifyHandler.not_modified) == 1
+    assert metrics.value("http_cache_requests_total", outcome="revalidated") == 1
+    assert metrics.value("spotify_response_bytes_total", endpoint="playlists") == received
+
+    StubSpotifyHandler.fake_session.playlist_size = 131
+    try:
+        assert session.playlist_items("playlist", limit=50, offset=0)["total"] == 131
+    finally:
+        StubSpotifyHandler.fake_session.playlist_size = 130
+    assert len(StubSpotifyHandler.not_modified) == 1
+
+
+def test_response_cache_evicts_by_size(tmp_path):
+    response_cache = ResponseCache(str(tmp_path / "http_cache.sqlite"), max_bytes=250)
+    for index in range(4):
+        response_cache.put(f"https://api/{index}", {"ETag": str(index)}, b"x" * 100)
+    assert len(response_cache) == 2
+    assert response_cache.size() == 200
+    assert response_cache.get("https://api/0") is None
+    assert response_cache.get("https://api/3")[1] == b"x" * 100
+
+
+class FakeHistorySession(FakeSession):
+    # Recently played endpoint with played_at times one minute apart: the newest 50 plays are returned, only the ones
+    # after the cursor if it is given.
+    def __init__(self, plays):
+        super().__init__()
+        self.plays = plays
+        self.recently_played_calls = []
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self.recently_played_calls.append(after)
+        played = [(1700000000000 + index * 60000, index) for index in range(self.plays)]
+        played = [(time, index) for time, index in played if after is None or time > after][-limit:]
+        return {"items": [{"played_at": format_played_at(time), "track": {"id": str(index), "artists": []}}
+                          for time, index in reversed(played)]}
+
+
+class PagedHistorySession(FakeSession):
+    # Recently played endpoint that pages back in time with the before cursor, like Spotify.
+    def __init__(self, plays, playlist_size=0):
+        super().__init__(playlist_size)
+        self.plays = plays
+        self.before_cursors = []
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self.before_cursors.append(before)
+        end = self.plays if before is None else int(before)
+        indexes = list(range(max(end - limit, 0), end))[::-1]
+        cursors = {"before": str(indexes[-1]), "after": str(indexes[0])} if indexes else None
+        return {"items": [{"played_at": format_played_at(1700000000000 + index * 60000),
+                           "track": {"id": str(index), "artists": [{"id": "artist"}]}} for index in indexes],
+                "cursors": cursors}
+
+
+def test_recently_played_pages_back_without_history_store():
+    spotify_api = SpotifyAPI()
+    spotify_api.user_session = PagedHistorySession(plays=80)
+    tracks = spotify_api.get_recently_or_playlist(120, True)
+    assert [track.id for track in tracks] == [str(index) for index in range(79, -1, -1)]
+    assert spotify_api.user_session.before_cursors == [None, "30"]
+    assert len(spotify_api.get_recently_or_playlist(20, True)) == 20
+
+
+def test_history_store_syncs_only_new_plays(tmp_path):
+    assert played_at_ms(format_played_at(1700000000123)) == 1700000000123
+    fake_session = FakeHistorySession(plays=30)
+    spotify_api = SpotifyAPI(history_store=HistoryStore(str(tmp_path / "history.sqlite")))
+    spotify_api.user_session = fake_session
+    assert [track.id for track in spotify_api.get_tracks(5, playlist_num=0)] == ["29", "28", "27", "26", "25"]
+
+    fake_session.plays = 100
+    fake_session.recently_played_calls.clear()
+    items = spotify_api.get_tracks(200, playlist_num=0)
+    assert fake_session.recently_played_calls[0] == 1700000000000 + 29 * 60000
+    assert len(fake_session.recently_played_calls) == 2
+    assert len(items) == 80
+    assert spotify_api.history_store.track_ids("user") == {str(index) for index in range(30)} | {
+        str(index) for index in range(50, 100)}
+
+
 if __name__ == '__main__':
     pytest.main()
@@ -0,0 +1,133 @@
+import threading
+import time
+from spotipy.cache_handler import CacheHandler
+
+
+class TokenCacheHandler(CacheHandler):
+    # Spotipy cache handler of one user's token in a TokenStore, given to SpotifyOAuth instead of a CacheFileHandler.
+    def __init__(self, token_store, key):
+        self.token_store = token_store
+        self.key = key
+
+    def get_cached_token(self):
+        return self.token_store.get(self.key)
+
+    def save_token_to_cache(self, token_info):
+        self.token_store.put(self.key, token_info)
+
+
+class TokenManager:
+    # Auth manager of spotipy.Spotify that reads the user's access token from the TokenStore's memory on every request.
+    # The token is only refreshed here if it already expired, because the background refresh could not run.
+    def __init__(self, token_store, key):
+        self.token_store = token_store
+        self.key = key
+
+    def get_access_token(self, as_dict=False):
+        token_info = self.token_store.get(self.key)
+        if token_info is not None and token_info["expires_at"] <= self.token_store.clock():
+            token_info = self.token_store.refresh(self.key) or token_info
+        if token_info is None:
+            return None
+        return token_info if as_dict else token_info["access_token"]
+
+
+class TokenStore:
+    # The access tokens of every user in memory, keyed by user (for example the session ID of the server mode), so the
+    # authenticated requests never read a file. Saved tokens are written through to the optional backing store:
+    # backing(key) returns a spotipy CacheHandler for the user, like CacheFileHandler, which is read once per user.
+    # A background thread refreshes every registered token refresh_margin seconds before it expires.
+    def __init__(self, backing=None, refresh_margin=300, check_interval=30, clock=time.time):
+        self.backing = backing
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self.clock = clock
+        self.tokens = {}
+        self.refreshers = {}
+        self.backing_handlers = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def cache_handler(self, key):
+        return TokenCacheHandler(self, key)
+
+    def token_manager(self, key):
+        return TokenManager(self, key)
+
+    def backing_handler(self, key):
+        if self.backing is None:
+            return None
+        with self.lock:
+            if key not in self.backing_handlers:
+                self.backing_handlers[key] = self.backing(key)
+            return self.backing_handlers[key]
+
+    def get(self, key):
+        # Return the user's token_info, or None if they have no token. Only the first lookup of a user reads the
+        # backing store.
+        with self.lock:
+            if key in self.tokens:
+                return self.tokens[key]
+        backing_handler = self.backing_handler(key)
+        token_info = backing_handler.get_cached_token() if backing_handler is not None else None
+        with self.lock:
+            return self.tokens.setdefault(key, token_info)
+
+    def put(self, key, token_info):
+        with self.lock:
+            self.tokens[key] = token_info
+        backing_handler = self.backing_handler(key)
+        if backing_handler is not None:
+            backing_handler.save_token_to_cache(token_info)
+
+    def discard(self, key):
+        # Forget the user's token and refresh function, for example once their server mode session is over.
+        with self.lock:
+            self.tokens.pop(key, None)
+            self.refreshers.pop(key, None)
+            self.backing_handlers.pop(key, None)
+
+    def register(self, key, refresh):
+        # Keep the user's token fresh with refresh(refresh_token), which returns the new token_info, for example
+        # SpotifyOAuth.refresh_access_token. The background thread starts with the first registered user.
+        with self.lock:
+            self.refreshers[key] = refresh
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="token-refresh", daemon=True)
+                self.thread.start()
+
+    def refresh(self, key):
+        # Refresh the user's token now and return the new token_info, or None if it could not be refreshed.
+        with self.lock:
+            refresh = self.refreshers.get(key)
+            token_info = self.tokens.get(key)
+        if refresh is None or not token_info or not token_info.get("refresh_token"):
+            return None
+        try:
+            new_token_info = refresh(token_info["refresh_token"])
+        except Exception:
+            # The old token stays until it expires, the next check tries again.
+            return None
+        # SpotifyOAuth.refresh_access_token already saves the new token through the store's cache handler, so it is
+        # only put here if the refresh function did not save it, and the backing store is written once.
+        with self.lock:
+            saved = self.tokens.get(key) == new_token_info
+        if new_token_info and not saved:
+            self.put(key, new_token_info)
+        return new_token_info
+
+    def refresh_due(self):
+        # Refresh the tokens that expire within refresh_margin seconds. Return the keys of the refreshed tokens.
+        deadline = self.clock() + self.refresh_margin
+        with self.lock:
+            due = [key for key in self.refreshers
+                   if self.tokens.get(key) and self.tokens[key].get("expires_at", 0) <= deadline]
+        return [key for key in due if self.refresh(key)]
+
+    def run(self):
+        while not self.stopped.wait(self.check_interval):
+            self.refresh_due()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,109 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from functools import partial
+from spotipy import SpotifyException
+from cache import AudioFeaturesCache
+from coalescing import RequestCoalescer
+from covers import when_done
+from history import HistoryStore
+from http_cache import ResponseCache
+from job_queue import JobQueue, PermanentJobError, QueueWorker
+from profiles import ProfileStore
+from project import Auth, SpotifyAPI, SpotifyPlaylist
+from scheduler import RequestScheduler
+from tokens import TokenStore
+
+
+class GenerationWorker:
+    # Generate the playlists of the jobs queued by the server mode (see create_server_app with a job_queue), like
+    # UserSession.run. The payload of a job holds the options of parse_options and the user's token_info, without
+    # the refresh token, so a job fails if it did not start before the access token expired.
+    # The ID of the created playlist is saved in the job's progress, so a retried job refreshes that playlist (see
+    # SpotifyPlaylist.refresh_playlist) instead of creating another one. The failures that a retry cannot fix (an
+    # expired token, a client error of Spotify, nothing to analyze) fail the job for good.
+    # One object is created per worker process: its jobs share the token store, the request coalescer and one
+    # RequestScheduler, since the rate limit of Spotify is the same for every job of the app. Every process opens the
+    # same audio features cache, listening history, taste profile and response cache databases, so the caches are
+    # shared by the processes too.
+    def __init__(self, api_workers=1, features_cache=None, history_store=None, response_cache=None,
+                 profile_store=None, scheduler=None):
+        self.api_workers = api_workers
+        self.features_cache = features_cache if features_cache is not None else AudioFeaturesCache()
+        self.history_store = history_store if history_store is not None else HistoryStore()
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self.profile_store = profile_store if profile_store is not None else ProfileStore()
+        self.token_store = TokenStore()
+        self.coalescer = RequestCoalescer()
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler(max_in_flight=api_workers)
+
+    def __call__(self, payload, progress=None):
+        # Generate the playlist of one job and return its summary. The token is forgotten once the cover is uploaded.
+        if payload["token_info"]["expires_at"] <= time.time():
+            raise PermanentJobError("the user's access token expired before the job started")
+        user_key = uuid.uuid4().hex
+        self.token_store.put(user_key, payload["token_info"])
+        auth = Auth(response_cache=self.response_cache, token_store=self.token_store, user_key=user_key)
+        spotify_api = SpotifyAPI(self.features_cache, max_workers=self.api_workers, history_store=self.history_store,
+                                 profile_store=self.profile_store, coalescer=self.coalescer,
+                                 scheduler=self.scheduler)
+        options = dict(payload["options"])
+        on_playlist_created = None
+        created_playlist_id = None
+        if progress is not None:
+            on_playlist_created = lambda playlist_id: progress.save(playlist_id=playlist_id)
+            created_playlist_id = progress.get("playlist_id")
+        if created_playlist_id is not None:
+            options["target_playlist_id"] = created_playlist_id
+        spotify_playlist = SpotifyPlaylist(spotify_api, on_playlist_created=on_playlist_created)
+        try:
+            spotify_api.user_session = auth.create_user_session()
+            summary = spotify_playlist.generate_playlist(**options)
+            if created_playlist_id is not None:
+                # The attempt that created the playlist failed before its cover was uploaded.
+                spotify_playlist.upload_cover(created_playlist_id)
+            return summary
+        except ValueError as error:
+            raise PermanentJobError(str(error)) from error
+        except SpotifyException as error:
+            if 400 <= error.http_status < 500 and error.http_status != 429:
+                raise PermanentJobError(str(error)) from error
+            raise
+        finally:
+            when_done(spotify_playlist.cover_uploads, partial(self.token_store.discard, user_key))
+
+
+def run_worker(queue_path, api_workers=1, until_empty=False):
+    # Entry point of a worker process: the queue and the caches are opened in the process itself.
+    QueueWorker(JobQueue(queue_path), GenerationWorker(api_workers)).run(until_empty=until_empty)
+
+
+def main(argv=None):
+    # Start worker processes that generate the playlists queued by 'python server.py --queue'. Several hosts can run
+    # workers on the same queue file, if it is on a shared filesystem with working file locks.
+    parser = argparse.ArgumentParser(description="Generate the playlists queued by the MelodyMystique server mode.")
+    parser.add_argument("--queue", default=".jobs.sqlite", help="job queue database shared with the server")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--api-workers", type=int, default=1, help="parallel Spotify requests per generation")
+    parser.add_argument("--until-empty", action="store_true", help="exit once no job is left in the queue")
+    arguments = parser.parse_args(argv)
+
+    processes = [multiprocessing.Process(target=run_worker, args=(arguments.queue, arguments.api_workers,
+                                                                  arguments.until_empty))
+                 for _ in range(arguments.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())